@@ -0,0 +1,317 @@
+import glob, os, argparse, warnings
+
+import astropy.io.fits as fits
+
+import numpy as np
+
+import morph
+
+from joblib import Parallel, delayed
+
+log = morph.get_logger('CLEAN_MORPHOLOGY_parallel')
+
+
+def failed_row(stem, flags):
+	# SExtractor couldn't do anything with this one -- keep a row anyway so
+	# the catalog accounts for every cutout
+	return {'name':'f_'+stem, 'objid':np.int64(stem.split('_')[0]),
+			'cat':flags[0], 'oflag':flags[1], 'uflag':flags[2], 
+			'bflag':flags[3]}
+
+
+def clean_job(args, f):
+	# Every worker cleans inside its own scratch directory -- clean_frame
+	# uses fixed file names and clean_directory deletes with wildcards, so
+	# a shared outdir is not safe. Only the finished datacube leaves scratch.
+	# f is a cutout file or a VirtualCutout
+	scratch = morph.worker_scratch(args.scratch)
+	if hasattr(f, 'name'):
+		stem = f.name
+	else:
+		stem = os.path.basename(os.path.splitext(f)[0])
+	try:
+		flags = morph.clean_frame(f, scratch, sep=args.sep, survey='SDSS')
+		cube = scratch+'f_'+stem+'.fits'
+		if not np.any(np.array(flags) < 9) or not os.path.isfile(cube):
+			return {'row':failed_row(stem, flags)}
+		filename = morph.promote(cube, args.outdir+'datacube/')
+	finally:
+		morph.remove_scratch(scratch)
+	return {'filename':filename, 'flags':flags}
+
+
+def measure_job(args, job):
+	# cutouts that couldn't be cleaned already have their row
+	if 'row' in job:
+		return job
+
+	with morph.stage('io'):
+		hdulist = fits.open(job['filename'])
+	g = morph.GalaxyMorphology(hdulist, job['filename'], job['flags'], 
+							   args.outdir)
+	with morph.stage('io'):
+		hdulist.close()
+
+	if args.plot:
+		# the plots need the profiles that table() throws away
+		job['galaxy'] = dict(g.__dict__)
+	job['row'] = g.table()
+	return job
+
+
+def plot_job(args, job):
+	# the figures are only for quality control -- a galaxy that can't be
+	# plotted still gets its row
+	galaxy = job.pop('galaxy', None)
+	if galaxy is not None and not np.isnan(galaxy['Rp']):
+		try:
+			with morph.measuring(job['filename'], counted=False), \
+				 morph.stage('plotting'):
+				hdulist = fits.open(job['filename'])
+				payload = morph.PlotPayload(galaxy, 
+											morph.plot_image(hdulist))
+				hdulist.close()
+				# each plotting worker keeps its figures from galaxy to 
+				# galaxy
+				for name, why in morph.reuse_figures(payload):
+					log.warning("Couldn't draw %s for %s: %s", name,
+								job['filename'], why)
+		except Exception:
+			log.exception("Couldn't plot %s", job['filename'])
+	return job
+
+
+def clean_and_measure_row(args, f):
+	# ...measure it straight away while it's still in the page cache
+	return measure_job(args, clean_job(args, f))['row']
+
+
+def clean_and_measure(args, f):
+	# in supervised mode a cutout that fails, hangs or eats all the memory
+	# gets quarantined and comes back as a NaN row with a failcode
+	with morph.measuring(f) as probe:
+		if args.supervise:
+			max_memory = args.max_memory*1e9 if args.max_memory else None
+			row = morph.supervised(clean_and_measure_row, (args,), f, 
+								   args.timeout, max_memory, args.quarantine)
+		else:
+			row = clean_and_measure_row(args, f)
+	if args.timings:
+		morph.add_timings(row, probe.columns())
+	return row
+
+
+def clean_and_measure_field(args, rows):
+	# one job per SDSS field: the field is memory-mapped once and every
+	# galaxy on it is cut out of it on the fly
+	result = []
+	for cut in morph.field_cutouts(rows, args.fielddir, args.scale, args.tag):
+		if cut.clipped:
+			log.warning("Too close to the edge of %s -- %s", cut.field,
+						cut.name)
+			continue
+		result.append(clean_and_measure(args, cut))
+	return result
+
+
+def supervised_job(args, func, job, source):
+	# supervised() quarantines whatever it was handed, so hand it the file
+	# (or cutout) behind the job and let it call func on the job itself
+	max_memory = args.max_memory*1e9 if args.max_memory else None
+	out = morph.supervised(lambda source: func(args, job), (), source,
+						   args.timeout, max_memory, args.quarantine)
+	if out['failcode'] != morph.FAIL_NONE:
+		return {'row':out}
+	del out['failcode'], out['failstage']
+	return out
+
+
+def clean_stage(args, f):
+	with morph.measuring(f) as probe:
+		if args.supervise:
+			job = supervised_job(args, clean_job, f, f)
+		else:
+			job = clean_job(args, f)
+		# the galaxy is done here only if it couldn't be cleaned; otherwise
+		# the measuring stage counts it
+		probe.counted = 'row' in job
+	if args.timings:
+		# cleaning's times travel with the job until there's a row
+		if 'row' in job:
+			morph.add_timings(job['row'], probe.columns())
+		else:
+			job['timings'] = probe.columns()
+	return job
+
+
+def measure_stage(args, job):
+	with morph.measuring(job.get('filename'), counted='row' not in job) \
+			as probe:
+		if args.supervise and 'row' not in job:
+			job = supervised_job(args, measure_job, job, job['filename'])
+			job['row'].setdefault('failcode', morph.FAIL_NONE)
+			job['row'].setdefault('failstage', '')
+		else:
+			job = measure_job(args, job)
+	if args.timings and 'timings' in job:
+		morph.add_timings(job['row'], probe.columns())
+		morph.add_timings(job['row'], job.pop('timings'))
+	return job
+
+
+def cutout_objid(f):
+	# cutouts are <objid>_<tag>.fits (no f_ in front until they're cleaned)
+	if hasattr(f, 'objid'):
+		return f.objid
+	return np.int64(os.path.basename(f).split('_')[0])
+
+
+def cutouts(args):
+	# discovery: every cutout file, or every virtual cutout field by field
+	if not args.fields:
+		for f in sorted(glob.glob(args.directory+"/*.fits")):
+			yield f
+		return
+	for rows in morph.group_by_field(args.fields):
+		for cut in morph.field_cutouts(rows, args.fielddir, args.scale, 
+									   args.tag):
+			if cut.clipped:
+				log.warning("Too close to the edge of %s -- %s", cut.field,
+							cut.name)
+				continue
+			yield cut
+
+
+def run_pipeline(args):
+	# cleaning (mostly waiting on SExtractor and the disk) and measuring 
+	# (all CPU) each get their own pool, joined by short queues, so they 
+	# run side by side instead of taking turns
+	stages = [morph.Stage('clean', clean_stage, (args,), args.cleaners),
+			  morph.Stage('measure', measure_stage, (args,), 
+						  args.measurers or morph.auto_workers())]
+	if args.plot:
+		stages.append(morph.Stage('plot', plot_job, (args,), args.plotters))
+
+	journal = open_journal(args)
+	todo = (f for f in cutouts(args) if cutout_objid(f) not in journal)
+
+	# the cutouts are found as they're needed: no total, no ETA
+	morph.status_started()
+
+	pipeline = morph.Pipeline(stages, report_every=args.report_every)
+	timed = []
+	for job in pipeline.run(todo):
+		with morph.stage('write', objid=int(job['row']['objid'])):
+			journal.append(job['row'])
+		if args.timings:
+			timed.append(job['row'])
+	write_catalog(args, journal, timed)
+
+
+def run_joblib(args):
+	# one joblib call over every cutout (or every field); the rows come
+	# back together at the end
+	journal = open_journal(args)
+	if args.fields:
+		groups = [rows[np.array([int(o) not in journal 
+								 for o in rows['objid']], dtype=bool)]
+				  for rows in morph.group_by_field(args.fields)]
+		groups = [rows for rows in groups if len(rows)]
+		morph.status_started(sum(len(rows) for rows in groups))
+		result = Parallel(n_jobs=args.n_jobs, verbose=morph.joblib_verbose())(
+					delayed(clean_and_measure_field)(args, rows)
+					for rows in groups)
+		result = [row for rows in result for row in rows]
+	else:
+		fitsfiles = [f for f in sorted(glob.glob(args.directory+"/*.fits"))
+					 if cutout_objid(f) not in journal]
+		morph.status_started(len(fitsfiles))
+		result = Parallel(n_jobs=args.n_jobs, verbose=morph.joblib_verbose())(
+					delayed(clean_and_measure)(args, f) for f in fitsfiles)
+
+	for row in result:
+		journal.append(row)
+	write_catalog(args, journal, result if args.timings else [])
+
+
+def open_journal(args):
+	# both modes journal their rows and compact the journal into the 
+	# catalog, so a rerun of either picks up where the last one stopped
+	return morph.ResultJournal(args.catalog_name+'.journal')
+
+
+def write_catalog(args, journal, timed):
+	journal.close()
+	morph.compact(journal.path, args.catalog_name, morph.column_dtype)
+	print "Catalog complete:", args.catalog_name
+	report = morph.finish_run(args, timed)
+	if report:
+		print report
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Clean and measure cutouts '
+									 'in parallel')
+	parser.add_argument('-d', dest="directory", type=str,
+		help='Directory of cutouts to clean and measure.')
+	parser.add_argument('--fields', type=str, default=None,
+		help='Catalog of objid, field, x, y, radius: cut stamps straight '
+			 'out of the fields instead of reading them from -d')
+	parser.add_argument('--fielddir', type=str, default='SDSSimages/',
+		help='Where the fields in --fields live')
+	parser.add_argument('--scale', type=float, default=4.,
+		help='Box half-size is scale*radius (e.g. 3 or 4 for 3Rp/4Rp)')
+	parser.add_argument('--tag', type=str, default='4Rp',
+		help='Suffix for virtual cutout names (f_<objid>_<tag>.fits)')
+	parser.add_argument('-c', dest="catalog_name", type=str,
+		help='Specify the desired name for output catalog.')
+	parser.add_argument('--outdir', type=str, default='output/',
+		help='Specify the desired name for output directory.')
+	parser.add_argument('--scratch', type=str, default=None,
+		help='Where worker scratch directories go (default: /dev/shm)')
+	parser.add_argument('--sep', type=float, default=4.,
+		help='Separation passed on to clean_frame')
+	parser.add_argument('-n', dest='n_jobs', type=int, default=30,
+		help='Number of workers')
+	parser.add_argument('--pipeline', action='store_true',
+		help='Run cleaning, measuring (and plotting) as separate stages '
+			 'with their own workers, overlapping each other')
+	parser.add_argument('--cleaners', type=int, default=8,
+		help='With --pipeline: workers cleaning')
+	parser.add_argument('--measurers', type=int, default=None,
+		help='With --pipeline: workers measuring (default: what the cores '
+			 'and memory allow)')
+	parser.add_argument('--plot', action='store_true',
+		help='With --pipeline: make the quality-control figures too')
+	parser.add_argument('--plotters', type=int, default=2,
+		help='With --pipeline --plot: workers plotting')
+	parser.add_argument('--report-every', dest='report_every', type=float,
+		default=60., help='With --pipeline: seconds between stage reports')
+	parser.add_argument('--supervise', action='store_true',
+		help='Quarantine cutouts that fail instead of stopping; they get '
+			 'NaN rows with a failcode')
+	parser.add_argument('--timeout', type=float, default=None,
+		help='With --supervise: seconds allowed per cutout')
+	parser.add_argument('--max-memory', dest='max_memory', type=float,
+		default=None, help='With --supervise: GB of memory allowed per cutout')
+	parser.add_argument('--quarantine', type=str, default=morph.QUARANTINE,
+		help='Where --supervise puts failed inputs and their failure records')
+	morph.add_run_options(parser)
+	args = parser.parse_args()
+
+	morph.start_run(args)
+
+	# There are a lot of useless warnings that pop up -- suppress them!
+	warnings.filterwarnings('ignore', message='Overwriting existing file .*',
+                            module='pyfits')
+
+	morph.checkdir(args.outdir+'datacube/')
+
+	if args.pipeline:
+		run_pipeline(args)
+	else:
+		run_joblib(args)
+
+
+if __name__ == "__main__":
+	main()
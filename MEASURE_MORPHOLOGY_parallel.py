@@ -1,27 +1,16 @@
-import re, glob, os, string, pdb, sys
+import re, glob, os, string, pdb
 import argparse, warnings
 
-import astropy.visualization as vis #import ZScaleInterval
 from astropy.table import Table
 import astropy.io.fits as fits
 
-import pandas as pd
 import numpy as np
 
+# nothing in here plots: importing matplotlib (or pandas) would only slow
+# down every worker's start-up
 import morph
 
-from joblib import Parallel, delayed
-
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
-import matplotlib as mpl
-mpl.rcParams.update({
-	'font.size': 24,
-	'font.family': 'STIXGeneral',
-	'mathtext.fontset':'stix',
-	'xtick.bottom': False,
-	'ytick.left': False})
-
+log = morph.get_logger('MEASURE_MORPHOLOGY_parallel')
 
 
 def get_clean(hdulist):
@@ -31,17 +20,105 @@ def get_clean(hdulist):
 		return hdulist['CLN'].data
 
 
-def do_the_things(args, filename, k):
+def do_the_things(args, filename):
 	#Open their cleaned FITS iamges
-	hdulist = fits.open(filename)
+	with morph.stage('io'):
+		hdulist = fits.open(filename)
 
 	flags = np.zeros(4)	
 	g = morph.GalaxyMorphology(hdulist, filename, flags, args.outdir)
+	with morph.stage('io'):
+		# closing a compressed cube runs the garbage collector: not free
+		hdulist.close()
+
+	return g.table()
+
+
+def measure_entry(args, objid):
+	# same as do_the_things but straight out of a packed stamp store
+	entry = morph.open_store(args.store)[objid]
+
+	g = morph.GalaxyMorphology(entry, entry.filename, entry.flags, args.outdir)
+
+	return g.table()
+
+
+def measure_row(args, work, item):
+	# in supervised mode a galaxy that fails, hangs or eats all the memory
+	# gets quarantined and comes back as a NaN row with a failcode
+	with morph.measuring(item) as probe:
+		if not args.supervise:
+			row = work(args, item)
+		else:
+			max_memory = args.max_memory*1e9 if args.max_memory else None
+			row = morph.supervised(work, (args,), item, args.timeout, 
+								   max_memory, args.quarantine)
+	if args.timings:
+		morph.add_timings(row, probe.columns())
+	return row
+
+
+def measure_into(args, work, job):
+	# runs in the worker: measure the galaxy and put its row straight into
+	# the shared result table -- only the row number goes back to the parent
+	idx, item = job
+	row = measure_row(args, work, item)
+	with morph.stage('write', objid=int(morph.item_objid(item))):
+		morph.open_table(args.table).write(idx, row)
+	return idx
+
+
+def distributed(args, work, key, cost, manifest, n_jobs, catalog):
+	# one of several nodes sharing the manifest through a coordinator 
+	# directory: claim a shard, measure it, hand it in, repeat. Every node
+	# writes the merged catalog once there's no work left (atomically, so
+	# the last one to get there wins).
+	coord = morph.LeaseCoordinator(args.coordinator, args.node, 
+								   args.lease_seconds)
+	# how many galaxies this node will end up doing isn't known
+	morph.status_started()
+	if coord.create(manifest(), args.shard_size):
+		print "Created", args.coordinator
+	print "Node", coord.node, "--", coord.progress()
+
+	# one pool for every shard this node takes: starting the workers (and
+	# their imports) per shard would cost more than a small shard does
+	pool = morph.WorkerPool(n_jobs)
+	try:
+		for lease in coord.leases():
+			done = lease.done_objids()
+			items = [key(i) for i in lease.items 
+					 if morph.item_objid(key(i)) not in done]
+			items = sorted(items, key=cost, reverse=True)
+			print "Shard", lease.shard, "--", len(items), "galaxies to measure"
+
+			try:
+				with lease.journal() as journal:
+					for item, row in morph.stream(measure_row, items, 
+												  (args, work), n_jobs, 
+												  args.inflight, pool):
+						if row is not None:
+							with morph.stage('write', 
+											 objid=int(row['objid'])):
+								journal.append(row)
+			except:
+				lease.release()
+				raise
+			if not lease.complete():
+				print "Lost the lease on shard", lease.shard, \
+					  "-- another node will redo it"
+		pool.finish()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
 
-	dd = g.table(init=True)
-	dfmini = pd.DataFrame(g.__dict__, index=[k])
-
-	return dfmini
+	merged = coord.merge(catalog, morph.column_dtype)
+	print "Morphological parameter catalog complete:", catalog
+	report = morph.finish_run(args, merged)
+	if report:
+		print report
 
 
 def main():  
@@ -54,8 +131,45 @@ def main():
         help='Specify the desired name for output directory.')
 	parser.add_argument('--hard', dest='hardest', default=False, 
 		help='run the "hardest" galaxies')
+	parser.add_argument('--store', type=str, default=None,
+		help='measure everything in this stamp store instead of the chunks')
+	parser.add_argument('--chunks', type=str,
+		default='output_4Rp/chunk*/datacube/f*4Rp.fits',
+		help='Glob of datacubes to measure (all chunks by default)')
+	parser.add_argument('--manifest', type=str, default=None,
+		help='File listing the datacubes to measure, one per line')
+	parser.add_argument('-n', dest='n_jobs', type=int, default=None,
+		help='Number of workers (default: whatever the cores and memory allow)')
+	parser.add_argument('--inflight', type=int, default=None,
+		help='Max galaxies queued for the workers at once (default: 2 per worker)')
+	parser.add_argument('--table', type=str, default=None,
+		help='Directory of the shared result table (default: next to the '
+			 'catalog); rerunning with the same table resumes')
+	parser.add_argument('--coordinator', type=str, default=None,
+		help='Shared directory to split the work with other nodes through '
+			 '(created from the manifest by whichever node gets there first)')
+	parser.add_argument('--node', type=str, default=None,
+		help='Name of this node for --coordinator (default: host.pid)')
+	parser.add_argument('--shard-size', dest='shard_size', type=int,
+		default=100, help='Galaxies per lease with --coordinator')
+	parser.add_argument('--lease-seconds', dest='lease_seconds', type=float,
+		default=600., help='A lease nobody has heartbeated for this long is '
+						   'given to another node')
+	parser.add_argument('--supervise', action='store_true',
+		help='Quarantine galaxies that fail instead of leaving them for the '
+			 'next run; they get NaN rows with a failcode')
+	parser.add_argument('--timeout', type=float, default=None,
+		help='With --supervise: seconds allowed per galaxy')
+	parser.add_argument('--max-memory', dest='max_memory', type=float,
+		default=None, help='With --supervise: GB of memory allowed per galaxy')
+	parser.add_argument('--quarantine', type=str, default=morph.QUARANTINE,
+		help='Where --supervise puts failed inputs and their failure records')
+	morph.add_run_options(parser)
 	args = parser.parse_args()
 
+	# nodes sharing a coordinator can share the trace and status
+	# directories too
+	morph.start_run(args, fresh=not args.coordinator)
 
 	# There are a lot of useless warnings that pop up -- suppress them!
 	warnings.filterwarnings('ignore', message='Overwriting existing file .*',
@@ -63,21 +177,78 @@ def main():
 
 	outdir = "/data/extragal/beck/gzcodez/SDSSmorphology_catalogs/110817"
 
-
-	for chunk in range(26,30):
-		#fitsfiles = "output_4Rp/chunk1/datacube/f_587725550679031929_4Rp.fits"
-		#do_the_things(args, fitsfiles, 0)
-
-		fitsfiles = glob.glob("output_4Rp/chunk{}/datacube/f*4Rp.fits".format(chunk))		
-
-		result = Parallel(n_jobs=30, verbose=51)(delayed(do_the_things)(args,f, k) for k, f in enumerate(fitsfiles))
-
-		#pdb.set_trace()
-
-		df = pd.concat(result)
-		df.to_csv("{}/SDSSmorphology_catalog_chunk{}.csv".format(outdir, chunk))
-
-	pdb.set_trace()
+	catalog = args.catalog_name or \
+			  "{}/SDSSmorphology_catalog.csv".format(outdir)
+	table = args.table or os.path.splitext(catalog)[0]+'_rows/'
+
+	# Everything goes through one pool of workers, biggest stamps first, and 
+	# each worker writes its galaxy's row into a memory-mapped table laid 
+	# out by the parent -- no DataFrames pickled back, nothing to concat
+	if args.store:
+		store = morph.open_store(args.store)
+		work = measure_entry
+		key = int
+		cost = lambda objid: np.prod(store[objid].shape)
+	else:
+		work = do_the_things
+		key = str
+		cost = morph.stamp_cost
+
+	if args.store:
+		manifest = lambda: [e.objid for e in store]
+	elif args.manifest:
+		manifest = lambda: [l.strip() for l in open(args.manifest) 
+							if l.strip()]
+	else:
+		manifest = lambda: glob.glob(args.chunks)
+
+	n_jobs = args.n_jobs or morph.auto_workers()
+
+	if args.coordinator:
+		distributed(args, work, key, cost, manifest, n_jobs, catalog)
+		return
+
+	# the columns are declared, not guessed from whichever galaxy comes
+	# first: a row with anything else in it is an error
+	columns = morph.catalog_columns(args.timings, args.supervise)
+	if os.path.isfile(os.path.join(table, 'table.json')):
+		# picking up a run that was cut short: the table knows what it
+		# was measuring and which rows are done -- as long as this run
+		# writes the same columns (--timings, --supervise)
+		try:
+			results = morph.ResultTable(table, columns=columns)
+		except ValueError as e:
+			parser.error(str(e))
+		items = [key(i) for i in results.items()]
+		print "Resuming", table, "--", len(results.todo()), "of", \
+			  len(results), "left"
+	else:
+		results = morph.ResultTable(table, manifest(), columns)
+		items = [key(i) for i in results.items()]
+
+	args.table = table
+	jobs = sorted([(idx, items[idx]) for idx in results.todo()],
+				  key=lambda job: cost(job[1]), reverse=True)
+
+	print "Measuring", len(jobs), "galaxies on", n_jobs, "workers"
+	morph.status_started(len(jobs))
+
+	counter = 0
+	for job, idx in morph.stream(measure_into, jobs, (args, work), n_jobs, 
+								 args.inflight):
+		if idx is None:
+			continue
+		counter += 1
+		if counter % 100 == 0:
+			log.info("%i galaxies measured", counter)
+
+	results.flush()
+	results.export(catalog)
+	print "Morphological parameter catalog complete:", catalog, \
+		  "(%i of %i galaxies)"%(results.done().sum(), len(results))
+	report = morph.finish_run(args, results.rows[results.done()])
+	if report:
+		print report
 
 
 
@@ -0,0 +1,192 @@
+import os, time, json, socket, shutil, tempfile, subprocess, platform
+import argparse, warnings
+
+import astropy.io.fits as fits
+import numpy as np
+
+import morph
+from morph import synthetic
+
+
+# what each stamp of a cell has around it: nothing, a companion galaxy, a
+# bright star, both (separations in re, fluxes relative to the galaxy)
+SCENES = [{'companions':[], 'stars':[]},
+		  {'companions':[(4., 0.5)], 'stars':[]},
+		  {'companions':[], 'stars':[(5., 2.)]},
+		  {'companions':[(3., 0.3)], 'stars':[(6., 1.)]}]
+
+
+def git_commit():
+	here = os.path.dirname(os.path.abspath(__file__))
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=here, stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def measure_stamp(args, stamp, workdir):
+	# time one synthetic galaxy from its datacube (or from the raw cutout
+	# through clean_frame with --clean) to its row; writing the stamp
+	# itself isn't timed
+	flags = np.zeros(4)
+	if args.clean:
+		cutout = synthetic.write_cutout(stamp, workdir+'raw/')
+		filename = workdir+'cubes/f_'+stamp.name+'.fits'
+	else:
+		filename = synthetic.write_datacube(stamp, workdir+'cubes/')
+
+	with morph.measuring(stamp) as probe:
+		if args.clean:
+			flags = morph.clean_frame(cutout, workdir+'cubes/')
+		with morph.stage('io'):
+			hdulist = fits.open(filename, memmap=True)
+		g = morph.GalaxyMorphology(hdulist, filename, flags, workdir+'out/')
+		with morph.stage('io'):
+			hdulist.close()
+	result = probe.columns()
+	for name in ['Rp', 'C', 'A', 'G', 'M20']:
+		measured = getattr(g, name, np.nan)
+		result['d'+name] = float(measured) - stamp.truth[name]
+	return result
+
+
+def summarize(cell, results):
+	# medians over a cell's stamps, by stage
+	totals = np.array([r['t_total'] for r in results])
+	cell['galaxies'] = len(results)
+	cell['t_total'] = float(np.median(totals))
+	cell['rate'] = len(results)/float(totals.sum())
+	cell['stages'] = dict((name, float(np.median([r['t_'+name]
+						  for r in results])))
+						  for name in morph.STAGES
+						  if any(r['t_'+name] for r in results))
+	cell['counts'] = dict((name, float(np.median([r['n_'+name]
+						  for r in results])))
+						  for name in morph.COUNTERS
+						  if any(r['n_'+name] for r in results))
+	# how far the measurements are off from what the profile says
+	rp = np.array([r['dRp'] for r in results])/cell['Rp']
+	cell['Rp_error'] = float(np.nanmedian(np.abs(rp))) \
+					   if np.isfinite(rp).any() else None
+	for name in ['C', 'A', 'G', 'M20']:
+		d = np.array([r['d'+name] for r in results])
+		cell[name+'_error'] = float(np.nanmedian(np.abs(d))) \
+							  if np.isfinite(d).any() else None
+	return cell
+
+
+def compare(entry, history):
+	# the last run with the same grid, cell by cell
+	same = [e for e in history if e['config'] == entry['config']]
+	if not same:
+		print "No earlier run with this configuration to compare with"
+		return
+	before = same[-1]
+	print "Compared with %s (%s, commit %s):"%(before['time'], before['host'],
+											   before['commit'])
+	cells = dict((c['cell'], c) for c in before['cells'])
+	for cell in entry['cells']:
+		if cell['cell'] in cells:
+			old = cells[cell['cell']]['t_total']
+			print "  %-22s %8.3fs -> %8.3fs  (x%.2f)"%(cell['cell'], old,
+				cell['t_total'], old/cell['t_total'])
+	print "  %-22s %6.2f/s -> %6.2f/s"%('galaxies per second',
+		before['rate'], entry['rate'])
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Time the measurement of '
+		'synthetic galaxies (morph/synthetic.py) and keep a history of it')
+	parser.add_argument('--history', type=str, default='benchmarks.json',
+		help='JSON file the results are appended to')
+	parser.add_argument('--scales', type=float, nargs='+', default=[3, 4],
+		help='Stamp sizes, in Petrosian radii from the galaxy')
+	parser.add_argument('--sizes', type=float, nargs='+', default=[3, 6, 12],
+		help='Half-light radii of the galaxies (pixels)')
+	parser.add_argument('--sersic', type=float, nargs='+', default=[1, 4],
+		help='Sersic indices of the galaxies')
+	parser.add_argument('--repeat', type=int, default=4,
+		help='Stamps per cell (each with the next scene and seed)')
+	parser.add_argument('--seed', type=int, default=0,
+		help='Seed of the first stamp')
+	parser.add_argument('--clean', action='store_true',
+		help='Start from raw cutouts and run clean_frame too (needs '
+			 'SExtractor and se_params_SDSS.cfg in the current directory)')
+	parser.add_argument('--workdir', type=str, default=None,
+		help='Where the stamps go (default: a temporary directory that is '
+			 'removed afterwards)')
+	parser.add_argument('--note', type=str, default='',
+		help='Saved with the results, e.g. what changed')
+	parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+		help="Don't add the results to the history")
+	args = parser.parse_args()
+
+	warnings.filterwarnings('ignore')
+
+	# GalaxyMorphology writes next to the first few directories of the
+	# file name, so the stamps need an absolute path
+	workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(
+		prefix='morph_benchmark_'))+'/'
+	for sub in ['cubes/', 'raw/', 'out/']:
+		morph.checkdir(workdir+sub)
+
+	config = {'scales':args.scales, 'sizes':args.sizes, 'sersic':args.sersic,
+			  'repeat':args.repeat, 'seed':args.seed, 'clean':args.clean,
+			  'scenes':SCENES}
+	# as it will read back from the history (tuples become lists)
+	config = json.loads(json.dumps(config))
+	cells, rows = [], []
+	index = 0
+	try:
+		for scale in args.scales:
+			for re in args.sizes:
+				for n in args.sersic:
+					results = []
+					for k in range(args.repeat):
+						scene = SCENES[k%len(SCENES)]
+						stamp = synthetic.make_stamp(n=n, re=re, scale=scale,
+							seed=args.seed+index, index=index, **scene)
+						index += 1
+						results.append(measure_stamp(args, stamp, workdir))
+					cell = summarize({'cell':'%gRp re=%g n=%g'%(scale, re, n),
+									  'scale':scale, 're':re, 'n':n,
+									  'Rp':stamp.truth['Rp'],
+									  'pixels':stamp.image.size}, results)
+					print "%-22s %6i px  %7.3fs  Rp off by %s"%(cell['cell'],
+						cell['pixels'], cell['t_total'],
+						'%.1f%%'%(100*cell['Rp_error'])
+						if cell['Rp_error'] is not None else 'n/a')
+					cells.append(cell)
+					rows.extend(dict(r, name=stamp.name) for r in results)
+	finally:
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	totals = np.array([r['t_total'] for r in rows])
+	entry = {'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+			 'host':socket.gethostname(), 'commit':git_commit(),
+			 'python':platform.python_version(), 'numpy':np.__version__,
+			 'note':args.note, 'config':config, 'cells':cells,
+			 'galaxies':len(rows), 'seconds':float(totals.sum()),
+			 'rate':len(rows)/float(totals.sum())}
+
+	print
+	print morph.timing_report(rows, top=0)
+	print
+	history = []
+	if os.path.isfile(args.history):
+		history = json.load(open(args.history))
+	compare(entry, history)
+
+	if not args.dry_run:
+		history.append(entry)
+		tmp = args.history+'.tmp'
+		with open(tmp, 'w') as F:
+			json.dump(history, F, indent=1, sort_keys=True)
+		os.rename(tmp, args.history)
+		print "Added to", args.history
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,64 @@
+import glob, argparse, warnings
+
+from astropy.table import Table
+
+import morph
+
+log = morph.get_logger('contact_sheets')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Contact sheets of many '
+		'galaxies per image for visual QC')
+	parser.add_argument('prefix', type=str,
+		help='Sheets are written as <prefix>_000.png (+ .csv), ...')
+	parser.add_argument('-c', dest='catalog_name', type=str, default=None,
+		help='Morphology catalog to select galaxies from (and take the '
+			 'overlays from)')
+	parser.add_argument('--where', type=str, default=None,
+		help="numpy expression over catalog columns, e.g. 'oflag==1' or "
+			 "'(failcode>0) | (Rpflag==1)'")
+	parser.add_argument('--subset', type=str, default=None,
+		help='Table (objid or dr7objid column) or list of objids to keep, '
+			 'e.g. what dimreduce.cut_out_mixedup_region wrote')
+	parser.add_argument('--files', type=str, default=None,
+		help="Glob of stamps to show instead of catalog rows, e.g. "
+			 "'bad_cutouts/*.fits'")
+	parser.add_argument('--store', type=str, default=None,
+		help='Read stamps out of this stamp store where it has them')
+	parser.add_argument('--per-sheet', dest='per_sheet', type=int,
+		default=morph.contactsheet.PER_SHEET, help='Galaxies per sheet')
+	parser.add_argument('--columns', type=int,
+		default=morph.contactsheet.COLUMNS, help='Tiles across a sheet')
+	parser.add_argument('--tile', type=int,
+		default=morph.contactsheet.TILE_PIXELS, help='Tile size in pixels')
+	parser.add_argument('-n', dest='n_jobs', type=int, default=None,
+		help='Workers making tiles (default: one per core)')
+	args = parser.parse_args()
+
+	warnings.filterwarnings('ignore')
+
+	catalog = Table.read(args.catalog_name) if args.catalog_name else None
+	subset = morph.read_objids(args.subset) if args.subset else None
+
+	if args.files:
+		items = morph.file_items(sorted(glob.glob(args.files)), catalog)
+		if subset is not None:
+			items = [i for i in items if i['objid'] in subset]
+	elif catalog is not None:
+		items = morph.sheet_items(catalog, args.where, subset)
+	else:
+		parser.error('Need a catalog (-c) or some --files')
+
+	if not items:
+		log.warning("Nothing selected")
+		return
+	log.info("%i galaxies selected", len(items))
+
+	sheets = morph.make_sheets(items, args.prefix, args.store, args.n_jobs,
+							   args.per_sheet, args.columns, args.tile)
+	log.info("Wrote %i contact sheets", len(sheets))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,52 @@
+import glob, os, argparse, warnings
+
+import morph
+
+from joblib import Parallel, delayed
+
+
+def convert(f, args):
+	outname = None
+	if not args.in_place:
+		# keep the output_*/chunk*/datacube/ layout under the new root
+		outname = os.path.join(args.outdir, f)
+		morph.checkdir(outname)
+	return morph.convert_datacube(f, outname, quantize_level=args.quantize)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Convert version 1 '
+		'datacubes into the compressed version 2 format')
+	parser.add_argument('pattern', type=str, nargs='?',
+		default='output_*/chunk*/datacube/f_*Rp.fits',
+		help='Glob of datacubes to convert')
+	parser.add_argument('--quantize', type=float,
+		default=morph.QUANTIZE_LEVEL,
+		help='Quantization level for float images: lossy, e.g. 16 as fpack '
+			 'does (default: 0, lossless)')
+	parser.add_argument('--outdir', type=str, default='datacubes_v2/',
+		help='Directory the converted cubes are written under, keeping '
+			 'their paths')
+	parser.add_argument('--in-place', dest='in_place', action='store_true',
+		help='Replace the original cubes instead (there is no going back)')
+	parser.add_argument('-n', dest='n_jobs', type=int, default=1,
+		help='Number of workers')
+	args = parser.parse_args()
+
+	warnings.filterwarnings('ignore', message='Overwriting existing file .*')
+
+	fitsfiles = sorted(glob.glob(args.pattern))
+	print "Converting", len(fitsfiles), "datacubes"
+
+	sizes = Parallel(n_jobs=args.n_jobs, verbose=5)(
+				delayed(convert)(f, args) for f in fitsfiles)
+
+	before = sum([s[0] for s in sizes])
+	after = sum([s[1] for s in sizes])
+	if after:
+		print "%.1f MB -> %.1f MB (%.1fx smaller)"%(before/1e6, after/1e6,
+													 float(before)/after)
+
+
+if __name__ == "__main__":
+	main()
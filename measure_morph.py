@@ -7,6 +7,42 @@ import numpy as np
 
 import morph
 
+log = morph.get_logger('measure_morph')
+
+
+def measure(args, flags, plots, hdulist, filename):
+    # hdulist is what the Prefetcher read out of the datacube, or None to
+    # open it here; plots is a RenderQueue to hand the figures to, or None
+    # to draw them here
+    log.info("Running %s", os.path.basename(filename))
+    opened = hdulist is None
+    if opened:
+        with morph.stage('io'):
+            hdulist = fits.open(filename, memmap=True)
+
+    try:
+        # Measure galaxy morphologies
+        g = morph.GalaxyMorphology(hdulist, filename, flags, args.outdir)
+
+        # Plot galaxy figures for quality control
+        if args.plot_every and not np.isnan(g.Rp):
+            with morph.stage('plotting'):
+                if plots is not None:
+                    plots.submit(g, morph.plot_image(hdulist))
+                elif args.legacy_plots:
+                    morph.galaxyPlots.plot(g, hdulist)
+                else:
+                    payload = morph.PlotPayload(g, morph.plot_image(hdulist))
+                    for name, why in morph.reuse_figures(payload):
+                        log.warning("Couldn't draw %s: %s", name, why)
+    finally:
+        # Close any remaining FITS files
+        if opened:
+            with morph.stage('io'):
+                hdulist.close()
+
+    return g.table()
+
 
 ####################### main ############################
 
@@ -19,11 +55,36 @@ def main():
         help='Specify the desired name for output catalog.')
     parser.add_argument('--outdir', type=str, default='output/datacube/', 
         help='Specify the desired name for output directory.')
+    parser.add_argument('--prefetch', type=int, default=4,
+        help='Datacubes to read ahead in the background (0 to not)')
+    parser.add_argument('--prefetch-mb', dest='prefetch_mb', type=float,
+        default=512., help='Most pixel data (MB) to hold read ahead')
+    parser.add_argument('--plot-every', dest='plot_every', type=int,
+        default=1, help='Make figures for one galaxy in N (flagged ones '
+                        'always); 0 for none')
+    parser.add_argument('--plot-workers', dest='plot_workers', type=int,
+        default=2, help='Processes drawing figures while measuring goes on '
+                        '(0 to draw them inline)')
+    parser.add_argument('--legacy-plots', dest='legacy_plots',
+        action='store_true', help="Draw figures with galaxyPlots' own "
+                                  "functions instead of the figure-reuse "
+                                  "renderer")
+    parser.add_argument('--supervise', action='store_true',
+        help='Quarantine galaxies that fail instead of stopping; they get '
+             'NaN rows with a failcode')
+    parser.add_argument('--timeout', type=float, default=None,
+        help='With --supervise: seconds allowed per galaxy')
+    parser.add_argument('--max-memory', dest='max_memory', type=float,
+        default=None, help='With --supervise: GB of memory allowed per galaxy')
+    parser.add_argument('--quarantine', type=str, default=morph.QUARANTINE,
+        help='Where --supervise puts failed inputs and their failure records')
+    morph.add_run_options(parser)
     args = parser.parse_args()
 
+    morph.start_run(args)
 
     # Select all FITS files in the given directory
-    fitsfiles = np.array(sorted(glob.glob(args.directory+"/*")))
+    fitsfiles = np.array(sorted(glob.glob(args.directory+"/*.fits")))
 
     # There are a lot of useless warnings that pop up -- suppress them!
     warnings.filterwarnings('ignore', message='Overwriting existing file .*',
@@ -42,87 +103,93 @@ def main():
     #
     # Sometimes this shit crashes because I'm a terrible programmer.
     # In that case, I remove the offending FITS image, putting it in the 
-    # "bad_cutouts" directory and then start up the code again.
+    # "bad_cutouts" directory and then start up the code again -- or run
+    # with --supervise and that happens by itself (morph/supervise.py).
     #
-    # When the code is rerun, we don't want to start a new morph catalog - 
-    # we want to keep appending to the old one so we test for this...
-
-
-    # check to see if a current morphology catalog exists
-    # if so -- find where cursor should go by getting the length
-    try:
-        t = Table.read(args.catalog_name)
-        counter = len(t)
-        # this "cursor" tells us which FITS file we should start at because, 
-        # presumably, all previous images have already been processed.
-        fitsfiles = fitsfiles[counter::]
-    except:
-        counter = 0
-
-    #tt = Table(names=('category', 'oFlag', 'uFlag', 'bFlag'))
+    # When the code is rerun, we don't want to start a new morph catalog -
+    # we want to pick up where we left off. Every galaxy's row goes into an
+    # append-only journal next to the catalog (rewriting the whole catalog
+    # after each galaxy got slower with every galaxy); anything whose objid
+    # is already in the journal has been done. The catalog itself is
+    # written from the journal at the end.
+    journal = morph.ResultJournal(args.catalog_name+'.journal')
+    counter = len(journal)
+
+    # we don't clean here so there are no SExtractor flags to pass on
+    flags = np.zeros(4)
 
     # Now that we have our list of FITS to process...
+    todo = []
     for idx, f in enumerate(fitsfiles): 
         basename = os.path.basename(f)
 
+        # resume: skip anything that's already in the journal
+        objid = np.int64(os.path.splitext(basename)[0].split('_')[1])
+        if objid in journal:
+            continue
+
         # If we're cleaning the stamp, we tack an "f" in front of
         # the original filename
         filename = args.outdir+'f_'+basename
 
         # Otherwise, just pull up the regular filename
         filename = args.directory+basename
-
-        #if not os.path.isfile(filename):
-        #print "File not found! Running SExtractor before proceeding."
-        #print "Cleaning ", os.path.basename(f)
-        #flags = morph.clean_frame(f, args.outdir+'datacube/', sep=4, 
-        #                          survey='SDSS')
-
-        #tt.add_row((flags[0], flags[1], flags[2], flags[3]))
-
-        #"""
-        # check to see if SExtractor failed
-        #if np.any(np.array(flags)-9 < 0):
-        if True:
-
-            print "Running", os.path.basename(f)
-            hdulist = fits.open(filename, memmap=True)
-
-            print hdulist
-            # Measure galaxy morphologies
-            g = morph.GalaxyMorphology(hdulist, filename, flags, args.outdir)
-
-            # Plot galaxy figures for quality control
-            if not np.isnan(g.Rp):
-                morph.galaxyPlots(g, hdulist)
-
-
-            # If this is the first galaxy; create a Table
-            if (idx == 0) and (counter == 0):
-                t, gal_dict = g.table(init=True)
-                t.add_row(gal_dict)
-            # Otherwise, append galaxy morphologies to existing Table
+        todo.append(filename)
+
+    # figures are drawn by their own processes (started before any of our
+    # threads) so measuring never waits for matplotlib
+    plots = None
+    if args.plot_every and args.plot_workers > 0:
+        render = morph.render_payload if args.legacy_plots \
+                 else morph.reuse_figures
+        plots = morph.RenderQueue(args.plot_workers, args.plot_every, render)
+
+    # the status thread (and the reader's) only once they've forked
+    morph.status_started(len(todo))
+
+    # the next few datacubes are read in the background while this one
+    # is measured
+    if args.prefetch > 0:
+        reader = morph.Prefetcher(todo, args.prefetch, args.prefetch_mb*2**20)
+    else:
+        reader = ((f, None) for f in todo)
+
+    timed, waited = [], 0.
+    for filename, hdulist in reader:
+        with morph.measuring(filename) as probe:
+            if args.supervise:
+                max_memory = args.max_memory*1e9 if args.max_memory else None
+                row = morph.supervised(measure, (args, flags, plots, hdulist),
+                                       filename, args.timeout, max_memory,
+                                       args.quarantine)
             else:
-                t.add_row(g.table())
-            
-            # Close any remaining FITS files
-            hdulist.close()
-            
-            # Write the file after each galaxy (costly but don't want to lose
-            # data when my shit crashes, which it inevitably does
-            t.write(args.catalog_name, overwrite=True)
-            print counter+1," galaxies measured!"
-            counter+=1
-            del g
-        else:
-            print "SExtractor failed on "+basename
-            #if (idx == 0) and (counter == 0):
-            #t, gal_dict = g.table(init=True)
-            #t.add_row(gal_dict)
-        #"""
-
-    t.write(args.directory+'/test.fits')
-    print "Morphological parameter catalog complete.\n"
+                row = measure(args, flags, plots, hdulist, filename)
+
+        if args.timings:
+            morph.add_timings(row, probe.columns())
+            if args.prefetch > 0:
+                # what this galaxy kept us waiting on the reader
+                wait, waited = reader.waited - waited, reader.waited
+                morph.add_timings(row, {'t_io':wait, 't_total':wait})
+            timed.append(row)
+
+        with morph.stage('write', objid=int(row['objid'])):
+            journal.append(row)
+        log.info("%i galaxies measured!", counter+1)
+        counter+=1
+
+    if args.prefetch > 0:
+        log.info("Waited %.1fs on reading datacubes", reader.waited)
+    if plots is not None:
+        plots.close()
+        log.info(plots.report())
+
+    journal.close()
+    morph.compact(journal.path, args.catalog_name, morph.column_dtype)
+    report = morph.finish_run(args, timed)
+    if report:
+        log.info(report)
+    log.info("Morphological parameter catalog complete.")
     exit()  
 
 
@@ -1,6 +1,29 @@
+import lazy as _lazy
+# plotting, extraction, synthetic stamps and the parity checks are
+# imported the first time they're asked for -- the submodule itself, or
+# one of the names in its __all__
+_package = _lazy.install(__name__, ['galaxyPlots', 'figures', 'contactsheet',
+                                    'clean', 'run_sextractor', 'synthetic',
+                                    'parity'])
+
+from logs import *
+from instrument import *
+from status import *
+from driver import *
 from utils import *
-from clean import *
-from galaxyPlots import *
-from clean import * 
-from run_sextractor import *
-from galaxyMorphology import GalaxyMorphology
+from scratch import *
+from datacube import *
+from stampstore import *
+from cutouts import *
+from scheduler import *
+from journal import *
+from resulttable import *
+from supervise import *
+from leases import *
+from pipeline import *
+from prefetch import *
+from render import *
+from galaxyMorphology import GalaxyMorphology, column_dtype, \
+                             catalog_columns
+
+_package.finish()
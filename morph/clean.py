@@ -2,26 +2,68 @@
 
 import os, glob
 import string
+import time
+import zlib
+import Queue
 import numpy as  np
 import astropy.io.fits as fits
-from random import gauss
 import run_sextractor
+import datacube as datacubes
+from instrument import timed, mark
 from utils import find_closest
-import pdb
-import matplotlib.pyplot as plt
-
-def clean_pixels(data, mask, segmap):
-    #mean = np.mean(data[segmap == 0])
-    #std = np.std(data[segmap == 0])
-    med = np.median(data[segmap == 0])
-    rms = np.sqrt(np.mean(np.square(data[segmap==0])))
-    for pixel in zip(mask[0], mask[1]):
-        data[pixel] = gauss(med, rms)
+from logs import get_logger
+
+__all__ = ['clean_frame', 'clean_image', 'clean_pixels', 'clean_directory',
+           'closest_above_thresh', 'closest_dist', 'galaxy_rng',
+           'predicts_smooth', 'remove_files', 'savedata', 'stop_jobs']
+
+log = get_logger(__name__)
+
+# How long clean_frame waits on its BRIGHT/FAINT runs. The runner's own 
+# timeout and retries (run_sextractor.SE_TIMEOUT, SE_RETRIES) end a run 
+# well before this -- it only keeps a run that never reports back from 
+# hanging the worker
+SE_WAIT = 1800.
+
+def galaxy_rng(name, seed=0):
+    '''
+    Random number generator seeded from the galaxy's name so that cleaning 
+    the same cutout twice gives the exact same noise pixels
+    '''
+    return np.random.RandomState((zlib.crc32(name) + seed) & 0xffffffff)
+
+def clean_pixels(data, mask, segmap, rng=None, noise='gauss'):
+    '''
+    Replace the pixels in mask with background noise. 
+    noise='gauss' draws from a Gaussian with the median and rms of the 
+    background pixels (segmap == 0); noise='empirical' resamples the 
+    background pixels themselves. With no background pixels at all both 
+    fill the mask with NaN.
+    '''
+    if rng is None:
+        rng = np.random
+    bkg = data[segmap == 0]
+    npix = len(mask[0])
+    if npix == 0:
+        return data
+
+    if len(bkg) == 0:
+        # nothing to draw from: NaN, as random.gauss used to give (rng
+        # raises on an empty background instead)
+        data[mask] = np.nan
+    elif noise == 'empirical':
+        data[mask] = rng.choice(bkg, size=npix)
+    else:
+        #mean = np.mean(bkg)
+        #std = np.std(bkg)
+        med = np.median(bkg)
+        rms = np.sqrt(np.mean(np.square(bkg)))
+        data[mask] = rng.normal(med, rms, size=npix)
     return data
 
-def clean_image(image, SEseg, SEcat, idx, bkgseg):
+def clean_image(image, SEseg, SEcat, idx, bkgseg, rng=None, noise='gauss'):
     mask = np.where((SEseg != SEcat['NUMBER'][idx]) & (SEseg != 0)) 
-    image = clean_pixels(image, mask, bkgseg)
+    image = clean_pixels(image, mask, bkgseg, rng, noise)
     return image
 
 def closest_above_thresh(SEcat, thing, center, coords, threshold=50., k=10):
@@ -72,13 +114,71 @@ def savedata(mode, hdr, galnumber, data=[], names=[]):
 
     return datacube
 
+def closest_dist(catname, center):
+    '''
+    Distance from the center of the image to the closest object in a SE 
+    catalog. Empty catalogs get the distance to the edge of the image, same
+    as Bdist in clean_frame
+    '''
+    cat = fits.getdata(catname)
+    if len(cat) == 0:
+        return center[0]
+    index, dist = find_closest(center, zip(cat['X_IMAGE'], cat['Y_IMAGE']))
+    return dist
+
+def predicts_smooth(Bdist, Fdist, sep):
+    '''
+    Does it look like clean_frame will end up in category 6 (SMOOTH)?
+    Category 6 is nothing near the center in BRIGHT but something near the 
+    center in FAINT. None means that run hasn't finished yet -- if only 
+    BRIGHT is in, guess from BRIGHT alone.
+    '''
+    if (Bdist is None) or (Bdist <= sep):
+        return False
+    if Fdist is None:
+        return True
+    return (Fdist <= sep) & (Bdist - Fdist > sep)
+
+def stop_jobs(jobs):
+    '''
+    Kill any background SE runs that are still going and wait for them so 
+    nothing gets written into outdir after we return
+    '''
+    for job in jobs.values():
+        if job.is_alive():
+            job.cancel()
+        job.join()
+
+def wait_for(finished, deadline):
+    '''
+    Next section off finished, or None once deadline (a time.time()) has
+    passed. Polls, so a signal (a supervisor's time limit, ^C) still gets 
+    through while we wait
+    '''
+    while time.time() < deadline:
+        try:
+            return finished.get(True, min(1., max(deadline-time.time(), 0.)))
+        except Queue.Empty:
+            pass
+    return None
+
 def clean_directory(outdir):
     for desc in ['*bright*', '*faint*', '*smooth*']:
         files = glob.glob(outdir+desc+".fits")
         for f in files:
             os.remove(f)
 
-def clean_frame(image, outdir, sep=17., survey='SDSS'):
+def remove_files(files):
+    ''' Delete exactly these files (the ones that exist, anyway) '''
+    for f in files:
+        if os.path.isfile(f):
+            os.remove(f)
+
+@timed('cleaning')
+def clean_frame(image, outdir, sep=17., survey='SDSS', speculate=True,
+                noise='gauss', seed=0, keep_intermediates=False,
+                cube_version=datacubes.DCVERS, 
+                quantize_level=datacubes.QUANTIZE_LEVEL):
     '''
     This is a multi-stage cleaning process for each galaxy cutout.
 
@@ -89,6 +189,8 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
     image -- Name of galaxy cutout on which to perform cleaning. 
           Galaxy must be in the center of the image! 
           Image does not have to be square.
+          Can also be a VirtualCutout (cutouts.py), which is written into
+          outdir for SE and removed with the other intermediates.
 
     outdir -- Name of the directory to which SExtractor output should
           be directed. 
@@ -97,10 +199,31 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
           1. obj in BRIGHT and center of image
           2. obj in FAINT and center of image
           3. obj in FAINT and obj in BRIGHT
+
+    speculate -- Start the SMOOTH run as soon as the BRIGHT/FAINT runs 
+          suggest category 6 rather than after the cascade decides it.
+          The number of SE runs in flight per process is set with
+          run_sextractor.set_max_concurrent()
+
+    noise -- How contaminating pixels are replaced: 'gauss' (median/rms 
+          of the background) or 'empirical' (resampled background pixels)
+
+    seed -- Added to the per-galaxy seed; the noise is otherwise fixed by 
+          the cutout name so re-cleaning a galaxy reproduces its stamp
+
+    keep_intermediates -- Keep the SExtractor catalogs/segmaps, the images
+          SE was run on and a separate f_<name>_clnonly.fits in outdir. By
+          default all of these are deleted before returning.
+
+    cube_version, quantize_level -- Format of the datacube written (see 
+          datacube.py). Version 2 is compressed; the float images stay
+          lossless unless quantize_level > 0.
     ---------------------------------------------------------------
     OUTPUTS:
     ---------------------------------------------------------------
-    All kinds of SExtractor nonsense
+    outdir/f_<name>.fits -- datacube with CLN, ORG, the segmaps and CAT
+          (plus MID_CLN/F2SEG, SSEG or UCLN depending on the category). It 
+          is assembled in memory and written exactly once.
 
     ---------------------------------------------------------------
     RETURNS:
@@ -144,31 +267,90 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
         configfile = 'se_params_COSMOS.cfg'
 
 
+    # a virtual cutout only becomes a file because SE needs one
+    cutout = None
+    if hasattr(image, 'write'):
+        cutout = image
+        image = cutout.write(outdir)
+
     basename = os.path.basename(os.path.splitext(image)[0])
     outname = outdir+basename
+    rng = galaxy_rng(basename, seed)
     catnames = [outname+'_bright_cat.fits', outname+'_faint_cat.fits', 
                 outname+'_smooth_cat.fits']
     segnames = [outname+'_bright_seg.fits', outname+'_faint_seg.fits',
                 outname+'_smooth_seg.fits']
+    testname = outname+'_cln.fits'
+
+    # every file SE (or we) write along the way, so they can be removed 
+    # by name rather than by globbing outdir
+    intermediates = catnames + segnames + \
+                    [outname+'_mid_cln.fits', 
+                     outname+'_mid_cln_faint_run2_cat.fits',
+                     outname+'_mid_cln_faint_run2_seg.fits',
+                     testname, outname+'_cln_smooth_test_cat.fits',
+                     outname+'_cln_smooth_test_seg.fits']
+    if cutout is not None:
+        intermediates.append(image)
+    if keep_intermediates:
+        intermediates = []
+
+    # run SE in BRIGHT and FAINT modes at the same time -- they don't depend
+    # on each other. If the first results already point at category 6, get 
+    # the SMOOTH run going too instead of waiting for the cascade below
+    if cutout is not None:
+        img, ihdr = np.asarray(cutout.data), cutout.header
+    else:
+        img, ihdr = fits.getdata(image, header=True)
+    center = [img.shape[0]/2., img.shape[1]/2.]
 
-    # run SE in FAINT and BRIGHT modes
-    if not run_sextractor.run_SE(image, 'BRIGHT', cfg_filename=configfile, 
-                                 outdir=outdir):
-        return [9, 9, 9, 9]
-
-    run_sextractor.run_SE(image, 'FAINT', cfg_filename=configfile, 
-                          outdir=outdir)
-
-    # READ IN ORIG FITS-FILE and both Bright/Faint SEGMAPs
-    img, ihdr = fits.getdata(image, header=True)
+    finished = Queue.Queue()
+    jobs = {}
+    for section in ['BRIGHT', 'FAINT']:
+        jobs[section] = run_sextractor.start_SE(image, section, outdir=outdir,
+                                             cfg_filename=configfile, 
+                                             notify=finished)
+
+    dists = {}
+    deadline = time.time() + SE_WAIT
+    try:
+        for n in range(2):
+            section = wait_for(finished, deadline)
+            if section is None:
+                log.error("SE runs on %s didn't finish within %gs", 
+                          basename, SE_WAIT)
+                stop_jobs(jobs)
+                remove_files(intermediates)
+                return [9, 9, 9, 9]
+            if not jobs[section].result():
+                if section == 'BRIGHT':
+                    stop_jobs(jobs)
+                    remove_files(intermediates)
+                    return [9, 9, 9, 9]
+                continue
+            catname = catnames[0] if section == 'BRIGHT' else catnames[1]
+            dists[section] = closest_dist(catname, center)
+            if speculate and ('SMOOTH' not in jobs) and \
+               predicts_smooth(dists.get('BRIGHT'), dists.get('FAINT'), sep):
+                jobs['SMOOTH'] = run_sextractor.start_SE(image, 'SMOOTH', 
+                                                     cfg_filename=configfile,
+                                                     outdir=outdir)
+    except BaseException:
+        # interrupted (a time limit, ^C): don't leave SE writing into outdir
+        stop_jobs(jobs)
+        remove_files(intermediates)
+        raise
+
+    # READ IN both Bright/Faint SEGMAPs
     cln = img.copy()
     bseg, fseg = fits.getdata(segnames[0]), fits.getdata(segnames[1]) 
     bcat, fcat = fits.getdata(catnames[0]), fits.getdata(catnames[1])
 
-    center = [img.shape[0]/2., img.shape[1]/2.]
-
     # check to see if ANYTHING is found ANYWHERE
     if len(bcat) == 0 and len(fcat) == 0:
+        mark('category 9', mode='nothing detected')
+        stop_jobs(jobs)
+        remove_files(intermediates)
         return [9,9,9,9]
 
     brightdist, bFlag = 0., 0
@@ -200,7 +382,7 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
         # FLAG 1: MOST COMMON CATEGORY --> CLEAN IN FAINT MODE
         if (Bdist <= sep) & (Fdist <= sep):
             #cln = clean_image(cln, bseg, bcat, BIndex, fseg)
-            cln = clean_image(cln, fseg, fcat, FIndex, fseg)
+            cln = clean_image(cln, fseg, fcat, FIndex, fseg, rng, noise)
             category, mode = 1, 'FAINT'
 
         # FLAG 2: CLEAN IN BRIGHT MODE & FLAG THESE!!
@@ -214,7 +396,7 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
             data. Going to clean in Faint mode instead for SDSS
             '''
             #cln = clean_image(cln, bseg, bcat, BIndex, fseg)
-            cln = clean_image(cln, fseg, fcat, FIndex, fseg)
+            cln = clean_image(cln, fseg, fcat, FIndex, fseg, rng, noise)
             category, mode = 2, 'FAINT'
 
         # FLAG 3: CLEAN IN FAINT MODE
@@ -222,13 +404,13 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
             ''' There aren't many of these
             They're oddballs but most are well cleaned in FAINT
             '''
-            cln = clean_image(cln, fseg, fcat, FIndex, fseg)
+            cln = clean_image(cln, fseg, fcat, FIndex, fseg, rng, noise)
             category, mode = 3, 'FAINT'
 
         # FLAG 4: TWO STAGE CLEANING -- BRIGHT --> RUN SE AGAIN IN FAINT
         elif (Bdist > sep) & (Fdist > sep): 
 
-            cln = clean_image(cln, bseg, bcat, BIndex, fseg)
+            cln = clean_image(cln, bseg, bcat, BIndex, fseg, rng, noise)
 
             cln_sv = cln.copy()
             cln_sv = fits.ImageHDU(data=cln_sv, name='MID_CLN')
@@ -246,14 +428,14 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
             # find closest obj to center with area above threshold
             Fdist, FIndex, FCoord, Farea, aFlag = \
                         closest_above_thresh(f2cat, area, center, coords, k=5)
-            cln = clean_image(cln, f2seg, f2cat, FIndex, f2seg)
+            cln = clean_image(cln, f2seg, f2cat, FIndex, f2seg, rng, noise)
             category, mode = 4, 'FAINT2'
             
     else:
         # FLAG 5: TWO STAGE CLEANING - BRIGHT --> RUN SE AGAIN IN FAINT
         if (Bdist <= sep) & (Fdist > sep):
 
-            cln = clean_image(cln, bseg, bcat, BIndex, fseg)
+            cln = clean_image(cln, bseg, bcat, BIndex, fseg, rng, noise)
 
             #save this image so that I can run SE on it
             cln_sv = cln.copy()
@@ -272,7 +454,7 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
             # find closest obj to center with area above threshold
             Fdist, FIndex, FCoord, Farea, aFlag = \
                         closest_above_thresh(f2cat, area, center, coords, k=5)
-            cln = clean_image(cln, f2seg, f2cat, FIndex, f2seg)
+            cln = clean_image(cln, f2seg, f2cat, FIndex, f2seg, rng, noise)
             category, mode = 5, 'FAINT2'
  
         # FLAG 6: CLEAN IN SMOOTH MODE
@@ -280,12 +462,15 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
             ''' These are mostly faint objects not detected in BRIGHT
             run SE in SMOOTH mode and then clean
             '''
-            run_sextractor.run_SE(image, 'SMOOTH', cfg_filename=configfile, 
-                                  outdir=outdir)
+            if 'SMOOTH' not in jobs:
+                jobs['SMOOTH'] = run_sextractor.start_SE(image, 'SMOOTH', 
+                                                    cfg_filename=configfile,
+                                                    outdir=outdir)
+            jobs['SMOOTH'].result()
             sseg, scat = fits.getdata(segnames[2]), fits.getdata(catnames[2])
             SIndex, Sdist = find_closest(center, zip(scat[x], scat[y]))
 
-            cln = clean_image(cln, sseg, scat, SIndex, sseg)
+            cln = clean_image(cln, sseg, scat, SIndex, sseg, rng, noise)
             category, mode = 6, 'SMOOTH'
 
         # FLAG 7: CLEAN IN FAINT MODE -- ALL GARBAGE ANYWAY
@@ -294,15 +479,22 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
             any object in here needs to be flagged and is likely not a true
             galaxy at all!
             '''
-            cln = clean_image(cln, fseg, fcat, FIndex, fseg)
+            cln = clean_image(cln, fseg, fcat, FIndex, fseg, rng, noise)
             category, mode = 7, 'FAINT'
 
         # FLAG 8: 
         elif  (Bdist <= sep) & (Fdist <= sep):
-            pdb.set_trace()
-            cln = clean_image(cln, bseg, bcat, BIndex, fseg)
+            # used to stop here in the debugger -- it's rare enough that
+            # the category flag is all anyone needs to go back and look
+            cln = clean_image(cln, bseg, bcat, BIndex, fseg, rng, noise)
             category, mode = 8, 'BRIGHT'
 
+    mark('category %i'%category, mode=mode)
+
+    # drop the speculative SMOOTH run if we ended up not needing it
+    if mode != 'SMOOTH':
+        stop_jobs(jobs)
+
     # Save all major data products
     if mode == 'BRIGHT':
         datacube = savedata(mode, ihdr, BIndex, data=[bseg, fseg, bcat], 
@@ -323,24 +515,19 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
                             names=['BSEG', 'FSEG', 'SSEG', 'CAT'])
 
         
-    # SAVE ALL PRODUCTS TO DATA CUBE
+    # SAVE ALL PRODUCTS TO DATA CUBE -- kept in memory until the test 
+    # below is done so the cube only gets written once
     datacube.insert(0, fits.ImageHDU(data=cln, header=ihdr, name='CLN'))
     datacube.insert(1, fits.ImageHDU(data=img, header=ihdr, name='ORG'))
 
-    newthing = fits.HDUList()
-    for thing in datacube: 
-        newthing.append(thing)
-    newthing.update_extend()
-    newthing.writeto(outdir+'f_'+basename+'.fits', output_verify='silentfix', 
-                     clobber=True)
-
-
     # Now that we've done the cleaning -- Let's test it!    
-    run_sextractor.run_SE(outdir+'f_'+basename+'.fits', 'SMOOTH', 
-                          cfg_filename=configfile, outdir=outdir, 
-                          outstr2='test')
-    tseg = fits.getdata(outdir+'f_'+basename+'_smooth_test_seg.fits')
-    tcat = fits.getdata(outdir+'f_'+basename+'_smooth_test_cat.fits')
+    # (SE only looks at the cleaned image so that's all it gets)
+    fits.PrimaryHDU(data=cln, header=ihdr).writeto(testname, clobber=True,
+                                                   output_verify='silentfix')
+    run_sextractor.run_SE(testname, 'SMOOTH', cfg_filename=configfile, 
+                          outdir=outdir, outstr2='test')
+    tseg = fits.getdata(outname+'_cln_smooth_test_seg.fits')
+    tcat = fits.getdata(outname+'_cln_smooth_test_cat.fits')
 
     # If we find obj near the center is too small then we overcleaned it
     uFlag, oFlag = 0, 0
@@ -352,22 +539,26 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
 
         if (dist[0] < sep): 
             if (objarea < 50.): 
-                print 'OVERCLEANED!!!'
+                log.info('OVERCLEANED!!! %s', basename)
                 oFlag = 1
 
             # If we find large objs far from the center- didn't clean enough
             if np.any(areas > 200.):       
-                print 'UNDER CLEANED!!'
+                log.info('UNDER CLEANED!! %s', basename)
                 uFlag = 1
                 
-                cln = clean_image(cln, tseg, tcat, index[0], tseg)
-                data = fits.open(outdir+'f_'+basename+'.fits')
-                data.insert(0,fits.ImageHDU(data=cln, name='UCLN'))
-                data['UCLN'].header.set('SECATIDX', index[0], 'Index in SECAT')
-                data['CAT'].data = tcat
-                data['FSEG'].data = tseg
-                data.writeto(outdir+'f_'+basename+'.fits', clobber=True,
-                             output_verify='silentfix')
+                # CLN keeps the first pass; UCLN goes on top along with the
+                # test run's catalog and segmap
+                cln = clean_image(cln.copy(), tseg, tcat, index[0], tseg, 
+                                  rng, noise)
+                ucln = fits.ImageHDU(data=cln, name='UCLN')
+                ucln.header.set('SECATIDX', index[0], 'Index in SECAT')
+                for i, hdu in enumerate(datacube):
+                    if hdu.name == 'CAT':
+                        datacube[i] = fits.TableHDU(data=tcat, name='CAT')
+                    elif hdu.name == 'FSEG':
+                        datacube[i] = fits.ImageHDU(data=tseg, name='FSEG')
+                datacube.insert(0, ucln)
         else:
             oFlag = 1
     else:
@@ -375,15 +566,18 @@ def clean_frame(image, outdir, sep=17., survey='SDSS'):
         # either overcleaned or blended into nearby object
         oFlag = 1
 
-    # I want to save the cleaned image separate -- 9/5/15 
-    # get rid of this later, probably?
-    cleanedup = fits.ImageHDU(data=cln, header=ihdr, name='CLN%i'%category)
-    cleanedup.writeto(outdir+'f_'+basename+'_clnonly.fits', 
-                      output_verify='silentfix', clobber=True)
+    datacubes.write_datacube(datacube, outdir+'f_'+basename+'.fits', 
+                             version=cube_version, 
+                             quantize_level=quantize_level)
 
-    # clean up directory
-    clean_directory(outdir) # doesn't work?! Harrumph.
+    if keep_intermediates:
+        # I want to save the cleaned image separate -- 9/5/15 
+        cleanedup = fits.ImageHDU(data=cln, header=ihdr, name='CLN%i'%category)
+        cleanedup.writeto(outdir+'f_'+basename+'_clnonly.fits', 
+                          output_verify='silentfix', clobber=True)
 
+    # clean up directory
+    remove_files(intermediates)
 
     #FIndex, Fdist, Bdist, DIST, Farea, Barea,
     return  [category, oFlag, uFlag, bFlag]
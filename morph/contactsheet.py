@@ -0,0 +1,306 @@
+'''
+Contact sheets: hundreds of galaxies on one image for visual QC.
+
+Going through thousands of per-galaxy PNGs one at a time isn't reviewing,
+it's clicking. A contact sheet puts per_sheet galaxies (256 by default) in
+a grid on one PNG, each tile zoomed to +-2Rp around the galaxy with its
+1Rp aperture, asymmetry center and M20 contour drawn on top and its objid
+underneath, and writes a <sheet>.csv saying which galaxy is where.
+
+    items = sheet_items(catalog, where='oflag==1')
+    make_sheets(items, 'sheets/overcleaned', store='stamps/', workers=8)
+
+Tiles are cut, stretched and shrunk (and their contours traced) by a pool
+of workers, reading out of a stamp store when there is one -- in store
+order, so the chunks are read front to back -- and out of each galaxy's
+datacube otherwise (much slower: astropy runs the garbage collector every
+time it closes a compressed image, so pack big selections into a store
+first). Raw cutouts (e.g. bad_cutouts/) work too: items with
+just a filename get a tile of the whole stamp and no overlays. Each sheet
+is then drawn as a single figure.
+'''
+
+import os
+import csv
+import multiprocessing
+import numpy as np
+import astropy.io.fits as fits
+from astropy.table import Table
+from astropy.visualization import ZScaleInterval
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import EllipseCollection, LineCollection
+
+import datacube
+from stampstore import open_store
+from supervise import item_objid
+from figures import aperture_contours
+from logs import get_logger
+
+__all__ = ['file_items', 'sheet_items', 'read_objids', 'select', 'make_sheets',
+           'draw_sheet', 'make_tile']
+
+log = get_logger(__name__)
+
+PER_SHEET = 256
+COLUMNS = 16
+TILE_PIXELS = 96
+
+# what the overlays are drawn from (any that are missing or NaN just
+# aren't drawn)
+OVERLAY_COLUMNS = ['x', 'y', 'e', 'theta', 'Rp', 'Ax', 'Ay', 'xc', 'yc',
+                   'Mlevel1']
+
+
+def read_objids(filename):
+    '''
+    objids out of a table with an objid (or dr7objid) column -- e.g. the
+    subset dimreduce.cut_out_mixedup_region writes -- or a plain list
+    '''
+    try:
+        t = Table.read(filename)
+    except Exception:
+        return set(int(line.split()[0]) for line in open(filename)
+                   if line.strip() and not line.startswith('#'))
+    for name in ['objid', 'dr7objid', 'OBJID']:
+        if name in t.colnames:
+            return set(int(o) for o in t[name])
+    raise KeyError("No objid column in %s"%filename)
+
+def select(catalog, where=None, subset=None):
+    '''
+    Rows of catalog (a Table) where the numpy expression `where` holds
+    (e.g. 'oflag==1', '(failcode>0) | (Rpflag==1)') and, given subset (a
+    set of objids), whose objid is in it
+    '''
+    keep = np.ones(len(catalog), bool)
+    if where:
+        columns = dict((name, np.asarray(catalog[name]))
+                       for name in catalog.colnames)
+        keep &= np.asarray(eval(where, {'np':np}, columns), bool)
+    if subset is not None:
+        keep &= np.array([int(o) in subset for o in catalog['objid']], bool)
+    return catalog[keep]
+
+def sheet_items(catalog, where=None, subset=None):
+    ''' What make_sheets needs to know about each selected galaxy '''
+    items = []
+    for row in select(catalog, where, subset):
+        item = {'objid':int(row['objid'])}
+        if 'filename' in row.colnames:
+            item['filename'] = str(row['filename']).strip()
+        for name in OVERLAY_COLUMNS:
+            if name in row.colnames:
+                item[name] = float(row[name])
+        items.append(item)
+    return items
+
+def file_items(filenames, catalog=None):
+    '''
+    Items for a pile of files (raw cutouts, quarantined datacubes...),
+    with the catalog's overlay values for any that are in it
+    '''
+    rows = {}
+    if catalog is not None:
+        rows = dict((int(o), i) for i, o in enumerate(catalog['objid']))
+    items = []
+    for filename in filenames:
+        item = {'objid':int(item_objid(filename)), 'filename':filename}
+        if item['objid'] in rows:
+            row = catalog[rows[item['objid']]]
+            for name in OVERLAY_COLUMNS:
+                if name in catalog.colnames:
+                    item[name] = float(row[name])
+        items.append(item)
+    return items
+
+
+def _finite(item, *names):
+    return all(np.isfinite(item.get(name, np.nan)) for name in names)
+
+def load_image(item, store=None):
+    ''' The stamp of an item: out of the store, its datacube or raw file '''
+    if store is not None and item['objid'] in store:
+        return np.asarray(store[item['objid']].plane('IMAGE'), 'float')
+    hdulist = fits.open(item['filename'], memmap=True)
+    try:
+        try:
+            return np.array(datacube.get_image(hdulist)[0], 'float')
+        except KeyError:
+            # not a datacube: the first image in it
+            for hdu in hdulist:
+                if hdu.data is not None and hdu.data.ndim == 2:
+                    return np.array(hdu.data, 'float')
+            raise IOError("No image in %s"%item['filename'])
+    finally:
+        hdulist.close()
+
+def make_tile(item, size=TILE_PIXELS, store=None):
+    '''
+    One galaxy's tile: its stamp around the galaxy, stretched to 0..1 and
+    shrunk to size x size (flipped so north is up as in the QC figures),
+    plus its overlays in tile pixels. Returns a dict.
+    '''
+    tile = {'objid':item['objid']}
+    try:
+        image = load_image(item, store)
+    except Exception as error:
+        tile['pixels'] = np.full((size, size), np.nan, 'float32')
+        tile['error'] = repr(error)
+        return tile
+
+    # +-2Rp around the middle of the stamp, like the RpAper figure
+    ny, nx = image.shape
+    half = 2*item['Rp'] if _finite(item, 'Rp') else max(nx, ny)/2.
+    half = min(half, max(nx, ny)/2.)
+    cx, cy = nx/2., ny/2.
+    c0, r0 = int(np.floor(cx-half)), int(np.floor(cy-half))
+    width = int(np.ceil(2*half)) or 1
+    scale = size/float(width)
+
+    # nearest-neighbour resampling, anything off the stamp is blank
+    src = c0 + ((np.arange(size)+0.5)/scale - 0.5).round().astype(int)
+    rows = r0 + ((np.arange(size)+0.5)/scale - 0.5).round().astype(int)
+    ok_c = (src >= 0) & (src < nx)
+    ok_r = (rows >= 0) & (rows < ny)
+    pixels = np.full((size, size), np.nan)
+    crop = image[np.clip(rows, 0, ny-1)][:, np.clip(src, 0, nx-1)]
+    pixels[np.ix_(ok_r, ok_c)] = crop[np.ix_(ok_r, ok_c)]
+
+    good = np.isfinite(pixels)
+    if good.any():
+        pixels[good] = ZScaleInterval()(pixels[good])
+    tile['pixels'] = pixels[::-1].astype('float32')
+
+    def to_tile(x, y):
+        # stamp (col, row) -> tile (col, row) of the flipped tile
+        u = (x - c0 + 0.5)*scale - 0.5
+        v = (y - r0 + 0.5)*scale - 0.5
+        return u, size-1-v
+
+    if _finite(item, 'x', 'y', 'Rp', 'e', 'theta'):
+        u, v = to_tile(item['x'], item['y'])
+        tile['aperture'] = (u, v, 2*item['Rp']*scale,
+                            2*item['Rp']/item['e']*scale,
+                            -item['theta']*180./np.pi)
+    if _finite(item, 'Ax', 'Ay'):
+        tile['center'] = to_tile(item['Ax'], item['Ay'])
+    if _finite(item, 'xc', 'yc', 'Rp', 'e', 'theta', 'Mlevel1'):
+        contours = aperture_contours(image, item['xc'], item['yc'],
+                                     item['Rp'], item['Rp']/item['e'],
+                                     item['theta'], item['Mlevel1'])
+        tile['contours'] = [np.column_stack(to_tile(c[:,1], c[:,0]))
+                            for c in contours]
+    return tile
+
+
+def _tile_job(args):
+    # runs in a worker (open_store keeps one store per process)
+    item, size, storepath = args
+    store = open_store(storepath) if storepath else None
+    return make_tile(item, size, store)
+
+
+def draw_sheet(tiles, filename, columns=COLUMNS, size=TILE_PIXELS,
+               labels=True):
+    ''' Draw tiles (in reading order) as one sheet and save it '''
+    nrows = int(np.ceil(len(tiles)/float(columns)))
+    label = 12 if labels else 0
+    height, width = nrows*(size+label), columns*size
+    mosaic = np.full((height, width), np.nan, 'float32')
+
+    apertures, centers, lines, texts = [], [], [], []
+    for n, tile in enumerate(tiles):
+        i, j = divmod(n, columns)
+        x0, y0 = j*size, i*(size+label)
+        mosaic[y0:y0+size, x0:x0+size] = tile['pixels']
+        if 'aperture' in tile:
+            u, v, w, h, angle = tile['aperture']
+            apertures.append((x0+u, y0+v, w, h, angle))
+        if 'center' in tile:
+            centers.append((x0+tile['center'][0], y0+tile['center'][1]))
+        for c in tile.get('contours', []):
+            lines.append(c + [x0, y0])
+        if labels:
+            texts.append((x0+2, y0+size+label-2, str(tile['objid']),
+                          'error' in tile))
+
+    dpi = 100.
+    fig = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.imshow(mosaic, cmap='Greys_r', origin='upper', vmin=0, vmax=1,
+              interpolation='nearest', extent=(-0.5, width-0.5,
+                                               height-0.5, -0.5))
+    if apertures:
+        a = np.array(apertures)
+        ax.add_collection(EllipseCollection(
+            a[:,2], a[:,3], a[:,4], units='xy', offsets=a[:,:2],
+            transOffset=ax.transData, facecolors='none',
+            edgecolors='deepskyblue', linewidths=0.7))
+    if lines:
+        ax.add_collection(LineCollection(lines, colors='yellow',
+                                         linewidths=0.7))
+    if centers:
+        c = np.array(centers)
+        ax.plot(c[:,0], c[:,1], 'r+', ms=5, mew=0.7)
+    for x, y, text, failed in texts:
+        ax.text(x, y, text, fontsize=6, color='red' if failed else 'black',
+                family='monospace')
+    ax.set_xlim(-0.5, width-0.5)
+    ax.set_ylim(height-0.5, -0.5)
+    fig.patch.set_facecolor('white')
+    canvas.print_png(filename)
+
+def make_sheets(items, prefix, store=None, workers=None, per_sheet=PER_SHEET,
+                columns=COLUMNS, size=TILE_PIXELS):
+    '''
+    Contact sheets <prefix>_000.png, _001.png... of per_sheet items each,
+    every one with a <prefix>_000.csv of objid, row, column (and the error
+    for tiles that couldn't be read). Returns the sheet file names.
+    '''
+    outdir = os.path.dirname(prefix)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # read the store front to back, whatever order the sheets are in
+    order = range(len(items))
+    if store is not None:
+        where = {}
+        s = open_store(store)
+        for n, item in enumerate(items):
+            if item['objid'] in s:
+                row = s.index[s.lookup()[item['objid']]]
+                where[n] = (int(row['chunk']), int(row['offset']))
+        order.sort(key=lambda n: where.get(n, (np.inf, 0)))
+
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    sheets = []
+    try:
+        for start in range(0, len(items), per_sheet):
+            batch = [n for n in order if start <= n < start+per_sheet]
+            tiles = pool.map(_tile_job, [(items[n], size, store)
+                                         for n in batch],
+                             chunksize=max(1, len(batch)/(4*workers)))
+            tiles = [t for n, t in sorted(zip(batch, tiles))]
+
+            name = '%s_%03i'%(prefix, start/per_sheet)
+            draw_sheet(tiles, name+'.png', columns, size)
+            with open(name+'.csv', 'w') as F:
+                w = csv.writer(F)
+                w.writerow(['objid', 'row', 'column', 'error'])
+                for n, tile in enumerate(tiles):
+                    w.writerow([tile['objid'], n/columns, n%columns,
+                                tile.get('error', '')])
+            sheets.append(name+'.png')
+            log.info("Wrote %s.png (%i galaxies)", name, len(tiles))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return sheets
@@ -0,0 +1,126 @@
+'''
+Virtual cutouts: postage stamps served straight out of the SDSS fields.
+
+SDSScutouts_3Rp/ and SDSScutouts_4Rp/ are just copies of pixels that are
+already sitting in SDSSimages/. Here each field is memory-mapped once and a
+cutout is a slice of it -- no pixels get copied until something actually
+needs a file (SExtractor does, so clean_frame gets the window written into
+its scratch directory). Changing the box size is just a different radius.
+
+The input is a catalog (anything Table.read understands) with columns
+    objid, field, x, y, radius
+where field is the name of the field FITS file in fielddir, x/y are the
+0-based pixel coordinates of the galaxy in that field and radius is the box
+half-size in pixels (multiplied by scale, so a column of Petrosian radii
+with scale=4 gives the old 4Rp stamps).
+'''
+
+import os
+import numpy as np
+import astropy.io.fits as fits
+from astropy.table import Table
+
+
+class VirtualCutout(object):
+
+    def __init__(self, objid, field, fielddata, fieldheader, x, y, radius,
+                 tag='', fieldpath=None):
+        self.objid = np.int64(objid)
+        self.field = field
+        self.fieldpath = fieldpath
+        self.x, self.y = x, y
+        self.name = '%i_%s'%(self.objid, tag) if tag else '%i'%self.objid
+
+        ny, nx = fielddata.shape
+        r = int(round(radius))
+        xc, yc = int(round(x)), int(round(y))
+        self.x0, self.x1 = max(xc-r, 0), min(xc+r+1, nx)
+        self.y0, self.y1 = max(yc-r, 0), min(yc+r+1, ny)
+
+        # galaxy too close to the edge of the field to sit in the middle
+        # of its stamp
+        self.clipped = (self.x1-self.x0 != 2*r+1) or (self.y1-self.y0 != 2*r+1)
+
+        self._field = fielddata
+        self._fieldheader = fieldheader
+
+    def __getstate__(self):
+        # sending a cutout to another process shouldn't mean sending the
+        # whole field along with it: it gets mapped again on the other side
+        state = dict(self.__dict__)
+        if self.fieldpath is not None:
+            state['_field'] = state['_fieldheader'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._field is None:
+            self._field, self._fieldheader = _mapped_field(self.fieldpath)
+
+    @property
+    def data(self):
+        ''' The stamp: a view into the memory-mapped field, not a copy '''
+        return self._field[self.y0:self.y1, self.x0:self.x1]
+
+    @property
+    def header(self):
+        ''' Field header with the WCS reference pixel moved to the stamp '''
+        hdr = self._fieldheader.copy()
+        if 'CRPIX1' in hdr:
+            hdr['CRPIX1'] -= self.x0
+            hdr['CRPIX2'] -= self.y0
+        hdr.set('FIELD', self.field, 'SDSS field this stamp is cut from')
+        hdr.set('CUTX0', self.x0, 'x offset of stamp in field')
+        hdr.set('CUTY0', self.y0, 'y offset of stamp in field')
+        return hdr
+
+    def write(self, outdir):
+        '''
+        Write the stamp out as FITS (for SExtractor) and return its name --
+        outdir is meant to be a scratch directory
+        '''
+        filename = os.path.join(outdir, self.name+'.fits')
+        fits.PrimaryHDU(data=self.data, header=self.header).writeto(
+                                    filename, output_verify='silentfix',
+                                    clobber=True)
+        return filename
+
+
+def read_field(filename):
+    ''' Memory-map the pixels of an SDSS field (and grab its header) '''
+    hdulist = fits.open(filename, memmap=True)
+    return hdulist[0].data, hdulist[0].header
+
+_last_field = {}
+
+def _mapped_field(filename):
+    # cutouts arrive a field at a time, so keeping the last one is enough
+    if filename not in _last_field:
+        _last_field.clear()
+        _last_field[filename] = read_field(filename)
+    return _last_field[filename]
+
+def group_by_field(catalog):
+    '''
+    Split a cutout catalog (Table or file name) into one sub-table per
+    field, so each field only has to be opened once
+    '''
+    if not isinstance(catalog, Table):
+        catalog = Table.read(catalog)
+    catalog = catalog.group_by('field')
+    return [group for group in catalog.groups]
+
+def field_cutouts(rows, fielddir='SDSSimages/', scale=1., tag=''):
+    '''
+    VirtualCutouts for every galaxy in rows (all from the same field, as
+    handed out by group_by_field). The field is mapped once for all of them
+    '''
+    if not len(rows):
+        return
+    field = str(rows['field'][0])
+    fieldpath = os.path.join(fielddir, field)
+    fielddata, fieldheader = read_field(fieldpath)
+    for row in rows:
+        yield VirtualCutout(row['objid'], field, fielddata, fieldheader,
+                            row['x'], row['y'], scale*row['radius'], tag,
+                            fieldpath)
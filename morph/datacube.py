@@ -0,0 +1,168 @@
+'''
+Reading and writing the f_<name>.fits datacubes made by clean_frame.
+
+Version 1 (everything written before DCVERS existed): plain ImageHDUs with
+the image to measure (CLN, or UCLN if the galaxy was re-cleaned) as the
+primary HDU, and CAT as an ASCII table.
+
+Version 2: an empty primary HDU carrying DCVERS = 2, then every image as a
+tile-compressed extension --
+    segmaps (BSEG, FSEG, F2SEG, SSEG): lossless, stored in the smallest
+        integer type that holds the largest object number
+    float images (CLN, UCLN, ORG, MID_CLN): lossless (GZIP_2) by default;
+        quantize_level > 0 quantizes them to rms/quantize_level (fpack
+        uses 16), which is much smaller but changes the pixels the
+        morphology is measured on -- only when asked for
+and CAT as a binary table.
+
+Anything that reads datacubes should go through read_galaxy (or get_image/
+get_catalog/get_segmap) so it doesn't care which version it's looking at.
+'''
+
+import os
+import numpy as np
+import astropy.io.fits as fits
+
+from instrument import timed, count
+
+
+DCVERS = 2
+# lossless: quantizing shifts the measured image's statistics
+QUANTIZE_LEVEL = 0.
+SEGMAPS = ['BSEG', 'FSEG', 'F2SEG', 'SSEG']
+
+
+def cube_version(hdulist):
+    return hdulist[0].header.get('DCVERS', 1)
+
+def get_image(hdulist):
+    '''
+    Return the image to measure and the index of the galaxy in CAT:
+    UCLN if the galaxy needed a second cleaning, CLN otherwise
+    '''
+    try:
+        name = 'UCLN'
+        catinfo = hdulist[name].header['SECATIDX']
+    except KeyError:
+        name = 'CLN'
+        catinfo = hdulist[name].header['SECATIDX']
+
+    if cube_version(hdulist) < 2:
+        # version 1 cubes always have that image up front
+        return hdulist[0].data, catinfo
+    return hdulist[name].data, catinfo
+
+@timed('io')
+def read_galaxy(source):
+    '''
+    The image to measure, the galaxy's row of the SE catalog and the FAINT
+    segmap. source is a datacube HDUList or anything else that knows how to
+    read_galaxy() itself (e.g. a StampEntry)
+    '''
+    if hasattr(source, 'read_galaxy'):
+        image, cat, segmap = source.read_galaxy()
+    else:
+        image, catinfo = get_image(source)
+        cat, segmap = get_catalog(source)[catinfo], get_segmap(source)
+    count('bytes_read', np.asarray(image).nbytes + np.asarray(segmap).nbytes)
+    return image, cat, segmap
+
+def get_catalog(hdulist):
+    return hdulist['CAT'].data
+
+def get_segmap(hdulist, name='FSEG'):
+    return hdulist[name].data
+
+def seg_dtype(seg):
+    ''' Smallest FITS-friendly integer type that holds this segmap '''
+    top = np.max(seg) if seg.size else 0
+    if top < 256:
+        return np.uint8
+    if top < 32768:
+        return np.int16
+    return np.int32
+
+def binary_table(data, name='CAT'):
+    ''' Copy any FITS table (ASCII or binary) into a binary table HDU '''
+    rec = np.rec.fromarrays([np.asarray(data[n]) for n in data.names],
+                            names=data.names)
+    return fits.BinTableHDU(data=rec, name=name)
+
+def compress_hdu(hdu, quantize_level=QUANTIZE_LEVEL, name=None):
+    ''' Version 2 equivalent of a single HDU; None if there's nothing in it '''
+    name = name or hdu.name
+    if isinstance(hdu, (fits.TableHDU, fits.BinTableHDU)):
+        return binary_table(hdu.data, name)
+    if isinstance(hdu, fits.CompImageHDU):
+        return hdu
+    if hdu.data is None:
+        return None
+
+    header = hdu.header.copy()
+    if name in SEGMAPS:
+        data = hdu.data.astype(seg_dtype(hdu.data))
+        return fits.CompImageHDU(data=data, header=header, name=name,
+                                 compression_type='RICE_1')
+    if quantize_level:
+        # seed the dither from the data so the same image always gives
+        # the same bytes
+        return fits.CompImageHDU(data=hdu.data, header=header, name=name,
+                                 compression_type='RICE_1',
+                                 quantize_level=quantize_level,
+                                 dither_seed=-1)
+    return fits.CompImageHDU(data=hdu.data, header=header, name=name,
+                             compression_type='GZIP_2', quantize_level=0.)
+
+def to_v2(hdus, quantize_level=QUANTIZE_LEVEL):
+    ''' Build a version 2 HDUList out of a version 1 cube (or list of HDUs) '''
+    out = fits.HDUList([fits.PrimaryHDU()])
+    out[0].header.set('DCVERS', DCVERS, 'datacube format version')
+    for idx, hdu in enumerate(hdus):
+        name = hdu.name
+        if idx == 0 and name == 'PRIMARY':
+            # nameless primary image in a version 1 cube is the cleaned one
+            name = 'CLN'
+        new = compress_hdu(hdu, quantize_level, name)
+        if new is not None:
+            out.append(new)
+    return out
+
+@timed('io')
+def write_datacube(hdus, filename, version=DCVERS,
+                   quantize_level=QUANTIZE_LEVEL):
+    ''' Write clean_frame's list of HDUs out in the requested version '''
+    if version < 2:
+        newthing = fits.HDUList()
+        for thing in hdus:
+            newthing.append(thing)
+        newthing.update_extend()
+    else:
+        newthing = to_v2(hdus, quantize_level)
+    newthing.writeto(filename, output_verify='silentfix', clobber=True)
+    count('bytes_written', os.path.getsize(filename))
+
+def convert_datacube(filename, outname=None, quantize_level=QUANTIZE_LEVEL):
+    '''
+    Rewrite a version 1 datacube as version 2 -- in place unless outname is
+    given. The new file is written next to its destination and renamed over
+    it so a crash never leaves half a cube behind.
+    Returns the sizes in bytes before and after.
+    '''
+    outname = outname or filename
+    before = os.path.getsize(filename)
+
+    hdulist = fits.open(filename)
+    try:
+        if cube_version(hdulist) >= 2:
+            if outname == filename:
+                return before, before
+            new = hdulist
+        else:
+            new = to_v2(hdulist, quantize_level)
+        tmp = outname+'.tmp'
+        new.writeto(tmp, output_verify='silentfix', clobber=True)
+    finally:
+        hdulist.close()
+
+    os.rename(tmp, outname)
+    return before, os.path.getsize(outname)
@@ -0,0 +1,64 @@
+'''
+What every driver (measure_morph.py, MEASURE_ and CLEAN_MORPHOLOGY_parallel.py)
+does to make a run watchable: the same options --
+
+    parser = argparse.ArgumentParser(...)
+    morph.add_run_options(parser)
+    args = parser.parse_args()
+    morph.start_run(args)
+
+-- set up the same way straight after parse_args, before any worker
+exists, so every process started later logs, traces and counts into the
+run's status like the driver does (logs.py, instrument.py, status.py).
+Once the work is laid out the driver says how much there is
+(status_started), and at the end finish_run() writes the trace, marks the
+status finished and hands back the timing report for the driver to show.
+'''
+
+from logs import DEFAULT_LEVEL, log_to
+from instrument import trace_to, write_trace, timing_report
+from status import status_to, status_finished
+
+
+def add_run_options(parser):
+    ''' --timings, --trace, --log-level, --log-dir and --status '''
+    parser.add_argument('--timings', action='store_true',
+        help='Add per-stage times (t_*) and operation counts (n_*) to the '
+             'catalog and summarize them at the end')
+    parser.add_argument('--trace', type=str, default=None,
+        help='Directory to write a Chrome trace of the run into '
+             '(trace.json, for chrome://tracing or ui.perfetto.dev)')
+    parser.add_argument('--log-level', dest='log_level', type=str,
+        default=DEFAULT_LEVEL, help='debug, info, warning (default: '
+        'progress stays quiet) or error')
+    parser.add_argument('--log-dir', dest='log_dir', type=str, default=None,
+        help='Directory for per-worker log files and per-galaxy records '
+             '(python -m morph.logs DIR sums them up)')
+    parser.add_argument('--status', type=str, default=None,
+        help='Directory to keep a live status of the run in (progress, '
+             'rate, ETA, workers; python -m morph.status DIR shows it)')
+    return parser
+
+def start_run(args, fresh=True):
+    '''
+    Logging, tracing and status as args asked for; fresh=False when other
+    nodes share the trace and status directories
+    '''
+    log_to(args.log_level, args.log_dir)
+    if args.trace:
+        trace_to(args.trace, fresh=fresh)
+    if args.status:
+        status_to(args.status, fresh=fresh)
+
+def finish_run(args, rows=None):
+    '''
+    The status's last word and the trace; returns the timing report of 
+    rows (and where the trace went), '' if there's nothing to report
+    '''
+    status_finished()
+    report = []
+    if args.timings and rows is not None and len(rows):
+        report.append(timing_report(rows))
+    if args.trace:
+        report.append('Trace written to %s'%write_trace(args.trace))
+    return '\n'.join(report)
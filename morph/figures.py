@@ -0,0 +1,351 @@
+'''
+Figure-reuse renderer for the quality-control figures.
+
+galaxyPlots builds a new figure, GridSpec and axes for every figure of every
+galaxy, then throws them away -- at catalog scale building figures is most
+of the time spent plotting. FigureRenderer makes each kind of figure once,
+on a bare Agg canvas (no pyplot, no figure manager), and for every galaxy
+only swaps in the new image data, moves the apertures and markers and
+rewrites the text before saving. Images are cut down to the part that's
+shown before they're handed to matplotlib, and the M20 contours are traced
+on a window around the aperture instead of the whole masked image.
+
+    renderer = FigureRenderer()
+    for payload in payloads:                # render.PlotPayload
+        failed = renderer.render(payload)
+
+The figures are the ones galaxyPlots.plot makes, with the same file names
+in outdir/figures/. A figure whose values weren't measured (e.g. no
+asymmetry) is skipped rather than failed. render_figures() keeps one
+renderer per process, for RenderQueue(render=render_figures).
+'''
+
+import os
+import numpy as np
+import astropy.io.fits as fits
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Ellipse
+from matplotlib.ticker import NullLocator
+from astropy.visualization import ZScaleInterval
+from skimage import measure
+
+import utils
+
+__all__ = ['FigureRenderer', 'render_figures']
+
+try:
+    # print_png always compresses at zlib level 6, which takes as long as
+    # drawing the figure did
+    from matplotlib import _png
+except ImportError:
+    _png = None
+
+
+FIGURE_DPI = 50
+PNG_COMPRESSION = 1
+
+
+class _Missing(Exception):
+    # the values a figure is drawn from weren't measured for this galaxy
+    pass
+
+def _need(p, *names):
+    for name in names:
+        value = getattr(p, name, None)
+        if value is None or not np.all(np.isfinite(value)):
+            raise _Missing(name)
+
+def _window(center, half, size):
+    # [lo, hi) pixel range around center, inside 0..size
+    lo = int(max(0, np.floor(center-half)))
+    hi = int(min(size, np.ceil(center+half)+1))
+    return lo, max(lo+1, hi)
+
+def _zscale(image):
+    return ZScaleInterval()(image)
+
+def ellipse_mask(shape, x, y, a, b, theta, rows=None, cols=None):
+    '''
+    utils.MyEllipticalAperture's mask (with its x along the first axis),
+    vectorized, for the window rows x cols of an image of this shape
+    '''
+    r0, r1 = rows or (0, shape[0])
+    c0, c1 = cols or (0, shape[1])
+    r, c = np.mgrid[r0:r1, c0:c1]
+    cosang = np.cos(theta+np.pi/2.)
+    sinang = np.sin(theta+np.pi/2.)
+    u = (x-r)*cosang - (y-c)*sinang
+    v = (x-r)*sinang + (y-c)*cosang
+    return (u**2/a**2 + v**2/b**2 <= 1).astype('float')
+
+def aperture_contours(image, x, y, a, b, theta, level):
+    '''
+    measure.find_contours(MyEllipticalAperture(...).aper*image, level) as
+    m20_plot does it, traced only on the aperture's bounding box (plus a
+    margin of zeros, so nothing changes)
+    '''
+    half = max(a, b)+2
+    rows = _window(x, half, image.shape[0])
+    cols = _window(y, half, image.shape[1])
+    mask = ellipse_mask(image.shape, x, y, a, b, theta, rows, cols)
+    crop = np.asarray(image[rows[0]:rows[1], cols[0]:cols[1]], 'float')
+    contours = measure.find_contours(mask*crop, level)
+    return [c+[rows[0], cols[0]] for c in contours]
+
+
+class _Figure(object):
+    ''' One kind of figure, built once and redrawn for every galaxy '''
+    suffix = ''
+    figsize = (8, 8)
+
+    def __init__(self, dpi=FIGURE_DPI):
+        self.fig = Figure(figsize=self.figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.setup()
+
+    def image_axes(self, cmap):
+        # no tight_layout per galaxy: the axes stay where they are. There
+        # are no tick labels either, so no ticks to lay out every time
+        ax = self.fig.add_axes([0.02, 0.02, 0.96, 0.9])
+        ax.xaxis.set_major_locator(NullLocator())
+        ax.yaxis.set_major_locator(NullLocator())
+        im = ax.imshow(np.zeros((2, 2)), cmap=cmap, origin='lower',
+                       interpolation='nearest')
+        return ax, im
+
+    def ellipse(self, ax, **kwargs):
+        patch = Ellipse((0, 0), 1, 1, 0, fill=False, **kwargs)
+        ax.add_patch(patch)
+        return patch
+
+    def show(self, im, image, rows=None, cols=None):
+        # only hand matplotlib the part of the image that's on show
+        r0, r1 = rows or (0, image.shape[0])
+        c0, c1 = cols or (0, image.shape[1])
+        im.set_data(image[r0:r1, c0:c1])
+        im.set_extent((c0-0.5, c1-0.5, r0-0.5, r1-0.5))
+        im.axes.set_xlim(c0-0.5, c1-0.5)
+        im.axes.set_ylim(r0-0.5, r1-0.5)
+
+    def draw(self, p):
+        ''' Put p's values into the figure; raises _Missing if it can't '''
+        raise NotImplementedError
+
+    def save(self, p):
+        filename = p.outdir+'figures/'+p.name+self.suffix
+        self.draw(p)
+        if _png is None:
+            self.canvas.print_png(filename)
+        else:
+            self.canvas.draw()
+            # no per-row filtering: it costs more than it saves here
+            _png.write_png(self.canvas.get_renderer()._renderer, filename,
+                           self.fig.dpi, compression=PNG_COMPRESSION,
+                           filter=_png.PNG_FILTER_NONE)
+        return filename
+
+
+def move(patch, x, y, a, b, theta):
+    ''' Make an Ellipse the aperture (x, y), semi-axes a, b, angle theta '''
+    patch.center = (x, y)
+    patch.width, patch.height = 2.*a, 2.*b
+    patch.angle = theta*180./np.pi
+
+
+class RpApertureFigure(_Figure):
+    ''' The galaxy with its 1 Petrosian radius aperture '''
+    suffix = '_RpAper.png'
+
+    def setup(self):
+        self.ax, self.im = self.image_axes('gray_r')
+        self.aper = self.ellipse(self.ax, color='blue', lw=1.5, alpha=0.5)
+        self.ax.set_title('1 Petrosian Radius')
+
+    def draw(self, p):
+        _need(p, 'Rp', 'x', 'y', 'e', 'theta')
+        image = p.image
+        size = 2*p.Rp
+        # galaxyPlots zooms to +-2Rp around the middle of the stamp
+        cols = _window(image.shape[0]/2., size, image.shape[1])
+        rows = _window(image.shape[1]/2., size, image.shape[0])
+        self.show(self.im, image, rows, cols)
+        self.im.set_clim(p.med - 2*p.rms, np.max(image)/2.)
+        move(self.aper, p.x, p.y, p.Rp, p.Rp/p.e, p.theta)
+
+
+class SBProfileFigure(_Figure):
+    ''' SB and <SB> against radius, and their ratio, with Rp marked '''
+    suffix = '_SBprofile.png'
+    figsize = (9, 7)
+
+    def setup(self):
+        self.ax2 = ax2 = self.fig.add_subplot(2, 1, 2)
+        self.ax1 = ax1 = self.fig.add_subplot(2, 1, 1, sharex=ax2)
+        ax2.set_xscale('log')
+        for label in ax1.get_xticklabels():
+            label.set_visible(False)
+        ax2.set_xlabel('Radius (pixels)', fontsize=16)
+        ax1.set_ylabel(r'$\mu$(R)', fontsize=16)
+        ax2.set_ylabel(r'$\mu$(R)/<$\mu$(<R)>', fontsize=16)
+        ax2.set_ylim(-0.5, 1.05)
+
+        self.sb, = ax1.plot([], [], 'ro')
+        self.avgsb, = ax1.plot([], [], 'go')
+        self.zero, = ax1.plot([], [], 'k--')
+        self.newratio, = ax2.plot([], [], 'bo')
+        self.ratio, = ax2.plot([], [], 'ro')
+        self.eta, = ax2.plot([], [], 'k--')
+        self.rp, = ax2.plot([], [], 'k-.')
+        self.text = ax2.text(.03, 0.05, '', fontsize=16, color='k',
+                             transform=ax2.transAxes)
+        self.fig.subplots_adjust(left=0.12, right=0.97, bottom=0.1,
+                                 top=0.97, hspace=0.05)
+
+    def draw(self, p):
+        _need(p, '_sb', '_avgsb', '_rads', '_ratio', 'Rp')
+        radii = p._rads
+        top = np.max(radii)
+        self.sb.set_data(radii, p._sb)
+        self.avgsb.set_data(radii, p._avgsb)
+        self.zero.set_data([1., top], [0., 0.])
+        self.ratio.set_data(radii, p._ratio)
+        newratio = getattr(p, '_newratio', None)
+        if newratio is not None and len(newratio) == len(radii):
+            self.newratio.set_data(radii, newratio)
+        else:
+            self.newratio.set_data([], [])
+        self.eta.set_data([1., top], [0.2, 0.2])
+        self.rp.set_data([p.Rp, p.Rp], [-0.5, 0.2])
+        self.text.set_text("Rp = %3.2f"%p.Rp)
+
+        self.ax2.set_xlim(np.min(radii), top)
+        self.ax1.set_ylim(-0.005, 1.2*np.max(p._sb))
+
+
+class AsymmetryFigure(_Figure):
+    ''' The asymmetry residual with the asymmetry center and aperture '''
+    suffix = '_asym.png'
+
+    def setup(self):
+        self.ax, self.im = self.image_axes('gray_r')
+        self.aper = self.ellipse(self.ax, lw=1)
+        self.center, = self.ax.plot([], [], 'r+', mew=.5, ms=10)
+        self.text = self.ax.text(.05, .05, '', fontsize=18, color='yellow',
+                                 transform=self.ax.transAxes)
+
+    def residual(self, p):
+        if getattr(p, 'residual', None) is not None:
+            return p.residual
+        filename = p.outdir+'asymimgs/'+p.name+'_res.fits'
+        if not os.path.isfile(filename):
+            raise _Missing('residual')
+        return fits.getdata(filename)
+
+    def draw(self, p):
+        _need(p, 'A', 'Ax', 'Ay', 'Rp', 'e', 'theta')
+        self.show(self.im, _zscale(self.residual(p)))
+        self.im.set_clim(0., 1.)
+        self.center.set_data([p.Ax], [p.Ay])
+        move(self.aper, p.Ax, p.Ay, p.Rp, p.Rp/p.e, p.theta)
+        self.text.set_text('A = %1.3f'%p.A)
+
+
+class ConcentrationFigure(_Figure):
+    ''' The r20, r80 and 1.5Rp apertures concentration comes from '''
+    suffix = '_conc.png'
+
+    def setup(self):
+        self.ax, self.im = self.image_axes('Greys_r')
+        self.r20 = self.ellipse(self.ax, linewidth=1, color='black')
+        self.r80 = self.ellipse(self.ax, linewidth=1, color='k')
+        self.total = self.ellipse(self.ax, linestyle='--', color='k')
+        self.text = self.ax.text(.05, .05, '', fontsize=18, color='yellow',
+                                 transform=self.ax.transAxes)
+
+    def draw(self, p):
+        _need(p, 'C', 'r20', 'r80', 'Ax', 'Ay', 'Rp', 'e', 'theta')
+        self.show(self.im, _zscale(p.image))
+        self.im.set_clim(0., 1.)
+        move(self.r20, p.Ax, p.Ay, p.r20, p.r20/p.e, p.theta)
+        move(self.r80, p.Ax, p.Ay, p.r80, p.r80/p.e, p.theta)
+        move(self.total, p.Ax, p.Ay, 1.5*p.Rp, 1.5*p.Rp/p.e, p.theta)
+        self.text.set_text('C = %1.3f'%p.C)
+
+
+class M20Figure(_Figure):
+    ''' The brightest-20% contours, the M20 center, M20 and G '''
+    suffix = '_M20.png'
+    figsize = (10, 6)
+
+    def setup(self):
+        self.ax, self.im = self.image_axes('Greys_r')
+        self.aper = self.ellipse(self.ax, linewidth=1, color='black')
+        self.center, = self.ax.plot([], [], 'r+', mew=.5, ms=10)
+        self.contours = []
+        self.m20 = self.ax.text(.05, .05, '', fontsize=18, color='yellow',
+                                transform=self.ax.transAxes)
+        self.gini = self.ax.text(.05, .15, '', fontsize=18, color='yellow',
+                                 transform=self.ax.transAxes)
+
+    def draw(self, p):
+        _need(p, 'M20', 'G', 'Mx', 'My', 'Mlevel1', 'xc', 'yc', 'Rp', 'e',
+              'theta')
+        self.show(self.im, _zscale(p.image))
+        self.im.set_clim(0., 1.)
+
+        contours = aperture_contours(p.image, p.xc, p.yc, p.Rp, p.Rp/p.e,
+                                     p.theta, p.Mlevel1)
+        # reuse the contour lines there are, make more only when needed
+        while len(self.contours) < len(contours):
+            line, = self.ax.plot([], [], color='blue', linewidth=2)
+            self.contours.append(line)
+        for n, line in enumerate(self.contours):
+            if n < len(contours):
+                line.set_data(contours[n][:,1], contours[n][:,0])
+            else:
+                line.set_data([], [])
+
+        move(self.aper, p.xc, p.yc, p.Rp, p.Rp/p.e, p.theta)
+        self.center.set_data([p.Mx], [p.My])
+        self.m20.set_text(r"M$_{20} = $"+"{0:.2f}".format(p.M20))
+        self.gini.set_text(r"$G = ${0:.2f}".format(p.G))
+
+
+FIGURES = [RpApertureFigure, SBProfileFigure, AsymmetryFigure,
+           ConcentrationFigure, M20Figure]
+
+
+class FigureRenderer(object):
+
+    def __init__(self, figures=FIGURES, dpi=FIGURE_DPI):
+        self.figures = [f(dpi) for f in figures]
+        self.saved = self.skipped = 0
+
+    def render(self, p):
+        '''
+        Save every figure p has the values for; returns [(figure, error)]
+        for those that failed, like render.render_payload
+        '''
+        utils.checkdir(p.outdir+'figures/')
+        failed = []
+        for figure in self.figures:
+            try:
+                figure.save(p)
+                self.saved += 1
+            except _Missing:
+                self.skipped += 1
+            except Exception as error:
+                failed.append((type(figure).__name__, repr(error)))
+        return failed
+
+
+_renderer = None
+
+def render_figures(payload):
+    ''' FigureRenderer.render with one renderer kept per process '''
+    global _renderer
+    if _renderer is None:
+        _renderer = FigureRenderer()
+    return _renderer.render(payload)
@@ -9,7 +9,6 @@ import cPickle
 
 import astropy.io.fits as fits
 import numpy as np
-import matplotlib.pyplot as plt
 
 import scipy.ndimage.interpolation as sp_interp
 from scipy.interpolate import interp1d
@@ -17,10 +16,55 @@ from scipy.optimize import fsolve
 
 from astropy.table import Table
 from astropy.stats import sigma_clipped_stats
-from photutils import aperture_photometry, EllipticalAnnulus, \
-                              EllipticalAperture, CircularAnnulus, \
-                              CircularAperture
+from photutils import EllipticalAnnulus, EllipticalAperture, \
+                      CircularAnnulus, CircularAperture
+import photutils
 import morph
+from instrument import timed, stage, count, timing_columns
+from logs import get_logger
+
+log = get_logger(__name__)
+
+def aperture_photometry(data, apertures, **kwargs):
+    # photutils' aperture_photometry, counted
+    count('photometry')
+    return photutils.aperture_photometry(data, apertures, **kwargs)
+
+# what table() hands back: the SExtractor values, background and Petrosian
+# radius (the A/C/G/M20 block in __init__ is off -- its columns go here
+# when it's back on)
+CATALOG_COLUMNS = ['name', 'objid', 'filename', 'outdir', 'cat', 'oflag',
+                   'uflag', 'bflag', 'xc', 'yc', 'e', 'x', 'y', 'kron', 'a',
+                   'b', 'theta', 'ra', 'dec', 'elipt', 'med', 'rms', 'Rp',
+                   'Rp_SB', 'Rpflag']
+
+def catalog_columns(timings=False, supervised=False):
+    '''
+    (name, dtype) of every catalog column, sorted: GalaxyMorphology's, the
+    failcode/failstage supervised() adds and the per-stage timing columns
+    '''
+    names = list(CATALOG_COLUMNS)
+    if supervised:
+        names += ['failcode', 'failstage']
+    if timings:
+        names += timing_columns()
+    return [(name, column_dtype(name)) for name in sorted(names)]
+
+def column_dtype(key):
+    ''' Catalog column type for each GalaxyMorphology attribute '''
+    if key in ['name']:
+        return 'S80'
+    elif key in ['filename', 'outdir']:
+        return 'S160'
+    elif key in ['failstage']:
+        return 'S40'
+    elif key in ['cat', 'oflag', 'uflag','Rpflag','Rpflag_c','bflag',
+                 'failcode']:
+        return 'i'
+    elif key in ['objid'] or key.startswith('n_'):
+        return 'int64'
+    else: 
+        return 'f'
 
 class GalaxyMorphology(object):
 
@@ -31,21 +75,9 @@ class GalaxyMorphology(object):
                     key and use that to compute the morphologies [use petrorad_i]
         """
 
-        #"""
-        # initialize fits image & catalog data
-        try:
-            image = hdulist['UCLN'].data
-            catinfo = hdulist['UCLN'].header['SECATIDX']
-        except:
-            image = hdulist['CLN'].data
-            catinfo = hdulist['CLN'].header['SECATIDX']
-        #"""
-
-        image = hdulist[0].data
-
-
-        cat = hdulist['CAT'].data[catinfo]
-        segmap = hdulist['FSEG'].data
+        # initialize fits image & catalog data (either datacube version, 
+        # or a StampEntry out of a packed stamp store)
+        image, cat, segmap = morph.read_galaxy(hdulist)
 
         self.xc, self.yc = image.shape[0]/2.,image.shape[1]/2.
         
@@ -110,7 +142,8 @@ class GalaxyMorphology(object):
             [self.M20], self.Mx, self.My = self.get_m20(image, gell_ap)
 
         else:
-            print "Petrosian radius could not be calculated!!"
+            log.warning("Petrosian radius of %s could not be calculated",
+                        self.name)
             self.A, self.Ax, self.Ay = np.nan, self.x, self.y
             #self.A_c, self.Ax_c, self.Ay_c = np.nan, self.x, self.y
 
@@ -137,6 +170,7 @@ class GalaxyMorphology(object):
          self.r20 = self.r80 = self.C = np.nan
          self.M20 = self.Mx = self.My = self.G = np.nan 
 
+    @timed('background')
     def background(self, data, segmap):
         mean, median, std = sigma_clipped_stats(data[segmap==0])
         return median, std
@@ -147,6 +181,7 @@ class GalaxyMorphology(object):
         n = len(galpixels)
         return np.sum(galpixels/np.sqrt(self.rms**2+abs(galpixels)))
         
+    @timed('petrosian')
     def get_petro_ell(self, image):
         r_flag = 0
     
@@ -234,12 +269,13 @@ class GalaxyMorphology(object):
                 rp_sb, r_flag = np.nan, 1
             return rp, rp_sb, r_flag
         else:
-            print "Petrosian interpolation failed!"
+            log.warning("Petrosian interpolation failed for %s", self.name)
             rp, rp_sb, r_flag = np.nan, np.nan, 2
             return rp, rp_sb, r_flag
 
+    @timed('petrosian')
     def get_petro_ell2(self, image):
-        print "Measuring Petrosian radius via elliptical apertures..."
+        log.debug("Measuring Petrosian radius via elliptical apertures...")
         r_flag = 0
         save = True
     
@@ -317,10 +353,15 @@ class GalaxyMorphology(object):
             except:
                 pass
 
-            outdir = string.join(self.filename.split('/')[:3],'/')
-            F = open(outdir+'/sb_profile_{}.pkl'.format(self.objid), 'wb')
-            cPickle.dump(sb_profile, F)
-            F.close()
+            # the profiles go with the rest of the output, not wherever
+            # the datacube happens to be
+            with stage('io'):
+                morph.checkdir(self.outdir+'/')
+                F = open(self.outdir+'/sb_profile_{}.pkl'.format(self.objid),
+                         'wb')
+                cPickle.dump(sb_profile, F)
+                count('bytes_written', F.tell())
+                F.close()
 
         if not np.any(np.isnan(ratios)):
             rp = morph.get_intersect(ratios, 0.2, radii, mono='dec')
@@ -335,11 +376,12 @@ class GalaxyMorphology(object):
                 rp_sb, r_flag = np.nan, 1
             return rp, rp_sb, r_flag
         else:
-            print "Petrosian interpolation failed!"
+            log.warning("Petrosian interpolation failed for %s", self.name)
             rp, rp_sb, r_flag = np.nan, np.nan, 2
             return rp, rp_sb, r_flag
 
 
+    @timed('petrosian')
     def get_petro_circ(self, image):
         r_flag = 0
 
@@ -429,6 +471,7 @@ class GalaxyMorphology(object):
 
 
         # minimize the background asymmetry
+        count('bkg_asym_evals', bkg_img.size)
         ba = []
         for idx1 in range(bkg_img.shape[0]):
             for idx2 in range(bkg_img.shape[1]):
@@ -444,7 +487,8 @@ class GalaxyMorphology(object):
         bkgasym = np.min(ba)*aperture.area()/(bkg_img.shape[0]*bkg_img.shape[1])
         return bkgasym
         
-    def get_asymmetry(self, image, aper, save_residual=True):
+    @timed('asymmetry')
+    def get_asymmetry(self, image, aper, save_residual=True, max_steps=100):
 
         '''
         1. make a smaller image of the galaxy -> 2*petrosian rad
@@ -452,9 +496,11 @@ class GalaxyMorphology(object):
         3. create an aperture 1.5*petrosian radius
         4. minimize asymmetry in the background img
         5. minimize asymmetry in the galaxy img
+
+        Gives up (asymmetry NaN) after max_steps moves of the center
         #'''
 
-        print "calculating Asymmetry..."
+        log.debug("calculating Asymmetry...")
        
         delta = np.array([self.x-self.xc, self.y-self.yc])
        
@@ -463,7 +509,8 @@ class GalaxyMorphology(object):
         asyms = defaultdict(list)
         prior_points = []
 
-        while True:
+        for step in range(max_steps):
+            count('asym_steps')
             # These hold intermediary asym & denominator values
             ga, dd = [], []
 
@@ -474,6 +521,7 @@ class GalaxyMorphology(object):
                 # if the point already exists in the dictionary, 
                 #don't run asym codes!
                 if p not in asyms: 
+                    count('asym_evals')
                     shifted = sp_interp.shift(image, d)
                     rotated = sp_interp.rotate(shifted, 180.)
                     residual = shifted - rotated
@@ -508,8 +556,11 @@ class GalaxyMorphology(object):
                     resid = shift - rot
                     res = fits.ImageHDU(data=resid)
                     morph.checkdir(self.outdir+'asymimgs/')
-                    res.writeto(self.outdir+'/asymimgs/'+self.name+'_res.fits', 
-                                clobber=True, output_verify='silentfix')
+                    resname = self.outdir+'/asymimgs/'+self.name+'_res.fits'
+                    with stage('io'):
+                        res.writeto(resname, clobber=True, 
+                                    output_verify='silentfix')
+                    count('bytes_written', os.path.getsize(resname))
 
 
                 return ga[0]-bkg_asym/dd[0], asym_center[0], asym_center[1]
@@ -523,7 +574,12 @@ class GalaxyMorphology(object):
                 else: 
                     return np.nan, self.x, self.y
 
+        log.warning("Asymmetry center of %s didn't settle after %i steps",
+                    self.name, max_steps)
+        return np.nan, self.x, self.y
 
+
+    @timed('concentration')
     def get_concentration_ell(self, image):
 
         '''
@@ -537,7 +593,7 @@ class GalaxyMorphology(object):
         Divide the running sum by the fixed total flux value and 
            see where this ratio crosses .2 and .8
         #'''
-        print "calculating Concentration..."
+        log.debug("calculating Concentration...")
 
         a = 10*np.logspace(-1.0, np.log10(np.min([self.xc,self.yc])/10.),num=20)
         b = a/self.e
@@ -572,6 +628,7 @@ class GalaxyMorphology(object):
 
         return r20, r50, r80, conc
 
+    @timed('concentration')
     def get_concentration_circ(self, image):
         #print "calculating Concentration..."
 
@@ -609,8 +666,9 @@ class GalaxyMorphology(object):
 
         return r20, r50, r80, conc
  
+    @timed('gini')
     def get_gini1(self, image, apertures):
-        print "calculating Gini..."
+        log.debug("calculating Gini...")
 
         ginis = []
         for aper in apertures:
@@ -627,6 +685,7 @@ class GalaxyMorphology(object):
             
         return ginis
 
+    @timed('gini')
     def get_gini2(self, image):
         #print "calculating Gini(2)..."
         ginis = []
@@ -652,9 +711,10 @@ class GalaxyMorphology(object):
 
         return ginis
         
+    @timed('m20')
     def get_m20(self, image, ell_aper): #, circ_aper
 
-        print "Calculating M20..."
+        log.debug("Calculating M20...")
 
         # create .5*Rp 'box' centered on img center in which to calculate
         # Mtot at each pixel
@@ -676,6 +736,8 @@ class GalaxyMorphology(object):
         #mtots_circ = np.zeros_like(image, dtype='float32')
 
         # calculate mtot at every pixel in our 'box'
+        count('m20_centers', max(0, mxrange[1]-mxrange[0]) *
+                             max(0, myrange[1]-myrange[0]))
         for i in range(mxrange[0], mxrange[1]):
             for j in range(myrange[0], myrange[1]):
 
@@ -695,8 +757,8 @@ class GalaxyMorphology(object):
                     mtots_ell[i,j] = np.sum(mask_ell*dist_grid)
                     #mtots_circ[i,j] = np.sum(mask_circ*dist_grid)
                 except:
-                    print "a failure in M20 has occured"
-                    pdb.set_trace()
+                    log.error("a failure in M20 has occured for %s", self.name)
+                    raise
 
         M20s = []
 
@@ -782,16 +844,7 @@ class GalaxyMorphology(object):
 
         if init:
             keys = [k for k in the_dict.keys()]
-            dtypes = []
-            for k in keys:
-                if k in ['name']:
-                    dtypes.append('S80')
-                elif k in ['cat', 'oflag', 'uflag','Rpflag','Rpflag_c','bflag']:
-                    dtypes.append('i')
-                elif k in ['objid']:
-                    dtypes.append('int64')
-                else: 
-                    dtypes.append('f')
+            dtypes = [column_dtype(k) for k in keys]
             t = Table(names=keys, dtype=dtypes)
             return t, the_dict
         else:
@@ -17,6 +17,9 @@ from skimage import measure
 import pdb
 import utils
 
+__all__ = ['plot', 'petro_radius', 'petro_radius2', 'petro_SB', 'petro_SB2',
+           'asym_plot', 'conc_plot', 'm20_plot']
+
     
 '''
 things we might want to plot:
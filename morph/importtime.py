@@ -0,0 +1,137 @@
+'''
+What a process pays to import things, module by module.
+
+    python -m morph.importtime                      # import morph
+    python -m morph.importtime morph morph.galaxyPlots
+    python -m morph.importtime --top 30 MEASURE_MORPHOLOGY_parallel
+
+Each import happens in a fresh interpreter, so nothing is loaded already,
+with __import__ wrapped to time every module that gets loaded. The report
+gives the total, how many modules came in, and the slowest ones both by
+their own time and including everything they imported in turn.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+def _resolve(name, globals, level):
+    # 'utils' imported from inside morph is really morph.utils
+    if level != 0 and globals and globals.get('__name__'):
+        package = globals.get('__package__')
+        if not package:
+            package = globals['__name__']
+            if '__path__' not in globals:
+                package = package.rpartition('.')[0]
+        for up in range(level-1):
+            # from .. import x
+            package = package.rpartition('.')[0]
+        if not name:
+            # from . import x
+            return package or name
+        # (py2 leaves None in sys.modules for relative names that turned
+        # out to be absolute)
+        if package and sys.modules.get(package+'.'+name) is not None:
+            return package+'.'+name
+    return name
+
+def time_imports(modules):
+    '''
+    Import modules in this process; returns {module: (cumulative, own)}
+    seconds for every module loaded along the way, and the total
+    '''
+    import __builtin__
+    real_import = __builtin__.__import__
+    stack = []
+    times = {}
+
+    def timed_import(name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        before = len(sys.modules)
+        stack.append(0.)
+        t0 = time.time()
+        try:
+            return real_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - t0
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if len(sys.modules) > before:
+                key = _resolve(name, globals, level)
+                total, own = times.get(key, (0., 0.))
+                times[key] = (total+elapsed, own+elapsed-children)
+
+    __builtin__.__import__ = timed_import
+    t0 = time.time()
+    try:
+        for module in modules:
+            __import__(module)
+    finally:
+        __builtin__.__import__ = real_import
+    return times, time.time()-t0
+
+def import_report(modules=('morph',), top=15, python=sys.executable):
+    '''
+    Time importing modules in a fresh interpreter; returns the report
+    as a string
+    '''
+    here = os.path.abspath(__file__)
+    if here.endswith('.pyc'):
+        here = here[:-1]
+    # the package's parent (for morph) and the working directory (for the
+    # drivers) have to be importable
+    env = dict(os.environ)
+    path = [os.path.dirname(os.path.dirname(here)), os.getcwd()]
+    if env.get('PYTHONPATH'):
+        path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(path)
+    env.setdefault('MPLBACKEND', 'Agg')
+
+    out = subprocess.check_output([python, '-W', 'ignore', here, '--child']
+                                  +list(modules), env=env)
+    result = json.loads(out.splitlines()[-1])
+    times, total = result['times'], result['total']
+
+    lines = ['import %s: %.2fs, %i modules loaded'
+             %(', '.join(modules), total, len(times))]
+    for title, column in [('own time', 1), ('including what they import', 0)]:
+        lines.append('  slowest by %s:'%title)
+        slowest = sorted(times, key=lambda m: times[m][column],
+                         reverse=True)[:top]
+        for module in slowest:
+            lines.append('    %7.3fs  %5.1f%%  %s'
+                         %(times[module][column],
+                           100*times[module][column]/max(total, 1e-9),
+                           module))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=
+        'Report how long importing modules takes, module by module.')
+    parser.add_argument('modules', nargs='*', default=['morph'])
+    parser.add_argument('--top', type=int, default=15,
+        help='How many of the slowest modules to list.')
+    parser.add_argument('--child', action='store_true',
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # running as a script puts morph/ itself on the path: take it off so
+        # its modules don't get imported a second time as top-level ones
+        here = os.path.dirname(os.path.abspath(__file__))
+        sys.path = [p for p in sys.path if os.path.abspath(p or '.') != here]
+        times, total = time_imports(args.modules)
+        sys.stdout.flush()
+        print json.dumps({'times':times, 'total':total})
+    else:
+        print import_report(args.modules, args.top)
+
+
+if __name__ == '__main__':
+    main()
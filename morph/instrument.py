@@ -0,0 +1,426 @@
+'''
+Per-galaxy instrumentation: where each galaxy's time went and how much
+work it took.
+
+The code doing the work only says what it's doing --
+
+    @timed('petrosian')
+    def get_petro_ell2(self, image): ...
+
+    count('photometry')
+    with stage('io'):
+        res.writeto(...)
+
+-- and whoever measures a galaxy collects it into that galaxy's Probe:
+
+    with measuring() as probe:
+        row = measure(...)
+    add_timings(row, probe.columns())
+
+A probe belongs to the thread that installed it (SExtractor's threads
+count into the probe of the thread that started them). Stages are
+exclusive: time spent in a stage nested inside another -- writing the
+residual image in the middle of the asymmetry -- only counts towards the
+inner one, so the stage times never add up to more than t_total. Outside
+measuring() everything goes into a throwaway probe.
+
+columns() always has every stage (t_<stage>, seconds), t_total and every
+counter (n_<counter>) so every row has the same columns. timing_report()
+adds up a run: how the time splits over the stages and how long the tail
+of each is, the counters, and the slowest galaxies with the stage that
+made them slow. `python -m morph.instrument catalog.fits` does the same
+for a finished catalog.
+
+The same hooks can also trace a run. After trace_to(directory), in this
+process and every process started from it, each stage, each galaxy
+(measuring(item)), each SExtractor run and each mark() is written to
+directory/events.<host>.<pid>.jsonl as it happens, with the galaxy's
+name and objid; write_trace() merges them into one Chrome trace-event
+file (chrome://tracing, ui.perfetto.dev) with a row per worker thread,
+where gaps between galaxies, stragglers and slow reads are easy to see.
+When nothing is being traced that costs one comparison per stage.
+
+measuring() also starts and finishes the galaxy's log record (logs.py)
+when there is a log directory, and counts the galaxy into the run's
+status (status.py) when there is a status directory.
+'''
+
+import os
+import glob
+import json
+import time
+import socket
+import argparse
+import threading
+import functools
+import numpy as np
+
+import logs
+import status
+
+
+STAGES = ['io', 'cleaning', 'background', 'petrosian', 'asymmetry',
+          'concentration', 'gini', 'm20', 'plotting']
+
+COUNTERS = ['photometry', 'asym_steps', 'asym_evals', 'bkg_asym_evals',
+            'm20_centers', 'se_runs', 'bytes_read', 'bytes_written']
+
+
+TRACE_ENV = 'MORPH_TRACE'
+
+
+class Probe(object):
+    ''' Stage times and operation counts of one galaxy '''
+
+    def __init__(self, item=None):
+        self.times = dict((name, 0.) for name in STAGES)
+        self.counts = dict((name, 0) for name in COUNTERS)
+        self.started = time.time()
+        self.stopped = None
+        # whether the run's status counts it as a galaxy (see measuring)
+        # and whether supervised() had to quarantine it
+        self.counted = True
+        self.quarantined = False
+        self._stack = []
+        self._lock = threading.Lock()
+
+        # what trace events of this galaxy say it is
+        self.item = {}
+        if item is not None:
+            from supervise import item_name, item_objid
+            self.item = {'name':item_name(item),
+                         'objid':int(item_objid(item))}
+
+    def enter(self, name, args=None):
+        self._stack.append([name, time.time(), 0., args])
+
+    def exit(self):
+        name, start, nested, args = self._stack.pop()
+        elapsed = time.time() - start
+        self.add(name, elapsed - nested)
+        if self._stack:
+            self._stack[-1][2] += elapsed
+        if _trace_dir is not None:
+            _event('X', name, 'stage', start, elapsed,
+                   dict(self.item, **(args or {})))
+
+    def add(self, name, seconds):
+        ''' Put seconds spent elsewhere (e.g. waiting on a reader) on a stage '''
+        with self._lock:
+            self.times[name] = self.times.get(name, 0.) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def stop(self):
+        self.stopped = time.time()
+
+    def total(self):
+        return (self.stopped or time.time()) - self.started
+
+    def columns(self):
+        ''' t_<stage>, t_total and n_<counter> for a catalog row '''
+        columns = {'t_total':self.total()}
+        with self._lock:
+            for name, seconds in self.times.items():
+                columns['t_'+name] = seconds
+            for name, n in self.counts.items():
+                columns['n_'+name] = n
+        return columns
+
+
+_local = threading.local()
+
+def current():
+    ''' This thread's probe '''
+    probe = getattr(_local, 'probe', None)
+    if probe is None:
+        probe = _local.probe = Probe()
+    return probe
+
+class measuring(object):
+    '''
+    with measuring(item) as probe: a fresh Probe for this thread, for the
+    galaxy item is (a file name, cutout, objid...)
+
+    counted=False when this is only part of a galaxy's work (cleaning it
+    ahead of a measuring stage, drawing its figures afterwards): its time
+    still counts, the galaxy is counted done elsewhere. Set
+    probe.counted when that's only known at the end.
+    '''
+
+    def __init__(self, item=None, counted=True):
+        self.item = item
+        self.counted = counted
+
+    def __enter__(self):
+        self._old = getattr(_local, 'probe', None)
+        self.probe = _local.probe = Probe(self.item)
+        self.probe.counted = self.counted
+        self._record = logs.galaxy_started(self.probe.item)
+        return self.probe
+
+    def __exit__(self, type, value, traceback):
+        self.probe.stop()
+        _local.probe = self._old
+        logs.galaxy_finished(self.probe, value, self._record)
+        status.galaxy_finished(self.probe, value)
+        if _trace_dir is not None:
+            _event('X', self.probe.item.get('name', 'galaxy'), 'galaxy',
+                   self.probe.started, self.probe.total(), self.probe.item)
+
+class stage(object):
+    '''
+    with stage(what): time the block as that stage; keyword arguments
+    only go into its trace event
+    '''
+
+    def __init__(self, what, **args):
+        self.name = what
+        self.args = args
+
+    def __enter__(self):
+        self.probe = current()
+        self.probe.enter(self.name, self.args)
+        return self.probe
+
+    def __exit__(self, type, value, traceback):
+        self.probe.exit()
+
+def timed(name):
+    ''' Decorator: every call of the function is timed as stage name '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    current().count(name, n)
+
+def mark(name, **args):
+    ''' A moment worth seeing in the trace (e.g. which way cleaning went) '''
+    if _trace_dir is not None:
+        _event('i', name, 'mark', time.time(), None,
+               dict(current().item, **args))
+
+def span(name, start, end, probe=None, lane=None, **args):
+    '''
+    Trace something that ran from start to end on behalf of probe's galaxy
+    (this thread's by default). It goes on this thread's row of the trace,
+    or with lane='sextractor' on the first of the 'sextractor' rows that's
+    free then -- so short-lived threads don't get a row each.
+    '''
+    if _trace_dir is not None:
+        probe = probe or current()
+        _event('X', name, 'stage', start, end-start, dict(probe.item, **args),
+               lane)
+
+
+_trace_dir = os.environ.get(TRACE_ENV) or None
+_trace_file = None
+_trace_pid = None
+_trace_lock = threading.Lock()
+_tids = {}
+_lanes = {}
+
+def trace_to(directory, fresh=True):
+    '''
+    Trace this process, and every process started from it from now on,
+    into directory (None to stop); fresh clears out an earlier run's events
+    '''
+    global _trace_dir, _trace_pid
+    if directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if fresh:
+            for old in glob.glob(os.path.join(directory, 'events.*.jsonl')):
+                os.remove(old)
+        os.environ[TRACE_ENV] = directory
+    else:
+        os.environ.pop(TRACE_ENV, None)
+    with _trace_lock:
+        _trace_dir = directory or None
+        _trace_pid = None
+
+def _event(ph, name, cat, start, duration, args, lane=None):
+    event = {'ph':ph, 'name':name, 'cat':cat, 'ts':start*1e6}
+    if duration is not None:
+        event['dur'] = duration*1e6
+    if ph == 'i':
+        event['s'] = 't'
+    if args:
+        event['args'] = args
+    thread = threading.current_thread()
+    key, row = thread.ident, thread.name
+    with _trace_lock:
+        if _trace_dir is None:
+            return
+        global _trace_file, _trace_pid
+        if _trace_pid != os.getpid():
+            # first event of this process (or of a fork of it): its own
+            # file, line buffered so a worker that's killed loses nothing
+            _trace_file = open(os.path.join(_trace_dir, 'events.%s.%i.jsonl'
+                               %(socket.gethostname(), os.getpid())), 'a', 1)
+            _trace_pid = os.getpid()
+            _tids.clear()
+            _lanes.clear()
+        if lane is not None:
+            # the first row of the lane that's been free since start
+            ends = _lanes.setdefault(lane, [])
+            free = [n for n, end in enumerate(ends) if end <= start]
+            n = free[0] if free else len(ends)
+            if not free:
+                ends.append(0.)
+            ends[n] = start + duration
+            key, row = (lane, n), '%s %i'%(lane, n+1)
+        if key not in _tids:
+            _tids[key] = len(_tids)
+            _trace_file.write(json.dumps({'ph':'M', 'name':'thread_name',
+                              'tid':_tids[key], 'args':{'name':row}})+'\n')
+        event['tid'] = _tids[key]
+        _trace_file.write(json.dumps(event)+'\n')
+
+def write_trace(directory, filename=None):
+    '''
+    Merge every process's events in directory into one Chrome trace
+    (directory/trace.json unless told otherwise); returns its name
+    '''
+    filename = filename or os.path.join(directory, 'trace.json')
+    events = []
+    for pid, path in enumerate(sorted(glob.glob(os.path.join(directory,
+                                                'events.*.jsonl')))):
+        # events.<host>.<pid>.jsonl
+        host, worker = os.path.basename(path)[7:-6].rsplit('.', 1)
+        events.append({'ph':'M', 'name':'process_name', 'pid':pid,
+                       'args':{'name':'%s pid %s'%(host, worker)}})
+        with open(path) as F:
+            for line in F:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the last line of a process that was killed mid-write
+                    continue
+                event['pid'] = pid
+                events.append(event)
+
+    starts = [e['ts'] for e in events if 'ts' in e]
+    t0 = min(starts) if starts else 0.
+    for event in events:
+        if 'ts' in event:
+            event['ts'] -= t0
+    with open(filename, 'w') as F:
+        json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, F)
+    return filename
+
+def timing_columns():
+    ''' The names of the columns columns() adds to a row '''
+    return ['t_'+name for name in STAGES] + ['t_total'] + \
+           ['n_'+name for name in COUNTERS]
+
+def is_timing(column):
+    return column.startswith('t_') or column.startswith('n_')
+
+def add_timings(row, columns):
+    '''
+    Add timing columns to a row, on top of any it already has (a galaxy
+    cleaned in one process and measured in another gets both)
+    '''
+    for name, value in columns.items():
+        row[name] = row.get(name, 0) + value
+    return row
+
+
+def _columns(rows):
+    # list of row dicts, structured array or Table -> {column: array}
+    if isinstance(rows, list):
+        names = []
+        for row in rows:
+            names.extend(k for k in row if k not in names)
+        get = lambda name: [row.get(name) for row in rows]
+    else:
+        names = list(getattr(rows, 'colnames', None) or rows.dtype.names)
+        get = lambda name: rows[name]
+    columns = {}
+    for name in names:
+        if is_timing(name):
+            values = [np.nan if v is None else v for v in get(name)]
+            columns[name] = np.asarray(values, 'float')
+        elif name == 'name':
+            columns[name] = np.asarray(get(name)).astype(str)
+    return columns
+
+def timing_report(rows, top=5):
+    '''
+    Summary of a run's timing columns (rows: list of row dicts, a
+    structured array or a Table)
+    '''
+    columns = _columns(rows)
+    if 't_total' not in columns:
+        return 'no timing columns'
+    total = columns['t_total']
+    ok = np.isfinite(total)
+    if not ok.any():
+        return 'no timing columns'
+    total = total[ok]
+
+    lines = ['timings of %i galaxies: %.1fs in all, median %.2fs, 99th '
+             'percentile %.2fs, max %.2fs'%(len(total), total.sum(),
+             np.median(total), np.percentile(total, 99), total.max())]
+    lines.append('%-14s %9s %6s %8s %8s %8s %8s'%(
+                 'stage', 'total', 'share', 'median', '95th', '99th', 'max'))
+    stages = [name[2:] for name in sorted(columns)
+              if name.startswith('t_') and name != 't_total']
+    stages = [s for s in STAGES if s in stages] + \
+             [s for s in stages if s not in STAGES]
+    accounted = np.zeros(len(total))
+    for name in stages + ['other']:
+        if name == 'other':
+            t = total - accounted
+        else:
+            t = np.nan_to_num(columns['t_'+name][ok])
+            accounted += t
+        if not t.any():
+            continue
+        lines.append('%-14s %8.1fs %5.1f%% %7.3fs %7.3fs %7.3fs %7.3fs'%(
+                     name, t.sum(), 100*t.sum()/total.sum(), np.median(t),
+                     np.percentile(t, 95), np.percentile(t, 99), t.max()))
+
+    counters = [name for name in sorted(columns) if name.startswith('n_')]
+    counters = ['n_'+c for c in COUNTERS if 'n_'+c in counters] + \
+               [c for c in counters if c[2:] not in COUNTERS]
+    for name in counters:
+        n = np.nan_to_num(columns[name][ok])
+        if n.any():
+            lines.append('%-14s %12i in all, %.1f per galaxy, max %i'%(
+                         name[2:], n.sum(), n.mean(), n.max()))
+
+    if top:
+        names = columns.get('name', np.array(['']*len(ok)))[ok]
+        lines.append('slowest:')
+        for idx in np.argsort(total)[::-1][:top]:
+            times = [(np.nan_to_num(columns['t_'+s][ok][idx]), s)
+                     for s in stages]
+            seconds, worst = max(times) if times else (0., '')
+            lines.append('  %-40s %8.2fs (%s %.2fs)'%(names[idx],
+                         total[idx], worst, seconds))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a catalog's "
+                                     "timing columns")
+    parser.add_argument('catalog', type=str)
+    parser.add_argument('--top', type=int, default=10,
+                        help='How many of the slowest galaxies to list')
+    args = parser.parse_args()
+
+    from astropy.table import Table
+    print timing_report(Table.read(args.catalog), args.top)
+
+
+if __name__ == '__main__':
+    main()
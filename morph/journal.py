@@ -0,0 +1,176 @@
+'''
+Append-only result journal for the catalog drivers.
+
+Rewriting the whole catalog after every galaxy costs O(N) per galaxy, so
+O(N^2) for a run. Instead each galaxy's row is appended to a journal -- one
+JSON object per line, always carrying its objid -- and the file is fsync'ed
+every sync_every rows (or sync_seconds, whichever comes first). At the end
+(or whenever you like) compact() turns the journal into the real catalog.
+
+Resuming is exact: done_objids() says which galaxies already have a row no
+matter what order they were run in or where their files live now. A row
+cut off half-way by a crash is just ignored and that galaxy gets redone.
+'''
+
+import os
+import json
+import time
+import socket
+import numpy as np
+from astropy.table import Table
+
+from resulttable import fill_value
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+def _jsonify(value):
+    # numpy scalars/arrays don't know how to turn into JSON by themselves
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+def read_journal(path):
+    ''' Every complete row in a journal, in the order they were written '''
+    rows = []
+    if not os.path.isfile(path):
+        return rows
+    with open(path) as F:
+        for line in F:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                # half-written last line from a crash
+                continue
+    return rows
+
+def _drop_partial_line(path):
+    # cut a crash's half-written row off the end so the next row doesn't
+    # get glued onto it
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb+') as F:
+        F.seek(0, os.SEEK_END)
+        end = F.tell()
+        pos = end
+        while pos > 0:
+            step = min(4096, pos)
+            F.seek(pos-step)
+            chunk = F.read(step)
+            nl = chunk.rfind('\n')
+            if nl >= 0:
+                pos = pos-step+nl+1
+                break
+            pos -= step
+        if pos != end:
+            F.truncate(pos)
+
+
+class ResultJournal(object):
+
+    def __init__(self, path, sync_every=50, sync_seconds=30.):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+
+        self._done = set(int(row['objid']) for row in read_journal(path)
+                         if 'objid' in row)
+        _drop_partial_line(path)
+        self._F = open(path, 'a')
+        self._unsynced = 0
+        self._lastsync = time.time()
+
+    def __len__(self):
+        return len(self._done)
+
+    def __contains__(self, objid):
+        return int(objid) in self._done
+
+    def done_objids(self):
+        return set(self._done)
+
+    def append(self, row):
+        ''' Add one galaxy's row (a dict which has to include objid) '''
+        objid = int(row['objid'])
+        line = json.dumps(row, default=_jsonify)
+        self._F.write(line+'\n')
+        self._F.flush()
+        self._done.add(objid)
+
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_every) or \
+           (time.time()-self._lastsync >= self.sync_seconds):
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._F.fileno())
+        self._unsynced = 0
+        self._lastsync = time.time()
+
+    def close(self):
+        if not self._F.closed:
+            self.sync()
+            self._F.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def compact(journal, catalog_name, dtype=None):
+    '''
+    Write the final catalog from a journal (or list of journals): one row
+    per objid -- the latest one if a galaxy was measured more than once,
+    though a row that failed never replaces one that didn't.
+    dtype(column name) gives each column's type -- e.g.
+    galaxyMorphology.column_dtype; otherwise astropy guesses.
+    Returns the Table.
+    '''
+    if isinstance(journal, basestring):
+        journal = [journal]
+    latest = {}
+    order = []
+    for path in journal:
+        for row in read_journal(path):
+            objid = int(row['objid'])
+            if objid not in latest:
+                order.append(objid)
+            elif row.get('failcode') and not latest[objid].get('failcode'):
+                continue
+            latest[objid] = row
+
+    rows = [latest[o] for o in order]
+    if not rows:
+        log.warning("Nothing in %s to write to %s", ', '.join(journal),
+                    catalog_name)
+        return Table()
+    names = []
+    for row in rows:
+        for key in row:
+            if key not in names:
+                names.append(key)
+
+    columns = []
+    for key in names:
+        if dtype is not None:
+            # rows without this column (e.g. galaxies that failed) get
+            # the column's blank value
+            blank = fill_value(dtype(key))
+            values = [row.get(key) for row in rows]
+            values = [blank if v is None else v for v in values]
+            columns.append(np.array(values, dtype=dtype(key)))
+        else:
+            values = [row.get(key, np.nan) for row in rows]
+            columns.append([np.nan if v is None else v for v in values])
+    t = Table(columns, names=names)
+
+    # write beside the catalog then swap it in, keeping the catalog's own
+    # extension so astropy can tell which format it's meant to be
+    root, ext = os.path.splitext(catalog_name)
+    tmp = root+'.tmp%s.%i'%(socket.gethostname(), os.getpid())+ext
+    t.write(tmp, overwrite=True)
+    os.rename(tmp, catalog_name)
+    return t
@@ -0,0 +1,102 @@
+'''
+Load the heavy parts of morph the first time they're used.
+
+Measuring only needs the numerical core, but plotting (galaxyPlots pulls in
+matplotlib, skimage, pyfits and astropy.visualization) and extraction
+(clean, run_sextractor) used to be star-imported by every process that did
+`import morph` -- every pool/joblib worker paid for the whole plotting
+stack whether or not it ever drew a figure.
+
+install() swaps the package in sys.modules for a LazyPackage that knows
+which submodule each of the lazy names lives in -- the names in each
+submodule's __all__, read from its source rather than by importing it --
+and imports that one submodule the first time one of its names is asked
+for. morph.galaxyPlots.plot, morph.clean_frame and
+morph.SERunner all work as before; they just cost nothing until somebody
+asks for them. Any other name is an AttributeError straight away -- a
+typo or a hasattr() doesn't go importing matplotlib to find out.
+'''
+
+import os
+import sys
+import ast
+import types
+import importlib
+
+
+def exported_names(filename):
+    '''
+    A module's __all__ without importing the module. It has to be a list 
+    of strings assigned at the top level; no __all__ means no names.
+    '''
+    with open(filename) as F:
+        source = F.read()
+    # the whole file through ast costs more than the imports being saved
+    start = source.find('\n__all__ = [')
+    if start < 0:
+        return []
+    start = source.index('[', start)
+    return ast.literal_eval(source[start:source.index(']', start)+1])
+
+
+class LazyPackage(types.ModuleType):
+
+    def __init__(self, module, lazy):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # the real package keeps running its __init__ (and its globals die
+        # with it) -- hang on to it
+        self._module = module
+        self._lazy = sorted(lazy)
+        # name -> the submodule it comes from
+        self._exports = {}
+        here = os.path.dirname(module.__file__)
+        for sub in self._lazy:
+            for name in exported_names(os.path.join(here, sub+'.py')):
+                if name in self._exports:
+                    raise ValueError('%s is exported by both %s and %s'%(
+                                     name, self._exports[name], sub))
+                self._exports[name] = sub
+
+    def _load(self, sub):
+        return importlib.import_module(self.__name__+'.'+sub)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        # whatever __init__ has imported since install()
+        if name in self._module.__dict__:
+            return self._module.__dict__[name]
+        if name in self._lazy:
+            return self._load(name)
+        if name in self._exports:
+            value = getattr(self._load(self._exports[name]), name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError("'module' object has no attribute '%s'"%name)
+
+    def __reduce__(self):
+        # pickle (cloudpickle, for joblib) only knows plain modules by
+        # reference: anything else would go by value, __dict__ and all
+        return importlib.import_module, (self.__name__,)
+
+    def finish(self):
+        ''' Pick up everything __init__ imported eagerly (for dir() & co.) '''
+        for name, value in self._module.__dict__.items():
+            self.__dict__.setdefault(name, value)
+
+    def loaded(self):
+        ''' Which of the lazy submodules have been imported so far '''
+        return [sub for sub in self._lazy
+                if self.__name__+'.'+sub in sys.modules]
+
+
+def install(name, lazy):
+    '''
+    Call at the top of a package's __init__: name is __name__, lazy the
+    submodules to hold back (the package exports each one's __all__).
+    Returns the LazyPackage now in sys.modules.
+    '''
+    package = LazyPackage(sys.modules[name], lazy)
+    sys.modules[name] = package
+    return package
@@ -0,0 +1,204 @@
+'''
+File-based coordinator for spreading one manifest over several machines.
+
+Everything lives in one directory on a filesystem all the nodes can see,
+and every state change is a rename, which either happens or doesn't no
+matter how many nodes try at once:
+
+    coord/manifest.txt           -- every galaxy, one per line
+    coord/todo/00042.txt         -- a shard nobody is working on
+    coord/claimed/00042.<node>   -- a shard <node> holds the lease on; its
+                                    mtime is the node's last heartbeat
+    coord/done/00042.txt         -- a finished shard
+    coord/results/00042.<node>.journal
+                                 -- rows <node> measured for that shard
+
+A node claims a shard by renaming it out of todo/ (only one rename can
+win), touches it every heartbeat seconds while it works, and renames it
+into done/ (or back into todo/ if it fails). A lease whose heartbeat is
+older than lease_seconds belongs to a node that died: the next node to
+come looking for work puts it back in todo/. If the slow node turns up
+after all, both sets of rows end up in results/ and merge() keeps one row
+per objid.
+
+Testing on one machine is just starting a few nodes with different names
+on the same directory.
+'''
+
+import os
+import glob
+import time
+import shutil
+import socket
+import threading
+
+from journal import ResultJournal, read_journal, compact
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+def node_name():
+    return '%s.%i'%(socket.gethostname(), os.getpid())
+
+def _shard(path):
+    return os.path.basename(path).split('.')[0]
+
+
+class Lease(object):
+    ''' One claimed shard: its items, heartbeat and results journal '''
+
+    def __init__(self, coord, path, heartbeat=30.):
+        self.coord = coord
+        self.path = path
+        self.shard = _shard(path)
+        self.lost = False
+
+        with open(path) as F:
+            self.items = [line.rstrip('\n') for line in F if line.strip()]
+        self.results = os.path.join(coord.path, 'results',
+                                    '%s.%s.journal'%(self.shard, coord.node))
+
+        self._stop = threading.Event()
+        self._beat = threading.Thread(target=self._heartbeat,
+                                      args=(heartbeat,))
+        self._beat.daemon = True
+        self._beat.start()
+
+    def _heartbeat(self, every):
+        while not self._stop.wait(every):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                # somebody decided we were dead and took the shard back
+                self.lost = True
+                return
+
+    def done_objids(self):
+        ''' objids of this shard that any node has already measured '''
+        done = set()
+        for journal in glob.glob(os.path.join(self.coord.path, 'results',
+                                              self.shard+'.*.journal')):
+            done.update(int(row['objid']) for row in read_journal(journal)
+                        if 'objid' in row)
+        return done
+
+    def journal(self):
+        return ResultJournal(self.results)
+
+    def _end(self, where):
+        self._stop.set()
+        self._beat.join()
+        try:
+            os.rename(self.path, where)
+            return True
+        except OSError:
+            self.lost = True
+            return False
+
+    def complete(self):
+        return self._end(os.path.join(self.coord.path, 'done',
+                                      self.shard+'.txt'))
+
+    def release(self):
+        ''' Give the shard back (e.g. this node is going down) '''
+        return self._end(os.path.join(self.coord.path, 'todo',
+                                      self.shard+'.txt'))
+
+
+class LeaseCoordinator(object):
+
+    def __init__(self, path, node=None, lease_seconds=600., heartbeat=30.):
+        self.path = path
+        self.node = node or node_name()
+        self.lease_seconds = lease_seconds
+        self.heartbeat = heartbeat
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, 'manifest.txt'))
+
+    def create(self, items, shard_size=100):
+        '''
+        Lay out the shards for items unless some node already has. The
+        whole directory is built under a temporary name and renamed into
+        place, so the other nodes either see all of it or none of it.
+        Returns True if this node made it.
+        '''
+        if self.exists():
+            return False
+        tmp = self.path.rstrip('/')+'.%s.tmp'%self.node
+        for sub in ['todo', 'claimed', 'done', 'results']:
+            os.makedirs(os.path.join(tmp, sub))
+        with open(os.path.join(tmp, 'manifest.txt'), 'w') as F:
+            for item in items:
+                F.write('%s\n'%item)
+        for n, start in enumerate(range(0, len(items), shard_size)):
+            with open(os.path.join(tmp, 'todo', '%05i.txt'%n), 'w') as F:
+                for item in items[start:start+shard_size]:
+                    F.write('%s\n'%item)
+        try:
+            os.rename(tmp, self.path)
+            return True
+        except OSError:
+            # lost the race to another node
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+
+    def _ls(self, sub):
+        return sorted(glob.glob(os.path.join(self.path, sub, '*')))
+
+    def requeue_stale(self):
+        ''' Put shards whose node stopped heartbeating back in todo/ '''
+        now = time.time()
+        for path in self._ls('claimed'):
+            try:
+                if now - os.path.getmtime(path) > self.lease_seconds:
+                    os.rename(path, os.path.join(self.path, 'todo',
+                                                 _shard(path)+'.txt'))
+                    log.info("Requeued stale lease %s",
+                             os.path.basename(path))
+            except OSError:
+                # finished or requeued by someone else in the meantime
+                pass
+
+    def claim(self):
+        ''' A Lease on the next free shard, None if there isn't one '''
+        for attempt in range(2):
+            for path in self._ls('todo'):
+                mine = os.path.join(self.path, 'claimed',
+                                    '%s.%s'%(_shard(path), self.node))
+                try:
+                    os.rename(path, mine)
+                except OSError:
+                    continue
+                os.utime(mine, None)
+                return Lease(self, mine, self.heartbeat)
+            self.requeue_stale()
+        return None
+
+    def finished(self):
+        return not self._ls('todo') and not self._ls('claimed')
+
+    def progress(self):
+        return dict((sub, len(self._ls(sub)))
+                    for sub in ['todo', 'claimed', 'done'])
+
+    def leases(self, poll=10.):
+        '''
+        Lease after lease until every shard is done; waits (polling every
+        poll seconds) while other nodes still hold leases that might yet
+        come back
+        '''
+        while True:
+            lease = self.claim()
+            if lease is not None:
+                yield lease
+            elif self.finished():
+                return
+            else:
+                time.sleep(poll)
+
+    def merge(self, catalog_name, dtype=None):
+        ''' One catalog out of every node's results, one row per objid '''
+        journals = self._ls('results')
+        return compact(journals, catalog_name, dtype)
@@ -0,0 +1,302 @@
+'''
+Logging for the pipeline instead of print.
+
+Every module logs to its own logger --
+
+    log = get_logger(__name__)
+    log.debug("calculating Asymmetry...")
+    log.warning("Asymmetry center didn't settle after %i steps", max_steps)
+
+-- under the 'morph' logger, which this sets up. Batch runs are quiet by
+default: warnings and errors go to stderr, progress (debug, info) goes
+nowhere and costs a level check. log_to(level, directory) changes that
+for this process and every process started from it afterwards (it goes
+through the environment, like trace_to), so joblib and multiprocessing
+workers log the same way without being told:
+
+    log_to('info', 'logs/')
+
+With a directory each process also writes its own
+directory/<host>.<pid>.log, and one JSON line per galaxy to
+directory/galaxies.<host>.<pid>.jsonl: its name, objid, how long it
+took and where the time went, whether it raised and the first few
+warnings and errors logged while it was measured (measuring() in
+instrument.py starts and finishes the records). `python -m morph.logs
+logs/` sums them up: failures, and which messages came up for how many
+galaxies.
+
+The same message (same logger and format string) is let through at
+most RATE_BURST times every RATE_INTERVAL seconds per process; the next
+one that gets through says how many were dropped. 30 workers hitting
+the same failure don't bury everything else.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+
+
+LEVEL_ENV = 'MORPH_LOG_LEVEL'
+DIR_ENV = 'MORPH_LOG_DIR'
+DEFAULT_LEVEL = 'warning'
+RATE_BURST = 10
+RATE_INTERVAL = 60.
+# messages kept in each galaxy's record
+GALAXY_MESSAGES = 20
+
+CONSOLE_FORMAT = '%(levelname)s %(name)s: %(message)s'
+FILE_FORMAT = '%(asctime)s %(process)d %(threadName)s %(levelname)s ' \
+              '%(name)s: %(message)s'
+
+
+def get_logger(name):
+    ''' The logger of a module (__name__) or driver, under 'morph' '''
+    if not name.startswith('morph'):
+        name = 'morph.'+name
+    return logging.getLogger(name)
+
+def level_number(level):
+    if isinstance(level, basestring):
+        return logging.getLevelName(level.upper())
+    return level
+
+
+class RateLimit(logging.Filter):
+    '''
+    Let through at most burst records of each logger and format string
+    every interval seconds. Share one between handlers: a record is only
+    counted once.
+    '''
+
+    def __init__(self, burst=RATE_BURST, interval=RATE_INTERVAL):
+        logging.Filter.__init__(self)
+        self.burst, self.interval = burst, interval
+        self._seen = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        decided = getattr(record, '_rate_limited', None)
+        if decided is not None:
+            return decided
+        key = (record.name, str(record.msg))
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                # a fork: it hasn't said anything yet
+                self._seen, self._pid = {}, os.getpid()
+            start, n, dropped = self._seen.get(key, (now, 0, 0))
+            if now - start > self.interval:
+                start, n = now, 0
+            keep = n < self.burst
+            if keep and dropped:
+                record.msg = '%s [%i more like this dropped]'%(record.msg,
+                                                                dropped)
+                dropped = 0
+            self._seen[key] = (start, n+1, dropped + (not keep))
+        record._rate_limited = keep
+        return keep
+
+
+class WorkerFileHandler(logging.FileHandler):
+    ''' directory/<host>.<pid>.log of whichever process is logging '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._pid = os.getpid()
+        logging.FileHandler.__init__(self, self._filename(), delay=True)
+
+    def _filename(self):
+        return os.path.join(self.directory, '%s.%i.log'
+                            %(socket.gethostname(), os.getpid()))
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            # a fork: its own file from now on
+            self.stream = None
+            self.baseFilename = os.path.abspath(self._filename())
+            self._pid = os.getpid()
+        logging.FileHandler.emit(self, record)
+
+
+_level = None
+_log_dir = None
+_limit = RateLimit()
+_handlers = []
+
+def _configure(level, directory):
+    global _level, _log_dir
+    root = logging.getLogger('morph')
+    for handler in _handlers:
+        root.removeHandler(handler)
+        handler.close()
+    del _handlers[:]
+
+    _level = level_number(level)
+    _log_dir = directory or None
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    _handlers.append(console)
+    if _log_dir:
+        if not os.path.isdir(_log_dir):
+            os.makedirs(_log_dir)
+        _handlers.append(WorkerFileHandler(_log_dir))
+        _handlers[-1].setFormatter(logging.Formatter(FILE_FORMAT))
+        # galaxy records want the warnings whatever the level
+        _handlers.append(GalaxyHandler(logging.WARNING))
+    for handler in _handlers:
+        if not isinstance(handler, GalaxyHandler):
+            handler.addFilter(_limit)
+            handler.setLevel(_level)
+        root.addHandler(handler)
+    root.setLevel(min(_level, logging.WARNING) if _log_dir else _level)
+    root.propagate = False
+
+def log_to(level=None, directory=None):
+    '''
+    Log at level (a name or number; DEFAULT_LEVEL if None) to stderr and,
+    given a directory, into per-process files and galaxy records there --
+    in this process and every process started from it from now on
+    '''
+    level = level or DEFAULT_LEVEL
+    os.environ[LEVEL_ENV] = str(logging.getLevelName(level_number(level)))
+    if directory:
+        os.environ[DIR_ENV] = directory
+    else:
+        os.environ.pop(DIR_ENV, None)
+    _configure(level, directory)
+
+def joblib_verbose():
+    ''' What to tell joblib: a line per task only when logging info '''
+    return 51 if _level <= logging.INFO else 0
+
+
+# galaxy records
+
+_local = threading.local()
+_records = None
+_records_pid = None
+_records_lock = threading.Lock()
+
+class GalaxyHandler(logging.Handler):
+    ''' Keeps warnings and errors with the galaxy being measured '''
+
+    def emit(self, record):
+        galaxy = getattr(_local, 'galaxy', None)
+        if galaxy is None:
+            return
+        galaxy['warnings' if record.levelno < logging.ERROR
+               else 'errors'] += 1
+        if len(galaxy['messages']) < GALAXY_MESSAGES:
+            galaxy['messages'].append([record.levelname, record.name,
+                                       str(record.msg), record.getMessage()])
+
+def galaxy_started(item):
+    '''
+    Start collecting this thread's galaxy record (item: what measuring()
+    was given, as Probe.item); returns the record it replaces
+    '''
+    if _log_dir is None:
+        return None
+    previous = getattr(_local, 'galaxy', None)
+    _local.galaxy = dict(item, warnings=0, errors=0, messages=[])
+    return previous
+
+def galaxy_finished(probe, error=None, previous=None):
+    ''' Write this thread's galaxy record (with probe's timings) '''
+    galaxy = getattr(_local, 'galaxy', None)
+    _local.galaxy = previous
+    if _log_dir is None or galaxy is None:
+        return
+    galaxy.update({'time':time.strftime('%Y-%m-%dT%H:%M:%S',
+                                        time.localtime(probe.started)),
+                   'host':socket.gethostname(), 'pid':os.getpid(),
+                   'seconds':round(probe.total(), 4),
+                   'status':'ok' if error is None else 'failed'})
+    if error is not None:
+        galaxy['error'] = repr(error)
+    galaxy['stages'] = dict((name, round(seconds, 4)) for name, seconds
+                            in probe.times.items() if seconds)
+    galaxy['counts'] = dict((name, n) for name, n in probe.counts.items()
+                            if n)
+    global _records, _records_pid
+    with _records_lock:
+        if _records_pid != os.getpid():
+            _records = open(os.path.join(_log_dir, 'galaxies.%s.%i.jsonl'
+                            %(socket.gethostname(), os.getpid())), 'a', 1)
+            _records_pid = os.getpid()
+        _records.write(json.dumps(galaxy)+'\n')
+
+def read_records(directory):
+    ''' Every galaxy record in directory '''
+    import glob
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory,
+                                              'galaxies.*.jsonl'))):
+        with open(path) as F:
+            for line in F:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the last line of a process that was killed mid-write
+                    continue
+    return records
+
+def records_report(records, top=10):
+    ''' Failures and the most common messages of a run's galaxy records '''
+    if not records:
+        return 'no galaxy records'
+    failed = [r for r in records if r.get('status') != 'ok']
+    lines = ['%i galaxies, %i failed, %i with warnings, %i with errors'%(
+             len(records), len(failed),
+             sum(1 for r in records if r.get('warnings')),
+             sum(1 for r in records if r.get('errors')))]
+
+    errors = {}
+    for r in failed:
+        kind = r.get('error', '?').split('(')[0]
+        errors.setdefault(kind, []).append(r.get('name'))
+    if errors:
+        lines.append('failures:')
+        for kind, names in sorted(errors.items(), key=lambda e: -len(e[1])):
+            lines.append('  %6i %-30s e.g. %s'%(len(names), kind, names[0]))
+
+    messages = {}
+    for r in records:
+        seen = set()
+        for level, logger, template, text in r.get('messages', []):
+            key = (level, logger, template)
+            if key not in messages:
+                messages[key] = [0, text]
+            if key not in seen:
+                messages[key][0] += 1
+                seen.add(key)
+    if messages:
+        lines.append('most common messages (galaxies):')
+        for (level, logger, template), (n, text) in sorted(messages.items(),
+                key=lambda m: -m[1][0])[:top]:
+            lines.append('  %6i %-8s %-28s %s'%(n, level, logger, text))
+    return '\n'.join(lines)
+
+
+_configure(os.environ.get(LEVEL_ENV, DEFAULT_LEVEL),
+           os.environ.get(DIR_ENV))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sum up the galaxy records '
+                                     'of a run logged with --log-dir')
+    parser.add_argument('directory', type=str)
+    parser.add_argument('--top', type=int, default=10,
+                        help='How many of the most common messages to list')
+    args = parser.parse_args()
+    print records_report(read_records(args.directory), args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+'''
+Numerical parity of GalaxyMorphology's diagnostics across implementations.
+
+A faster way of measuring something (different interpolation, shifting,
+aperture weights...) has to give the same catalog. Each diagnostic has
+its legacy implementation -- the GalaxyMorphology method -- registered
+here under 'legacy', and a replacement is registered next to it under a
+name of its own:
+
+    @parity.implementation('asymmetry', 'new')
+    def fast_asymmetry(g, image, apertures):
+        ...
+        return {'A':A, 'Ax':Ax, 'Ay':Ay}
+
+An implementation gets a GalaxyMorphology (a copy; set anything on it),
+the image it was measured on and the apertures the disabled block of
+GalaxyMorphology.__init__ would have made ('ell' around the stamp
+centre, 'gell' around the galaxy) and returns its catalog columns.
+
+check_parity() then runs both on the same stamps -- a fixed sample of
+synthetic ones (morph/synthetic.py) unless given datacubes -- one
+diagnostic after another, with the inputs of each (Rp, the asymmetry
+centre...) taken from legacy so differences don't pile up. Every
+column is compared to TOLERANCES and every diagnostic timed, so the
+report says both whether the science moved and how much faster it got:
+
+    python -m morph.parity --candidate new
+
+exits 1 when any column is out of tolerance. Diagnostics without the
+candidate are run with legacy twice, which is at least a check that
+they're deterministic.
+'''
+
+import os
+import sys
+import copy
+import time
+import glob
+import random
+import shutil
+import argparse
+import tempfile
+import warnings
+import numpy as np
+import astropy.io.fits as fits
+from photutils import EllipticalAperture
+
+import morph
+
+
+# (absolute, relative): a column is out when |new - legacy| is more than
+# absolute + relative*|legacy|
+TOLERANCES = {'Rp':(0.05, 0.005), 'C':(0.02, 0.), 'A':(0.005, 0.),
+              'G':(0.002, 0.), 'M20':(0.01, 0.),
+              'Mx':(0.5, 0.), 'My':(0.5, 0.), 'Ax':(0.1, 0.), 'Ay':(0.1, 0.)}
+
+# in the order GalaxyMorphology measures them (concentration is centred
+# on the asymmetry centre)
+DIAGNOSTICS = ['petrosian', 'asymmetry', 'concentration', 'gini', 'm20']
+
+# the fixed sample: (n, re, clump, companions, stars)
+SAMPLE = [(1., 4., 0., [], []),
+          (1., 8., 0.15, [(4., 0.5)], []),
+          (2.5, 6., 0.1, [], [(5., 2.)]),
+          (4., 4., 0., [], []),
+          (4., 8., 0.05, [(3., 0.3)], [(6., 1.)]),
+          (1.5, 5., 0.25, [], [])]
+
+_implementations = dict((name, {}) for name in DIAGNOSTICS)
+
+
+def implementation(diagnostic, name):
+    ''' Register the decorated function as `name`'s way of a diagnostic '''
+    def register(func):
+        _implementations[diagnostic][name] = func
+        return func
+    return register
+
+def implementations(diagnostic):
+    return sorted(_implementations[diagnostic])
+
+
+@implementation('petrosian', 'legacy')
+def _petrosian(g, image, apertures):
+    Rp, Rp_SB, Rpflag = g.get_petro_ell2(image)
+    return {'Rp':Rp}
+
+@implementation('asymmetry', 'legacy')
+def _asymmetry(g, image, apertures):
+    A, Ax, Ay = g.get_asymmetry(image, apertures['ell'], save_residual=False)
+    return {'A':A, 'Ax':Ax, 'Ay':Ay}
+
+@implementation('concentration', 'legacy')
+def _concentration(g, image, apertures):
+    r20, r50, r80, C = g.get_concentration_ell(image)
+    return {'C':C}
+
+@implementation('gini', 'legacy')
+def _gini(g, image, apertures):
+    [G] = g.get_gini1(image, [apertures['gell']])
+    return {'G':G}
+
+@implementation('m20', 'legacy')
+def _m20(g, image, apertures):
+    [M20], Mx, My = g.get_m20(image, apertures['gell'])
+    return {'M20':M20, 'Mx':Mx, 'My':My}
+
+
+def apertures(g, image):
+    ''' The apertures GalaxyMorphology measures A, G and M20 in '''
+    return {'ell':EllipticalAperture((g.xc, g.yc), g.Rp, g.Rp/g.e, g.theta),
+            'gell':morph.MyEllipticalAperture((g.x, g.y), g.Rp, g.Rp/g.e,
+                                              g.theta, image)}
+
+def within(legacy, new, tolerance):
+    if legacy == new:
+        # including the same infinity
+        return True
+    if np.isnan(legacy) or np.isnan(new):
+        return bool(np.isnan(legacy) and np.isnan(new))
+    absolute, relative = tolerance
+    return abs(new - legacy) <= absolute + relative*abs(legacy)
+
+
+def sample_stamps(outdir, sample=SAMPLE, scale=4):
+    ''' Write the fixed sample of synthetic stamps; their datacubes '''
+    from synthetic import make_stamp, write_datacube
+    filenames = []
+    for index, (n, re, clump, companions, stars) in enumerate(sample):
+        stamp = make_stamp(n=n, re=re, clump=clump, companions=companions,
+                           stars=stars, scale=scale, seed=index, index=index,
+                           tag='parity')
+        filenames.append(write_datacube(stamp, outdir))
+    return filenames
+
+
+def _run(func, g, image, aper, seed, repeat):
+    # fastest of repeat runs, on fresh copies seeded the same (the
+    # background asymmetry draws noise); the result of the last
+    best, result = np.inf, {}
+    for _ in range(repeat):
+        mine = copy.copy(g)
+        random.seed(seed)
+        np.random.seed(seed)
+        start = time.time()
+        result = func(mine, image, aper)
+        best = min(best, time.time() - start)
+    return result, best
+
+def compare_stamp(filename, outdir, candidate='new', repeat=1):
+    '''
+    Legacy and candidate values of every column and the time of every
+    diagnostic for one datacube:
+    ({column: (legacy, new)}, {diagnostic: (legacy s, new s, new name)})
+    '''
+    hdulist = fits.open(filename)
+    try:
+        g = morph.GalaxyMorphology(hdulist, filename, np.zeros(4), outdir)
+        image = morph.read_galaxy(hdulist)[0]
+    finally:
+        hdulist.close()
+    seed = int(g.objid % 2**31)
+
+    values, times = {}, {}
+    aper = None
+    for diagnostic in DIAGNOSTICS:
+        if diagnostic != 'petrosian':
+            if np.isnan(g.Rp):
+                break
+            aper = aper or apertures(g, image)
+        legacy = _implementations[diagnostic]['legacy']
+        func = _implementations[diagnostic].get(candidate, legacy)
+        name = candidate if func is not legacy else 'legacy'
+        old, t_old = _run(legacy, g, image, aper, seed, repeat)
+        new, t_new = _run(func, g, image, aper, seed, repeat)
+        for column in old:
+            values[column] = (float(old[column]),
+                              float(new.get(column, np.nan)))
+            # what the next diagnostics are measured with
+            setattr(g, column, old[column])
+        times[diagnostic] = (t_old, t_new, name)
+    return values, times
+
+
+class ParityReport(object):
+    ''' What check_parity found; str() of it is the report '''
+
+    def __init__(self, candidate, tolerances):
+        self.candidate = candidate
+        self.tolerances = tolerances
+        self.stamps = []
+
+    def add(self, filename, values, times):
+        self.stamps.append((filename, values, times))
+
+    def failures(self):
+        ''' (stamp name, column, legacy, new) of everything out of tolerance '''
+        out = []
+        for filename, values, times in self.stamps:
+            for column, (old, new) in sorted(values.items()):
+                if column in self.tolerances and \
+                   not within(old, new, self.tolerances[column]):
+                    out.append((os.path.basename(filename), column, old, new))
+        return out
+
+    @property
+    def passed(self):
+        return not self.failures()
+
+    def __str__(self):
+        lines = ['parity of %r against legacy on %i stamps'%(self.candidate,
+                                                          len(self.stamps))]
+        lines.append('%-6s %12s %12s %16s %6s  %s'%('column', 'max |diff|',
+                     'median', 'tolerance', 'out', ''))
+        for column in sorted(self.tolerances):
+            diffs = []
+            out = 0
+            for filename, values, times in self.stamps:
+                if column not in values:
+                    continue
+                old, new = values[column]
+                if old == new or (np.isnan(old) and np.isnan(new)):
+                    diffs.append(0.)
+                else:
+                    diffs.append(abs(new - old) if np.isfinite(new - old)
+                                 else np.inf)
+                out += not within(old, new, self.tolerances[column])
+            if not diffs:
+                continue
+            absolute, relative = self.tolerances[column]
+            tolerance = '%g'%absolute + ('+%g*|x|'%relative if relative
+                                          else '')
+            lines.append('%-6s %12.3g %12.3g %16s %6i  %s'%(column, max(diffs),
+                         np.median(diffs), tolerance, out,
+                         'ok' if not out else 'FAIL'))
+
+        lines.append('%-14s %10s %10s %8s'%('diagnostic', 'legacy', 'new',
+                                             'speedup'))
+        for diagnostic in DIAGNOSTICS:
+            runs = [times[diagnostic] for f, v, times in self.stamps
+                    if diagnostic in times]
+            if not runs:
+                continue
+            old = sum(r[0] for r in runs)
+            new = sum(r[1] for r in runs)
+            names = set(r[2] for r in runs)
+            lines.append('%-14s %9.3fs %9.3fs %7.2fx%s'%(diagnostic, old, new,
+                         old/new if new else np.inf,
+                         '' if self.candidate in names
+                         else '  (no %r: legacy twice)'%self.candidate))
+
+        failures = self.failures()
+        if failures:
+            lines.append('out of tolerance:')
+            for name, column, old, new in failures:
+                lines.append('  %-36s %-4s legacy %-12.6g new %.6g'%(name,
+                             column, old, new))
+        lines.append('PASSED' if not failures else
+                     'FAILED (%i values out of tolerance)'%len(failures))
+        return '\n'.join(lines)
+
+
+def check_parity(filenames=None, candidate='new', tolerances=TOLERANCES,
+                 repeat=1, workdir=None):
+    '''
+    Run legacy and candidate side by side on the given datacubes (the
+    fixed synthetic sample if None); a ParityReport
+    '''
+    cleanup = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(
+        prefix='morph_parity_'))+'/'
+    try:
+        if filenames is None:
+            filenames = sample_stamps(workdir+'stamps/')
+        report = ParityReport(candidate, tolerances)
+        for filename in filenames:
+            values, times = compare_stamp(filename, workdir+'out/',
+                                          candidate, repeat)
+            report.add(filename, values, times)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a new '
+        "implementation of GalaxyMorphology's diagnostics gives the legacy "
+        'values, and time both')
+    parser.add_argument('--candidate', type=str, default='new',
+        help='Name the new implementations are registered under')
+    parser.add_argument('--module', type=str, nargs='*', default=[],
+        help='Modules to import first (that register implementations)')
+    parser.add_argument('--files', type=str, default=None,
+        help='Glob of datacubes to use instead of the synthetic sample')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='Time each diagnostic this many times and keep the fastest')
+    parser.add_argument('--workdir', type=str, default=None,
+        help='Where the stamps and output go (default: a temporary '
+             'directory that is removed afterwards)')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    for module in args.module:
+        __import__(module)
+
+    # run as python -m this is __main__; the implementations were
+    # registered with morph.parity
+    from morph import parity
+    filenames = sorted(glob.glob(args.files)) if args.files else None
+    report = parity.check_parity(filenames, args.candidate, repeat=args.repeat,
+                          workdir=args.workdir)
+    print report
+    sys.exit(0 if report.passed else 1)
+
+
+if __name__ == '__main__':
+    main()
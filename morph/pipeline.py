@@ -0,0 +1,195 @@
+'''
+Staged pipeline: discovery -> stage -> stage -> ... -> the caller.
+
+Each Stage has its own pool of workers (processes by default, threads for
+anything that's just waiting on I/O) and the stages are joined by bounded
+queues, so while one stage is stuck waiting on SExtractor or the disk the
+next one keeps its CPUs busy -- and a fast stage can only run queue_size
+items ahead of a slow one before it has to wait.
+
+    stages = [Stage('clean', clean_job, (args,), workers=8),
+              Stage('measure', measure_job, (args,), workers=16)]
+    for out in Pipeline(stages).run(cutouts):
+        write it down
+
+A stage function takes (*args, item) and returns the item for the next
+stage, or None to drop it. If it raises, the traceback is logged, the
+item is dropped and the stage's failed count goes up.
+
+Every report_every seconds (and at the end) a report says, per stage, how
+many items went through, how fast, how many are queued up in front of it
+and how busy its workers were; the busiest stage is the bottleneck.
+'''
+
+import sys
+import time
+import threading
+import Queue
+
+from logs import get_logger
+from scheduler import END_OF_STREAM as _END, call_safely, interruptible_get
+from scheduler import WorkerPool
+
+log = get_logger(__name__)
+
+
+class Stage(object):
+
+    def __init__(self, name, func, args=(), workers=1, threads=False,
+                 queue_size=None):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.workers = max(1, int(workers))
+        self.threads = threads
+        self.queue_size = queue_size or 2*self.workers
+
+        self.done = self.failed = 0
+        self.busy = 0.
+        self._lock = threading.Lock()
+
+    def _count(self, seconds, error):
+        with self._lock:
+            self.done += 1
+            self.busy += seconds
+            if error is not None:
+                self.failed += 1
+                log.error("Stage %s failed:\n%s", self.name, error)
+
+    def start(self, inq, outq):
+        ''' Start pulling from inq and pushing to outq '''
+        self.inq, self.outq = inq, outq
+        if self.threads:
+            self._alive = self.workers
+            self._threads = [threading.Thread(target=self._thread_worker)
+                             for n in range(self.workers)]
+        else:
+            self._threads = [threading.Thread(target=self._feeder)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def make_pool(self):
+        # pools are forked before any pipeline thread exists
+        if not self.threads:
+            self.pool = WorkerPool(self.workers)
+
+    def terminate(self):
+        if not self.threads:
+            self.pool.terminate()
+
+    def _thread_worker(self):
+        while True:
+            item = self.inq.get()
+            if item is _END:
+                # leave it there for the other workers
+                self.inq.put(_END)
+                break
+            out, seconds, error = call_safely(self.func, self.args, item)
+            self._count(seconds, error)
+            if out is not None:
+                self.outq.put(out)
+
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last:
+            self.outq.put(_END)
+
+    def _feeder(self):
+        # hands items to the pool, never more than queue_size at once
+        slots = threading.BoundedSemaphore(self.queue_size)
+
+        def finished(result):
+            out, seconds, error = result
+            self._count(seconds, error)
+            slots.release()
+            if out is not None:
+                # blocks the pool's result thread when the next stage is
+                # full -- that's the back-pressure
+                self.outq.put(out)
+
+        while True:
+            item = self.inq.get()
+            if item is _END:
+                break
+            slots.acquire()
+            self.pool.submit(self.func, self.args, item, finished)
+        self.pool.finish()
+        self.outq.put(_END)
+
+
+class Pipeline(object):
+
+    def __init__(self, stages, report_every=60., out=sys.stdout):
+        self.stages = stages
+        self.report_every = report_every
+        self.out = out
+        self.discovered = 0
+        self.finished = 0
+
+    def _discover(self, source, q):
+        for item in source:
+            q.put(item)
+            self.discovered += 1
+        q.put(_END)
+
+    def _reporter(self, stop):
+        while not stop.wait(self.report_every):
+            print >> self.out, self.report()
+
+    def report(self):
+        ''' Throughput, backlog and utilization of every stage '''
+        elapsed = max(time.time() - self.t0, 1e-9)
+        lines = ['pipeline: %i discovered, %i finished in %.0fs'
+                 %(self.discovered, self.finished, elapsed)]
+        for s in self.stages:
+            util = s.busy/(s.workers*elapsed)
+            lines.append('  %-10s workers %3i  done %7i  failed %5i  '
+                         '%7.2f/s  backlog %4i/%-4i  busy %3.0f%%'
+                         %(s.name, s.workers, s.done, s.failed,
+                           s.done/elapsed, s.inq.qsize(), s.inq.maxsize,
+                           100*util))
+        bottleneck = max(self.stages,
+                         key=lambda s: s.busy/(s.workers*elapsed))
+        lines.append('  bottleneck: %s'%bottleneck.name)
+        return '\n'.join(lines)
+
+    def run(self, source):
+        '''
+        Push everything in source through the stages; yields what comes
+        out of the last one as it comes out
+        '''
+        for s in self.stages:
+            s.make_pool()
+
+        self.t0 = time.time()
+        queues = [Queue.Queue(maxsize=s.queue_size) for s in self.stages]
+        final = Queue.Queue(maxsize=self.stages[-1].queue_size)
+        for s, inq, outq in zip(self.stages, queues, queues[1:]+[final]):
+            s.start(inq, outq)
+
+        discover = threading.Thread(target=self._discover,
+                                    args=(source, queues[0]))
+        discover.daemon = True
+        discover.start()
+
+        stop = threading.Event()
+        reporter = threading.Thread(target=self._reporter, args=(stop,))
+        reporter.daemon = True
+        reporter.start()
+
+        try:
+            while True:
+                item = interruptible_get(final)
+                if item is _END:
+                    break
+                self.finished += 1
+                yield item
+        except:
+            for s in self.stages:
+                s.terminate()
+            raise
+        finally:
+            stop.set()
+            print >> self.out, self.report()
@@ -0,0 +1,154 @@
+'''
+Read-ahead for going through datacubes one after another.
+
+Opening a datacube over NFS and pulling its pixels across takes about as
+long as measuring it, and a serial loop waits for every byte. Prefetcher
+reads the next few datacubes on a background thread while the current one
+is being measured, keeping only what GalaxyMorphology needs -- the image
+(UCLN or CLN), its row of CAT and FSEG -- and never holding more than
+`ahead` galaxies or max_bytes of pixels at once (it can go one galaxy over,
+since it doesn't know how big a galaxy is until it has read it).
+
+    for filename, galaxy in Prefetcher(filenames, ahead=4):
+        g = GalaxyMorphology(galaxy, filename, flags, outdir)
+
+A datacube that can't be read still comes out in its turn, and raises the
+original error as soon as anything tries to use it.
+'''
+
+import os
+import sys
+import time
+import threading
+import Queue
+import numpy as np
+import astropy.io.fits as fits
+
+import datacube
+from instrument import stage, span
+from scheduler import END_OF_STREAM as _END, interruptible_get
+
+
+PREFETCH_BYTES = 512*1024*1024
+
+
+class _Plane(object):
+    # enough of an ImageHDU for galaxyPlots: hdulist['CLN'].data
+    def __init__(self, data):
+        self.data = data
+
+
+class PrefetchedGalaxy(object):
+    '''
+    One datacube's worth of what GalaxyMorphology reads, already in memory.
+    Works wherever a datacube hdulist does for measuring (read_galaxy) and
+    plotting (['UCLN'] / ['CLN'])
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        hdulist = fits.open(filename, memmap=False)
+        try:
+            image, catinfo = datacube.get_image(hdulist)
+            table = datacube.get_catalog(hdulist)
+            self.image = np.array(image)
+            self.cat = dict((name, table[name][catinfo])
+                            for name in table.names)
+            self.segmap = np.array(datacube.get_segmap(hdulist))
+            try:
+                hdulist['UCLN']
+                self.imagename = 'UCLN'
+            except KeyError:
+                self.imagename = 'CLN'
+        finally:
+            hdulist.close()
+        self.nbytes = self.image.nbytes + self.segmap.nbytes
+
+    def read_galaxy(self):
+        return self.image, self.cat, self.segmap
+
+    def __getitem__(self, name):
+        if name != self.imagename:
+            raise KeyError(name)
+        return _Plane(self.image)
+
+
+class FailedRead(object):
+    ''' Stands in for a datacube that couldn't be read '''
+
+    def __init__(self, filename, exc_info):
+        self.filename = filename
+        self.exc_info = exc_info
+        self.nbytes = 0
+
+    def read_galaxy(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def __getitem__(self, name):
+        self.read_galaxy()
+
+
+class Prefetcher(object):
+
+    def __init__(self, filenames, ahead=4, max_bytes=PREFETCH_BYTES):
+        self.ahead = max(1, int(ahead))
+        self.max_bytes = max_bytes
+        self.waited = 0.
+
+        self._queue = Queue.Queue(maxsize=self.ahead)
+        self._held = 0
+        self._room = threading.Condition()
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._read,
+                                        args=(list(filenames),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, filenames):
+        for filename in filenames:
+            if self._stop.is_set():
+                break
+            try:
+                with stage('io', name=os.path.basename(filename)):
+                    galaxy = PrefetchedGalaxy(filename)
+            except Exception:
+                galaxy = FailedRead(filename, sys.exc_info())
+
+            # wait for the consumer to make room (unless nothing's waiting
+            # -- one galaxy bigger than the budget still has to get through)
+            with self._room:
+                while self._held and \
+                      self._held + galaxy.nbytes > self.max_bytes and \
+                      not self._stop.is_set():
+                    self._room.wait(1.)
+                self._held += galaxy.nbytes
+            self._queue.put((filename, galaxy))
+        self._queue.put(_END)
+
+    def __iter__(self):
+        try:
+            while True:
+                t0 = time.time()
+                item = interruptible_get(self._queue)
+                self.waited += time.time() - t0
+                span('waiting on reads', t0, time.time())
+                if item is _END:
+                    return
+                with self._room:
+                    self._held -= item[1].nbytes
+                    self._room.notify()
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        with self._room:
+            self._room.notify()
+        # unblock the reader if it's stuck on a full queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
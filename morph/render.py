@@ -0,0 +1,241 @@
+'''
+Render queue: quality-control figures off the measuring hot path.
+
+Drawing and saving galaxyPlots' five figures takes longer than measuring
+the galaxy did. Instead of plotting inline, the measuring loop hands a
+PlotPayload -- just the scalars, profiles and image the figures are drawn
+from, not the whole GalaxyMorphology -- to a RenderQueue, which draws them
+in its own pool of processes (with figures.FigureRenderer unless told to
+use galaxyPlots' functions, render=render_payload):
+
+    plots = RenderQueue(workers=2, every=10)    # before any other threads
+    for ...:
+        g = GalaxyMorphology(...)
+        plots.submit(g, plot_image(hdulist))   # before g.table()
+    plots.close()
+    print plots.report()
+
+Only one galaxy in `every` gets plotted, except flagged ones (any of
+FLAG_COLUMNS set), which always are and skip ahead of the rest in their
+own lane. submit() never waits for the renderers on the ordinary lane: if
+it's full the figures are dropped and counted, so measuring runs at the
+same speed whatever plotting is doing. The priority lane does wait rather
+than lose a flagged galaxy.
+'''
+
+import threading
+import Queue
+import numpy as np
+
+from instrument import stage
+from logs import get_logger
+from scheduler import END_OF_STREAM as _END, interruptible_join, WorkerPool
+
+log = get_logger(__name__)
+
+
+# everything galaxyPlots reads off a galaxy
+PLOT_ATTRS = ['name', 'outdir', 'x', 'y', 'xc', 'yc', 'e', 'theta',
+              'med', 'rms', 'Rp', 'A', 'Ax', 'Ay', 'r20', 'r80', 'C',
+              'G', 'M20', 'Mx', 'My', 'Mlevel1',
+              '_sb', '_avgsb', '_rads', '_ratio', '_newratio',
+              '_interprads', '_interpvals']
+
+FLAG_COLUMNS = ['oflag', 'uflag', 'bflag', 'Rpflag', 'failcode']
+
+FIGURES = ['petro_radius', 'petro_SB', 'asym_plot', 'conc_plot', 'm20_plot']
+
+
+class PlotPayload(object):
+    '''
+    What galaxyPlots needs from a GalaxyMorphology, small enough to
+    pickle over to a render process. Has to be made before g.table(),
+    which throws the profiles away.
+    '''
+
+    def __init__(self, g, image, priority=False):
+        # g can also be a galaxy's attributes as a dict
+        values = g if isinstance(g, dict) else g.__dict__
+        for key in PLOT_ATTRS:
+            if key in values:
+                setattr(self, key, values[key])
+        self.image = np.asarray(image)
+        self.priority = priority
+
+
+def plot_image(hdulist):
+    ''' The image the figures are drawn on, as galaxyPlots.plot picks it '''
+    try:
+        return hdulist['UCLN'].data
+    except KeyError:
+        return hdulist['CLN'].data
+
+def flagged(g):
+    ''' Whether any of FLAG_COLUMNS is set on a galaxy (or row dict) '''
+    values = g if isinstance(g, dict) else g.__dict__
+    for key in FLAG_COLUMNS:
+        value = values.get(key)
+        try:
+            if value and not np.isnan(value):
+                return True
+        except TypeError:
+            pass
+    return False
+
+def reuse_figures(payload):
+    '''
+    Draw one payload's figures with figures.FigureRenderer, which keeps
+    its figures from one galaxy to the next (one renderer per process).
+    Returns [(figure, error)] for any that failed.
+    '''
+    # imported here: only render processes need matplotlib
+    import figures
+    return figures.render_figures(payload)
+
+def render_payload(payload):
+    '''
+    Draw every figure of one payload with galaxyPlots' own functions (a
+    new figure each time: slow). A figure that fails doesn't stop the
+    others; returns [(figure, error)] for those that did.
+    '''
+    # imported here: only render processes need matplotlib
+    import matplotlib.pyplot as plt
+    import galaxyPlots
+    import utils
+
+    utils.checkdir(payload.outdir+'figures/')
+    failed = []
+    for name in FIGURES:
+        try:
+            if name == 'petro_SB':
+                getattr(galaxyPlots, name)(payload)
+            else:
+                getattr(galaxyPlots, name)(payload, payload.image)
+        except Exception as error:
+            failed.append((name, repr(error)))
+            plt.close('all')
+    return failed
+
+def _render(render, payload):
+    # runs in a render process, under call_safely
+    with stage('plotting', name=getattr(payload, 'name', '')):
+        return render(payload)
+
+
+class RenderQueue(object):
+
+    def __init__(self, workers=2, every=1, render=reuse_figures,
+                 queue_size=None):
+        self.workers = max(1, int(workers))
+        self.every = max(1, int(every))
+        self.render = render
+        self.queue_size = queue_size or 4*self.workers
+
+        self.seen = self.sampled_out = self.dropped = 0
+        self.rendered = self.failed = 0
+        self.failures = {}
+        self._lock = threading.Lock()
+
+        # forked before the dispatcher thread exists
+        self.pool = WorkerPool(self.workers)
+        self._regular = Queue.Queue(maxsize=self.queue_size)
+        self._priority = Queue.Queue(maxsize=10*self.queue_size)
+        self._slots = threading.BoundedSemaphore(2*self.workers)
+
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, g, image, priority=None):
+        '''
+        Queue g's figures (image is what they're drawn on). priority
+        defaults to whether g is flagged. Returns whether it was queued.
+        '''
+        if priority is None:
+            priority = flagged(g)
+        with self._lock:
+            self.seen += 1
+            sampled = (self.seen-1) % self.every == 0
+        if priority:
+            self._priority.put(PlotPayload(g, image, True))
+            return True
+        if not sampled:
+            with self._lock:
+                self.sampled_out += 1
+            return False
+        try:
+            self._regular.put_nowait(PlotPayload(g, image))
+            return True
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def _next(self):
+        # the priority lane first; a short wait on the ordinary one so a
+        # flagged galaxy never sits behind it for long
+        while True:
+            try:
+                return self._priority.get_nowait()
+            except Queue.Empty:
+                pass
+            try:
+                item = self._regular.get(True, 0.05)
+            except Queue.Empty:
+                continue
+            if item is _END and not self._priority.empty():
+                # anything flagged that came in meanwhile still goes out
+                self._regular.put(_END)
+                continue
+            return item
+
+    def _finished(self, result):
+        failed, seconds, error = result
+        with self._lock:
+            self.rendered += 1
+            if error is not None:
+                failed = [('render', error)]
+            for name, why in failed or []:
+                if name not in self.failures:
+                    log.warning("Figure %s failed: %s", name, why)
+                self.failures[name] = self.failures.get(name, 0) + 1
+                self.failed += 1
+        self._slots.release()
+
+    def _dispatch(self):
+        while True:
+            # wait for a free renderer before picking what goes next, so a
+            # flagged galaxy that turns up meanwhile still gets it
+            self._slots.acquire()
+            item = self._next()
+            if item is _END:
+                break
+            self.pool.submit(_render, (self.render,), item, self._finished)
+        self.pool.finish()
+
+    def close(self):
+        ''' Wait for everything queued to be drawn '''
+        if self._thread.is_alive():
+            self._regular.put(_END)
+            interruptible_join(self._thread)
+
+    def terminate(self):
+        self.pool.terminate()
+
+    def report(self):
+        text = ('figures: %i galaxies seen, %i rendered, %i sampled out, '
+                '%i dropped (queue full)'%(self.seen, self.rendered,
+                                          self.sampled_out, self.dropped))
+        if self.failures:
+            text += '; failed: '+', '.join('%s %i'%kv for kv in
+                                           sorted(self.failures.items()))
+        return text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -0,0 +1,169 @@
+'''
+Memory-mapped result table shared by the parallel workers.
+
+Rather than every worker pickling a one-row DataFrame back to the parent
+(which then holds them all until a final concat), the parent lays out one
+row per galaxy up front and the workers write their row straight into it:
+
+    table/table.json  -- the columns and their dtypes, number of rows
+    table/rows.npy    -- structured array, one row per item, memory-mapped
+    table/done.npy    -- one byte per row, set once that row is written
+    table/items.txt   -- what each row is (datacube name or objid)
+
+Nothing about a row travels between processes but its index. done.npy
+uses a whole byte per row rather than a bit so two workers finishing
+neighbouring rows never write to the same byte. Reopening the table tells
+you exactly what's left to do (todo()), and export() writes the finished
+rows out as CSV, FITS, ... (anything Table.write knows by its extension)
+or .npz (one array per column).
+'''
+
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from astropy.table import Table
+
+
+def fill_value(dtype):
+    ''' What an unwritten (or missing) value looks like in a column '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind in 'SU':
+        return ''
+    return 0
+
+
+class ResultTable(object):
+
+    def __init__(self, path, items=None, columns=None):
+        '''
+        Open the table in directory path, or create it if it isn't there:
+        then items (list of whatever identifies each row) and columns
+        (list of (name, dtype)) are needed. Reopening with columns checks 
+        the table has those columns: a ValueError if it doesn't, rather 
+        than every write() failing later.
+        '''
+        self.path = path
+        config = os.path.join(path, 'table.json')
+
+        if not os.path.isfile(config):
+            if items is None or columns is None:
+                raise IOError('No result table at %s'%path)
+            self._create(items, columns)
+
+        with open(config) as F:
+            info = json.load(F)
+        self.columns = [(str(n), str(d)) for n, d in info['columns']]
+        self.dtype = np.dtype(self.columns)
+        if columns is not None:
+            self._check_columns([str(n) for n, d in columns])
+
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r+')
+        self._done = np.load(os.path.join(path, 'done.npy'), mmap_mode='r+')
+        self._items = None
+
+    def _create(self, items, columns):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        dtype = np.dtype([(str(n), str(d)) for n, d in columns])
+
+        rows = open_memmap(os.path.join(self.path, 'rows.npy'), mode='w+',
+                           dtype=dtype, shape=(len(items),))
+        for name in dtype.names:
+            rows[name] = fill_value(dtype[name])
+        rows.flush()
+        del rows
+
+        done = open_memmap(os.path.join(self.path, 'done.npy'), mode='w+',
+                           dtype=np.uint8, shape=(len(items),))
+        del done
+
+        with open(os.path.join(self.path, 'items.txt'), 'w') as F:
+            for item in items:
+                F.write('%s\n'%item)
+
+        # table.json goes last: if it exists the rest is complete
+        with open(os.path.join(self.path, 'table.json'), 'w') as F:
+            json.dump({'columns':[(n, dtype[n].str) for n in dtype.names],
+                       'nrows':len(items)}, F)
+
+    def _check_columns(self, names):
+        missing = [n for n in names if n not in self.dtype.fields]
+        extra = [n for n in self.dtype.names if n not in names]
+        if missing or extra:
+            raise ValueError('%s was made with other columns (missing: %s; '
+                             'extra: %s) -- resume it with the options it '
+                             'was started with, or remove it to start over'
+                             %(self.path, ', '.join(missing) or '-',
+                               ', '.join(extra) or '-'))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def items(self):
+        ''' What each row is, as the strings it was created with '''
+        if self._items is None:
+            with open(os.path.join(self.path, 'items.txt')) as F:
+                self._items = [line.rstrip('\n') for line in F]
+        return self._items
+
+    def done(self):
+        return self._done.astype(bool)
+
+    def todo(self):
+        ''' Indices of the rows nobody has written yet '''
+        return np.flatnonzero(self._done == 0)
+
+    def write(self, idx, row):
+        '''
+        Fill in row idx from a dict of column -> value. Columns the dict
+        doesn't have keep their fill value; a key that isn't a column is a
+        ValueError (the columns are fixed when the table is made, and a
+        value with nowhere to go would otherwise vanish from the catalog).
+        '''
+        unknown = [name for name in row if name not in self.dtype.fields]
+        if unknown:
+            raise ValueError('%s has no column for %s'%(self.path,
+                             ', '.join(sorted(unknown))))
+        out = self.rows[idx]
+        for name in self.dtype.names:
+            if name in row and row[name] is not None:
+                out[name] = row[name]
+        # every process maps the same pages, so the row is there for
+        # anyone who sees it marked done; flush() is for getting it to disk
+        self._done[idx] = 1
+
+    def flush(self):
+        self.rows.flush()
+        self._done.flush()
+
+    def to_table(self, everything=False):
+        ''' Finished rows (or all of them) as an astropy Table '''
+        rows = self.rows if everything else self.rows[self.done()]
+        return Table(np.array(rows))
+
+    def export(self, filename, everything=False):
+        '''
+        Write the finished rows out; the format comes from the extension
+        (.csv, .fits, .ecsv, .hdf5 ... or .npz for plain numpy columns)
+        '''
+        root, ext = os.path.splitext(filename)
+        tmp = root+'.tmp%i'%os.getpid()+ext
+        if ext == '.npz':
+            rows = np.array(self.rows if everything else
+                            self.rows[self.done()])
+            np.savez(tmp, **dict((n, rows[n]) for n in rows.dtype.names))
+        else:
+            self.to_table(everything).write(tmp, overwrite=True)
+        os.rename(tmp, filename)
+
+
+_open_tables = {}
+
+def open_table(path):
+    ''' One ResultTable per path per process (for workers) '''
+    if path not in _open_tables:
+        _open_tables[path] = ResultTable(path)
+    return _open_tables[path]
@@ -1,15 +1,59 @@
 #! /usr/bin/env python
 
 import os
+import time
+import errno
+import shutil
 import subprocess
-import pyfits
+import threading
+import Queue
+import multiprocessing
+from distutils.spawn import find_executable
 import ConfigParser
-import pdb
 import argparse
-import pdb
 
-def single_SE(image, outstr, outdir='', params={}, outstr2=0):
-    flag = True
+import instrument
+
+__all__ = ['SERunner', 'SEJob', 'run_SE', 'start_SE', 'single_SE',
+           'set_max_concurrent', 'default_runner', 'set_binary', 'se_binary',
+           'se_command', 'read_section', 'move_to_bad', 'BAD_CUTOUTS',
+           'MAX_CONCURRENT_SE', 'SE_TIMEOUT', 'SE_RETRIES']
+
+#----------------------------------------------------------------------------#
+# Where SExtractor lives
+#
+# Looked up once per process, first hit wins:
+#   set_binary(path) / the SEXTRACTOR environment variable
+#   'binary' in the [SEXTRACTOR] section of the SE config file
+#   sex, sextractor or source-extractor on the PATH
+#   /usr/bin/sex (what this always used to be)
+# e.g. on Ramons: export SEXTRACTOR=/home/user1/beck/Software/sex
+
+SE_NAMES = ['sex', 'sextractor', 'source-extractor']
+_se_binary = os.environ.get('SEXTRACTOR')
+
+def set_binary(path):
+    global _se_binary
+    _se_binary = path
+
+def se_binary(cfg_filename=None):
+    global _se_binary
+    if _se_binary:
+        return _se_binary
+    if cfg_filename is not None:
+        config = ConfigParser.ConfigParser()
+        config.read(cfg_filename)
+        if config.has_option('SEXTRACTOR', 'binary'):
+            _se_binary = config.get('SEXTRACTOR', 'binary')
+            return _se_binary
+    for name in SE_NAMES:
+        path = find_executable(name)
+        if path:
+            _se_binary = path
+            return _se_binary
+    return '/usr/bin/sex'
+
+def se_command(image, outstr, outdir='', params={}, outstr2=0, binary=None):
     basename = os.path.basename(os.path.splitext(image)[0])
 
     if isinstance(outstr2, int):
@@ -23,36 +67,43 @@ def single_SE(image, outstr, outdir='', params={}, outstr2=0):
     params['-checkimage_type'] = 'segmentation'
     params['-checkimage_name'] = seg
 
-    args = ['/usr/bin/sex', image] # for running on my laptop
-    #args = ['/home/user1/beck/Software/sex', image] # to run on Ramons
+    args = [binary or se_binary(), image]
 
     for key, value in params.iteritems():
         args.append(key)
         args.append(value)
-    try:
-        subprocess.check_call(args)
-    except:
-        # been finding a lot of cutouts that weren't saved properly
-        # trying to run SE on them fails miserably
-        # need to remove these for now until I figure out what to do with them
-        os.rename(image, 'bad_cutouts/'+basename+'.fits')
-        flag = False
+    return args
 
-    return flag
+# where cutouts that SE chokes on get moved to
+BAD_CUTOUTS = 'bad_cutouts/'
 
-def run_SE(image, section, cfg_filename='se_params_COSMOS.cfg',
-           outdir='', outstr2=0):
-    ''' Run SExtractor on COSMOS/ZEST cutouts using the parameters
-        in se_param.cfg
-         
-        If section = 'BRIGHT', the parameters are geared toward finding
-        the brightest objects -- MINCONT = 0.04, THRESH = 2.2
+def move_to_bad(image, why=None):
+    # been finding a lot of cutouts that weren't saved properly
+    # trying to run SE on them fails miserably
+    # need to remove these for now until I figure out what to do with them
+    # (concurrent runs on the same cutout may have moved it already)
+    # why, if given, goes into <name>.se.log next to it
+    basename = os.path.basename(os.path.splitext(image)[0])
+    if not os.path.exists(BAD_CUTOUTS):
+        try:
+            os.makedirs(BAD_CUTOUTS)
+        except OSError:
+            pass
+    if os.path.exists(image):
+        shutil.move(image, BAD_CUTOUTS+basename+'.fits')
+    if why is not None:
+        with open(BAD_CUTOUTS+basename+'.se.log', 'a') as F:
+            F.write(why+'\n')
 
-        If section = 'FAINT', parametrs are set to find the faintest 
-        objects -- MINCONT = 0.065, THRESH = 1.0
+def single_SE(image, outstr, outdir='', params={}, outstr2=0):
+    job = SEJob(image, None, outdir=outdir, outstr2=outstr2,
+                args=se_command(image, outstr, outdir, params, outstr2))
+    job.run()
+    return job.flag
 
-        If section = 'SMOOTH', the parameters are identical to FAINT
-        except with the addition of gaussian smoothing
+def read_section(section, cfg_filename='se_params_COSMOS.cfg'):
+    ''' Return the SE output string and command-line parameters for one
+        section of the config file
     '''
     config = ConfigParser.ConfigParser()
     config.read(cfg_filename)
@@ -68,23 +119,252 @@ def run_SE(image, section, cfg_filename='se_params_COSMOS.cfg',
         outstr = 'faint'
     if section == 'SMOOTH':
         outstr = 'smooth'
+    return outstr, params
+
+def run_SE(image, section, cfg_filename='se_params_COSMOS.cfg',
+           outdir='', outstr2=0):
+    ''' Run SExtractor on COSMOS/ZEST cutouts using the parameters
+        in se_param.cfg
+         
+        If section = 'BRIGHT', the parameters are geared toward finding
+        the brightest objects -- MINCONT = 0.04, THRESH = 2.2
+
+        If section = 'FAINT', parametrs are set to find the faintest 
+        objects -- MINCONT = 0.065, THRESH = 1.0
+
+        If section = 'SMOOTH', the parameters are identical to FAINT
+        except with the addition of gaussian smoothing
+    '''
+    outstr, params = read_section(section, cfg_filename)
     
     if isinstance(outstr2, int):
         flag = single_SE(image, outstr, outdir, params)
     else:
         flag = single_SE(image, outstr, outdir, params, outstr2)
     return flag
+
+#----------------------------------------------------------------------------#
+# Concurrent SExtractor runs
+#
+# Each SEJob is a thread that waits for a slot on its SERunner and then runs
+# one SE process, with its stdout/stderr captured, killed if it runs longer
+# than the runner's timeout and tried again (up to retries more times) if
+# it died of something that might not happen twice -- a timeout, a signal,
+# the system being out of processes or memory. SE exiting with an error of
+# its own means the input is bad: that isn't retried.
+#
+# One SERunner caps how many SE processes are in flight across everything
+# that uses it. Each python process has a default runner (set_max_concurrent
+# changes its size) but a single process can just as well make one big
+# runner and keep every core busy with SE on its own -- see main().
+
+MAX_CONCURRENT_SE = 3
+SE_TIMEOUT = 300.
+SE_RETRIES = 2
+
+TRANSIENT_ERRNOS = [errno.EAGAIN, errno.ENOMEM, errno.EINTR]
+
+
+class SERunner(object):
+
+    def __init__(self, max_in_flight=MAX_CONCURRENT_SE, timeout=SE_TIMEOUT,
+                 retries=SE_RETRIES, backoff=2.):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def submit(self, image, section, cfg_filename='se_params_COSMOS.cfg',
+               outdir='', outstr2=0, notify=None):
+        ''' Start one SE run; returns the running SEJob '''
+        job = SEJob(image, section, cfg_filename=cfg_filename, outdir=outdir,
+                    outstr2=outstr2, notify=notify, runner=self)
+        job.start()
+        return job
+
+    def run_all(self, images, section, cfg_filename='se_params_COSMOS.cfg',
+                outdir='', outstr2=0):
+        ''' Run SE on every image, max_in_flight at a time; the SEJobs '''
+        # don't pile up thousands of idle threads: once max_in_flight are
+        # going, the next one only starts when one of them has finished
+        finished = Queue.Queue()
+        jobs = []
+        for n, image in enumerate(images):
+            if n >= self.max_in_flight:
+                finished.get()
+            jobs.append(self.submit(image, section, cfg_filename, outdir,
+                                    outstr2, notify=finished))
+        for job in jobs:
+            job.join()
+        return jobs
+
+_runner = SERunner()
+
+def set_max_concurrent(n):
+    ''' Change the number of SE runs allowed in flight in this process '''
+    global MAX_CONCURRENT_SE, _runner
+    MAX_CONCURRENT_SE = max(1, int(n))
+    _runner = SERunner(MAX_CONCURRENT_SE, _runner.timeout, _runner.retries,
+                       _runner.backoff)
+
+def default_runner():
+    return _runner
+
+
+class SEJob(threading.Thread):
+    ''' One SExtractor run in a background thread; same arguments as run_SE.
+        
+        If a Queue is passed as notify, the job puts its section on it when 
+        finished so the caller can react to whichever run completes first.
+        A job that is no longer needed can be cancel()ed -- the SE process is
+        killed and the input is NOT moved to bad_cutouts/.
+
+        Afterwards stdout, stderr, returncode and attempts say how it went;
+        if it failed the input is moved to bad_cutouts/ along with a log of
+        why.
+    '''
+    def __init__(self, image, section, cfg_filename='se_params_COSMOS.cfg',
+                 outdir='', outstr2=0, notify=None, runner=None, args=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.image, self.section = image, section
+        self.notify = notify
+        self.runner = runner or _runner
+        self.flag = None
+        self.cancelled = False
+        self.timed_out = False
+        self.stdout = self.stderr = ''
+        self.returncode = None
+        self.attempts = 0
+        self._proc = None
+        self._lock = threading.Lock()
+        # runs count towards whoever started them, not this thread
+        self.probe = instrument.current()
+
+        if args is None:
+            outstr, params = read_section(section, cfg_filename)
+            args = se_command(image, outstr, outdir, params, outstr2,
+                              se_binary(cfg_filename))
+        self.args = args
+
+    def _kill(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                self.timed_out = True
+                self._proc.kill()
+
+    def _attempt(self):
+        ''' One go at it: True if it worked, None if it's worth retrying '''
+        self.attempts += 1
+        self.timed_out = False
+        started = time.time()
+        with self._lock:
+            if self.cancelled:
+                return False
+            try:
+                self._proc = subprocess.Popen(self.args,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.PIPE)
+            except OSError as e:
+                self.stderr = 'could not start %s: %s'%(self.args[0], e)
+                return None if e.errno in TRANSIENT_ERRNOS else False
+            self.probe.count('se_runs')
+
+        timer = None
+        if self.runner.timeout:
+            timer = threading.Timer(self.runner.timeout, self._kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            self.stdout, self.stderr = self._proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self.returncode = self._proc.returncode
+        instrument.span('sextractor', started, time.time(), self.probe,
+                        lane='sextractor', section=self.section,
+                        attempt=self.attempts, returncode=self.returncode)
+
+        if self.returncode == 0:
+            return True
+        if self.cancelled:
+            return False
+        if self.timed_out or self.returncode < 0:
+            return None
+        return False
+
+    def run(self):
+        flag = False
+        try:
+            for attempt in range(1 + self.runner.retries):
+                if attempt:
+                    # back off without the slot, so other runs can use it
+                    time.sleep(self.runner.backoff*attempt)
+                with self.runner.slots:
+                    flag = self._attempt()
+                if flag is not None:
+                    break
+            if not flag and not self.cancelled:
+                move_to_bad(self.image, self.why())
+        finally:
+            self.flag = bool(flag) and not self.cancelled
+            if self.notify is not None:
+                self.notify.put(self.section)
+
+    def why(self):
+        ''' What went wrong, for the bad_cutouts/ log '''
+        if self.timed_out:
+            what = 'timed out after %gs'%self.runner.timeout
+        else:
+            what = 'exit status %s'%self.returncode
+        return '%s: %s (%i attempts)\n  %s\n%s'%(
+               time.strftime('%Y-%m-%d %H:%M:%S'), what, self.attempts,
+               ' '.join(self.args), self.stderr[-2000:])
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.kill()
+
+    def result(self):
+        ''' Block until the run is done; return the same flag as run_SE '''
+        self.join()
+        return self.flag
+
+def start_SE(image, section, cfg_filename='se_params_COSMOS.cfg',
+             outdir='', outstr2=0, notify=None):
+    ''' Launch run_SE in the background and return the running SEJob '''
+    return _runner.submit(image, section, cfg_filename, outdir, outstr2,
+                          notify)
         
 def main():
     
     parser = argparse.ArgumentParser(description='Run SExtractor')
-    parser.add_argument('Imagename', type=str, 
-        help='Name of fits image to run SExtractor on')
+    parser.add_argument('Imagename', type=str, nargs='+',
+        help='Name of fits image(s) to run SExtractor on')
     parser.add_argument('--mode', default='BRIGHT',
         help='Specify which config file to use: Bright, Smooth, or Faint')
+    parser.add_argument('--cfg', default='se_params_COSMOS.cfg',
+        help='SE parameter file')
+    parser.add_argument('--outdir', default='',
+        help='Where the catalogs and segmaps go')
+    parser.add_argument('-j', dest='n_jobs', type=int, 
+        default=multiprocessing.cpu_count(),
+        help='SE processes to keep running at once')
+    parser.add_argument('--timeout', type=float, default=SE_TIMEOUT,
+        help='Seconds before an SE run is killed (and retried)')
+    parser.add_argument('--retries', type=int, default=SE_RETRIES,
+        help='Extra tries for runs that time out or get killed')
     args = parser.parse_args()
 
-    run_SE(args.Imagename, args.mode)
+    runner = SERunner(args.n_jobs, args.timeout, args.retries)
+    jobs = runner.run_all(args.Imagename, args.mode, args.cfg, args.outdir)
+    failed = [job.image for job in jobs if not job.flag]
+    print len(jobs)-len(failed), "of", len(jobs), "SE runs succeeded"
+    for image in failed:
+        print "failed:", image
 
 
 if __name__ == '__main__':
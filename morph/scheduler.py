@@ -0,0 +1,235 @@
+'''
+Streaming work scheduler for the parallel drivers.
+
+Instead of one blocking Parallel() call per chunk (where the slowest galaxy
+in the chunk holds up the next chunk), everything goes through one pool of
+workers that stays up for the whole run:
+    - work is handed out biggest-first (stamp size is a decent guess at how
+      long a galaxy takes) so the long ones don't end up last
+    - only max_inflight items are queued at once, so memory stays flat no
+      matter how long the manifest is
+    - results come back as soon as each galaxy finishes
+
+The pipeline, prefetcher and render queue share its plumbing: END_OF_STREAM
+after a queue's last item, call_safely() around whatever a worker runs, 
+WorkerPool to run it on and interruptible_get()/interruptible_join() for 
+waiting on them.
+'''
+
+import os
+import time
+import itertools
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.queues
+import Queue
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+def available_memory():
+    ''' Bytes of memory available to new processes (Linux), None if unknown '''
+    try:
+        with open('/proc/meminfo') as F:
+            for line in F:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except IOError:
+        pass
+    return None
+
+def auto_workers(mem_per_worker=2e9, reserve=1):
+    '''
+    How many workers this machine can take: one per core (minus reserve for
+    the parent) but no more than fit in the available memory
+    '''
+    n = max(1, multiprocessing.cpu_count() - reserve)
+    mem = available_memory()
+    if mem is not None:
+        n = min(n, max(1, int(mem/mem_per_worker)))
+    return n
+
+def stamp_cost(filename):
+    ''' Expected cost of a datacube: its size on disk '''
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def largest_first(items, cost=stamp_cost):
+    return sorted(items, key=cost, reverse=True)
+
+# what a producer puts on a queue after its last item
+END_OF_STREAM = '__end_of_stream__'
+
+
+# in a WorkerPool's workers: where call_safely says which task it's on
+_started = None
+
+def _announce_to(started):
+    global _started
+    _started = started
+
+def call_safely(func, args, item, token=None):
+    '''
+    func(*args, item) as (result, seconds, error). Runs in a worker, where
+    an exception must never escape -- the parent only ever hears about it
+    through the callback -- so it comes back as error, its traceback.
+    '''
+    if token is not None and _started is not None:
+        _started.put((token, os.getpid()))
+    t0 = time.time()
+    try:
+        return func(*(args+(item,))), time.time()-t0, None
+    except Exception:
+        return None, time.time()-t0, traceback.format_exc()
+
+class WorkerPool(multiprocessing.pool.Pool):
+    '''
+    A process pool that notices when a worker dies under a task.
+
+    A worker the kernel kills (the OOM killer, a SIGKILL) takes its task 
+    with it: multiprocessing starts a new worker, but the task's callback
+    never fires and whoever is counting results waits forever. Workers 
+    here say which task they start on, and every check_every seconds a 
+    watchdog fails the tasks whose worker is gone -- their callback gets
+    (None, seconds, error) like any other failure.
+    '''
+
+    def __init__(self, processes=None, check_every=1.):
+        self._started = multiprocessing.queues.SimpleQueue()
+        multiprocessing.pool.Pool.__init__(self, processes, _announce_to,
+                                           (self._started,))
+        self.lost = 0
+        self._tokens = itertools.count()
+        self._callbacks = {}
+        self._running = {}
+        self._tasks_lock = threading.Lock()
+        self._stop = threading.Event()
+        watchdog = threading.Thread(target=self._watch, args=(check_every,))
+        watchdog.daemon = True
+        watchdog.start()
+
+    def submit(self, func, args, item, callback):
+        '''
+        call_safely(func, args, item) on a worker; callback gets its 
+        (result, seconds, error)
+        '''
+        token = next(self._tokens)
+        with self._tasks_lock:
+            self._callbacks[token] = callback, time.time()
+        self.apply_async(call_safely, (func, args, item, token),
+                         callback=lambda out: self._done(token, out))
+
+    def _done(self, token, out):
+        with self._tasks_lock:
+            callback, t0 = self._callbacks.pop(token, (None, None))
+        if callback is not None:
+            callback(out)
+
+    def check(self):
+        ''' Fail every task whose worker has died '''
+        while not self._started.empty():
+            token, pid = self._started.get()
+            self._running[token] = pid
+        # multiprocessing drops a dead worker from _pool when it starts
+        # the one replacing it
+        alive = set(p.pid for p in list(self._pool))
+        dead = []
+        with self._tasks_lock:
+            for token, pid in self._running.items():
+                if token not in self._callbacks:
+                    del self._running[token]
+                elif pid not in alive:
+                    del self._running[token]
+                    dead.append((pid, self._callbacks.pop(token)))
+                    self.lost += 1
+        for pid, (callback, t0) in dead:
+            callback((None, time.time()-t0, 'worker %i died (killed by '
+                      'the kernel -- out of memory?)'%pid))
+
+    def _watch(self, every):
+        while not self._stop.wait(every):
+            self.check()
+
+    def finish(self):
+        '''
+        close() and join() once every task has come back. multiprocessing
+        never forgets a task whose worker died (join() would wait for it 
+        forever), so a pool that lost one is terminated instead.
+        '''
+        self.close()
+        while self._callbacks:
+            time.sleep(0.1)
+        if self.lost:
+            self.terminate()
+        self._stop.set()
+        self.join()
+
+    def terminate(self):
+        self._stop.set()
+        multiprocessing.pool.Pool.terminate(self)
+
+def interruptible_get(q):
+    ''' q.get() that ctrl-c can interrupt '''
+    # a blocking get without a timeout ignores KeyboardInterrupt
+    return q.get(True, 1e6)
+
+def interruptible_join(thread):
+    ''' thread.join() that ctrl-c can interrupt '''
+    while thread.is_alive():
+        thread.join(1.)
+
+def stream(func, items, args=(), n_workers=None, max_inflight=None,
+           pool=None):
+    '''
+    Call func(*args, item) for every item on a pool of n_workers processes
+    and yield (item, result) as each one finishes, in whatever order that
+    is. At most max_inflight items are handed to the pool at a time.
+
+    If func raises, the traceback is logged and result is None.
+    func has to be picklable (a module-level function).
+
+    Pass a WorkerPool (of n_workers) to stream several batches through 
+    the same workers; it's left running for the caller to finish().
+    '''
+    n_workers = n_workers or auto_workers()
+    max_inflight = max_inflight or 2*n_workers
+
+    own_pool = pool is None
+    if own_pool:
+        pool = WorkerPool(n_workers)
+    finished = Queue.Queue()
+    pending = 0
+
+    def collect():
+        item, result, error = interruptible_get(finished)
+        if error is not None:
+            log.error("Failed on %s\n%s", item, error)
+        return item, result
+
+    try:
+        for item in items:
+            while pending >= max_inflight:
+                yield collect()
+                pending -= 1
+            pool.submit(func, args, item,
+                lambda out, item=item: finished.put((item, out[0], out[2])))
+            pending += 1
+
+        while pending:
+            yield collect()
+            pending -= 1
+        if own_pool:
+            pool.finish()
+    except:
+        if own_pool:
+            pool.terminate()
+        raise
+    finally:
+        if own_pool:
+            pool.join()
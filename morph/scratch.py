@@ -0,0 +1,57 @@
+'''
+Scratch space for running clean_frame in several processes at once.
+
+clean_frame dumps all of its SExtractor output (and the datacube) into
+whatever outdir it is handed and clean_directory globs that same directory,
+so two workers sharing an outdir will happily delete each other's files.
+Each worker gets its own scratch directory instead (on /dev/shm when it
+exists so all those intermediate FITS files never hit the disk) and only
+the final datacube is copied out.
+'''
+
+import os
+import shutil
+import tempfile
+
+import utils
+
+
+def scratch_root(root=None):
+    '''
+    Where to put scratch directories: root if given, otherwise a RAM-backed
+    filesystem if there is one, otherwise the usual tmp directory
+    '''
+    if root:
+        return root
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def worker_scratch(root=None):
+    '''
+    Scratch directory belonging to the current process (one per worker).
+    Returned with a trailing slash because clean_frame glues names on
+    directly
+    '''
+    scratch = os.path.join(scratch_root(root), 'gzclean_%i/'%os.getpid())
+    utils.checkdir(scratch)
+    return scratch
+
+def remove_scratch(scratch):
+    ''' Throw away a scratch directory and everything left in it '''
+    shutil.rmtree(scratch, ignore_errors=True)
+
+def promote(src, destdir):
+    '''
+    Move a finished file from scratch into destdir so that it appears there
+    all at once: copy it next to its final name, then rename. Anyone
+    globbing destdir never sees a half-written datacube.
+    '''
+    utils.checkdir(os.path.join(destdir, ''))
+    dest = os.path.join(destdir, os.path.basename(src))
+    tmp = os.path.join(destdir, '.%s.%i.tmp'%(os.path.basename(src),
+                                             os.getpid()))
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dest)
+    os.remove(src)
+    return dest
@@ -0,0 +1,249 @@
+'''
+Packed stamp store: many galaxies' image planes in a handful of big files.
+
+Going through one FITS file per galaxy means a directory listing, an open
+and a header parse for every stamp. A store instead keeps
+
+    store/store.json        -- which planes are kept and their dtypes
+    store/index.npy         -- one row per galaxy: objid, where its planes
+                               live (chunk, offset), shape, SECATIDX, the
+                               cleaning flags, the datacube it came from and
+                               the SE catalog values GalaxyMorphology needs
+    store/chunk_0000.bin... -- raw pixel data, planes of one galaxy back to
+                               back, each chunk capped at chunk_bytes
+
+Chunks are memory-mapped when read, so an entry's planes are views into the
+page cache rather than copies. Look galaxies up by objid:
+
+    store = StampStore('stamps/')
+    entry = store[587725550679031929]
+    g = GalaxyMorphology(entry, entry.filename, entry.flags, outdir)
+
+pack_stamps.py builds a store out of existing datacubes.
+'''
+
+import os
+import json
+import numpy as np
+import astropy.io.fits as fits
+
+import datacube
+
+
+# the bits of the SE catalog row GalaxyMorphology uses
+CATFIELDS = ['X_IMAGE', 'Y_IMAGE', 'ELONGATION', 'KRON_RADIUS', 'A_IMAGE',
+             'B_IMAGE', 'THETA_IMAGE', 'ALPHA_J2000', 'DELTA_J2000',
+             'ELLIPTICITY']
+
+# the images are float32 in the datacubes: kept as they are
+PLANES = [('IMAGE', '<f4'), ('FSEG', '<i4')]
+CHUNK_BYTES = 1 << 30
+
+
+def index_dtype():
+    return np.dtype([('objid', '<i8'), ('chunk', '<i4'), ('offset', '<i8'),
+                     ('ny', '<i4'), ('nx', '<i4'), ('SECATIDX', '<i4'),
+                     ('cat', '<i2'), ('oflag', '<i2'), ('uflag', '<i2'),
+                     ('bflag', '<i2'), ('filename', 'S160')] +
+                    [(f, '<f8') for f in CATFIELDS])
+
+
+class StampEntry(object):
+    '''
+    One galaxy out of a StampStore. Passing it to GalaxyMorphology in place
+    of an hdulist works because it answers read_galaxy() the same way
+    datacube.read_galaxy does for a FITS datacube.
+    '''
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+        self.objid = int(row['objid'])
+        self.filename = row['filename']
+        self.flags = [row['cat'], row['oflag'], row['uflag'], row['bflag']]
+        self.shape = (int(row['ny']), int(row['nx']))
+
+    def plane(self, name):
+        return self.store.read_plane(self.row, name)
+
+    def read_galaxy(self):
+        return self.plane('IMAGE'), self.row, self.plane('FSEG')
+
+
+class StampStore(object):
+
+    def __init__(self, path, mode='r', planes=PLANES, chunk_bytes=CHUNK_BYTES):
+        '''
+        mode='r' opens an existing store for reading; mode='a' opens (or
+        creates) one for adding galaxies. The index is written every time a
+        chunk fills up, on flush() and on close(); galaxies added since are
+        in the chunk but not yet findable.
+        '''
+        self.path = path
+        self.mode = mode
+        self._maps = {}
+        self._lookup = None
+
+        config = os.path.join(path, 'store.json')
+        if os.path.isfile(config):
+            with open(config) as F:
+                info = json.load(F)
+            self.planes = [(str(n), str(d)) for n, d in info['planes']]
+            self.chunk_bytes = info['chunk_bytes']
+        elif mode == 'a':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.planes = list(planes)
+            self.chunk_bytes = chunk_bytes
+            with open(config, 'w') as F:
+                json.dump({'planes':self.planes,
+                           'chunk_bytes':self.chunk_bytes}, F)
+        else:
+            raise IOError('No stamp store at %s'%path)
+
+        self.dtype = index_dtype()
+        indexfile = os.path.join(path, 'index.npy')
+        if os.path.isfile(indexfile):
+            self.index = np.load(indexfile, mmap_mode='r' if mode == 'r'
+                                                      else None)
+        else:
+            self.index = np.zeros(0, dtype=self.dtype)
+
+        if mode == 'a':
+            self._new = []
+            self._chunk = int(self.index['chunk'].max()) if len(self.index) \
+                          else 0
+            self._out = open(self._chunkname(self._chunk), 'ab')
+
+    def __len__(self):
+        return len(self.index) + len(getattr(self, '_new', []))
+
+    def __contains__(self, objid):
+        return int(objid) in self.lookup()
+
+    def __getitem__(self, objid):
+        return StampEntry(self, self.index[self.lookup()[int(objid)]])
+
+    def __iter__(self):
+        for row in self.index:
+            yield StampEntry(self, row)
+
+    def objids(self):
+        return np.asarray(self.index['objid'])
+
+    def lookup(self):
+        ''' objid -> row number in the index, built on first use '''
+        if self._lookup is None:
+            self._lookup = dict((int(o), i) for i, o in
+                                enumerate(self.index['objid']))
+        return self._lookup
+
+    def _chunkname(self, chunk):
+        return os.path.join(self.path, 'chunk_%04i.bin'%chunk)
+
+    def _chunkmap(self, chunk):
+        if chunk not in self._maps:
+            self._maps[chunk] = np.memmap(self._chunkname(chunk),
+                                          dtype=np.uint8, mode='r')
+        return self._maps[chunk]
+
+    def read_plane(self, row, name):
+        ''' Zero-copy, read-only view of one plane of one galaxy '''
+        shape = (int(row['ny']), int(row['nx']))
+        offset = int(row['offset'])
+        for pname, dtype in self.planes:
+            nbytes = shape[0]*shape[1]*np.dtype(dtype).itemsize
+            if pname == name:
+                mm = self._chunkmap(int(row['chunk']))
+                return np.ndarray(shape, dtype=dtype, buffer=mm,
+                                  offset=offset)
+            offset += nbytes
+        raise KeyError(name)
+
+    def add(self, objid, planes, filename='', secatidx=0, flags=(0,0,0,0),
+            catrow=None):
+        '''
+        Append one galaxy. planes maps plane name -> 2d array (all the same
+        shape); catrow is its row of the SE catalog.
+        '''
+        shape = planes[self.planes[0][0]].shape
+        blob = ''.join([np.ascontiguousarray(planes[n], dtype=d).tostring()
+                        for n, d in self.planes])
+
+        offset = self._out.tell()
+        if offset and offset + len(blob) > self.chunk_bytes:
+            # everything in the full chunk gets indexed before moving on
+            self.flush()
+            self._out.close()
+            self._chunk += 1
+            self._out = open(self._chunkname(self._chunk), 'ab')
+            offset = self._out.tell()
+        self._out.write(blob)
+
+        row = [objid, self._chunk, offset, shape[0], shape[1], secatidx] + \
+              list(flags) + [filename] + \
+              [float(catrow[f]) if catrow is not None else np.nan
+               for f in CATFIELDS]
+        self._new.append(tuple(row))
+        self._lookup = None
+
+    def add_datacube(self, filename, flags=(0,0,0,0)):
+        ''' Append the galaxy in a clean_frame datacube (either version) '''
+        basename = os.path.basename(os.path.splitext(filename)[0])
+        objid = np.int64(basename.split('_')[1])
+        hdulist = fits.open(filename)
+        try:
+            image, catinfo = datacube.get_image(hdulist)
+            catrow = datacube.get_catalog(hdulist)[catinfo]
+            planes = {'IMAGE':image, 'FSEG':datacube.get_segmap(hdulist)}
+            for name, dtype in self.planes:
+                if name not in planes:
+                    planes[name] = hdulist[name].data
+            self.add(objid, planes, filename, catinfo, flags, catrow)
+        finally:
+            hdulist.close()
+
+    def flush(self):
+        '''
+        Write the index with everything added so far, so a packer that dies
+        later only loses what it added after this
+        '''
+        if self.mode != 'a':
+            return
+        # the pixels have to be on disk before the index points at them
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        if not self._new:
+            return
+        new = np.array(self._new, dtype=self.dtype)
+        index = np.concatenate([np.asarray(self.index), new])
+
+        # write the new index beside the old one then swap it in
+        indexfile = os.path.join(self.path, 'index.npy')
+        tmp = os.path.join(self.path, 'index.tmp.npy')
+        np.save(tmp, index)
+        os.rename(tmp, indexfile)
+        self.index = index
+        self._new = []
+        self._lookup = None
+
+    def close(self):
+        if self.mode != 'a':
+            return
+        self.flush()
+        self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+_open_stores = {}
+
+def open_store(path):
+    ''' One read-only StampStore per path per process (for workers) '''
+    if path not in _open_stores:
+        _open_stores[path] = StampStore(path)
+    return _open_stores[path]
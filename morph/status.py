@@ -0,0 +1,398 @@
+'''
+Live status of a run: how far it has got, how fast it's going, when it
+will be done and what each worker is up to -- for deciding, days into a
+catalog run, whether to rebalance workers or pause it.
+
+After status_to(directory) in the driver, every process that measures
+galaxies, in this process and every process started from it afterwards
+(it goes through the environment, like trace_to), keeps its
+own directory/worker.<host>.<pid>.json: galaxies done, failed and
+quarantined, how many finished in each of the last few minutes, where
+its time went stage by stage, and its memory (now, and the peak from
+utils.resource_usage). measuring() in instrument.py counts into it, and
+it's rewritten whole (and renamed into place, so nobody reads half of
+one) at most every STATUS_EVERY seconds and when the worker exits.
+
+The driver keeps run.<host>.<pid>.json (when it started, how many
+galaxies it has to do: status_started(total) once it knows) and, from a
+thread started then, merges everything into
+directory/status.json every STATUS_EVERY seconds: the counts, the
+galaxies/sec of the last RATE_WINDOW seconds, the share of the time
+each stage took, the ETA and a line per worker. To watch a run:
+
+    python -m morph.status status/ --watch 30
+
+read_status() does the merging for anything else that wants it.
+'''
+
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import resource
+import argparse
+import threading
+
+from utils import resource_usage
+
+
+STATUS_ENV = 'MORPH_STATUS'
+STATUS_EVERY = 5.
+# the rate is over this many seconds, counted in RATE_BIN second bins
+RATE_WINDOW = 600.
+RATE_BIN = 10.
+# a worker that hasn't written for this long is marked stale
+STALE = 300.
+OUTCOMES = ['done', 'failed', 'quarantined']
+
+
+def _write_json(path, value):
+    # rename is atomic: a reader gets the old file or the new one
+    tmp = '%s.%i.tmp'%(path, os.getpid())
+    with open(tmp, 'w') as F:
+        json.dump(value, F)
+    os.rename(tmp, path)
+
+def _read_json(path):
+    try:
+        with open(path) as F:
+            return json.load(F)
+    except (IOError, OSError, ValueError):
+        # gone between glob and open, or not a status file
+        return None
+
+def process_memory():
+    ''' Resident memory of this process (now, peak) in MB; now is None
+    where there's no /proc '''
+    peak = resource_usage()['ru_maxrss']/1024.
+    if sys.platform == 'darwin':
+        # bytes there
+        peak /= 1024.
+    try:
+        with open('/proc/self/statm') as F:
+            now = int(F.read().split()[1])*resource.getpagesize()/2.**20
+    except (IOError, OSError, IndexError, ValueError):
+        now = None
+    return now, peak
+
+
+class WorkerStatus(object):
+    ''' What one process has measured so far '''
+
+    def __init__(self):
+        self.host, self.pid = socket.gethostname(), os.getpid()
+        self.started = time.time()
+        self.counts = dict((outcome, 0) for outcome in OUTCOMES)
+        self.seconds = 0.
+        self.stages = {}
+        # {bin start: galaxies finished in it}
+        self.bins = {}
+        self.last = None
+        self.written = 0.
+
+    def add(self, probe, outcome):
+        ''' A galaxy's probe; outcome is None for part of a galaxy '''
+        now = time.time()
+        self.seconds += probe.total()
+        for name, seconds in probe.times.items():
+            if seconds:
+                self.stages[name] = self.stages.get(name, 0.) + seconds
+        if outcome is None:
+            return
+        self.counts[outcome] += 1
+        start = now - now % RATE_BIN
+        self.bins[start] = self.bins.get(start, 0) + 1
+        for old in [b for b in self.bins if b < now - RATE_WINDOW]:
+            del self.bins[old]
+        self.last = probe.item.get('name')
+
+    def state(self):
+        now, peak = process_memory()
+        state = {'host':self.host, 'pid':self.pid, 'started':self.started,
+                 'updated':time.time(), 'seconds':self.seconds,
+                 'stages':self.stages, 'last':self.last, 'rss_mb':now,
+                 'peak_mb':peak,
+                 'bins':sorted([start, n] for start, n in self.bins.items())}
+        state.update(self.counts)
+        return state
+
+    def write(self, directory):
+        _write_json(os.path.join(directory, 'worker.%s.%i.json'
+                                 %(self.host, self.pid)), self.state())
+        self.written = time.time()
+
+
+_status_dir = os.environ.get(STATUS_ENV) or None
+_worker = None
+_lock = threading.Lock()
+_merger = None
+
+def _flush():
+    with _lock:
+        if _status_dir is not None and _worker is not None and \
+           _worker.pid == os.getpid():
+            _worker.write(_status_dir)
+
+def galaxy_finished(probe, error=None):
+    '''
+    Count a galaxy measuring() has finished with into this process's
+    status: failed if it raised, quarantined if supervised() said so,
+    otherwise done -- unless the probe isn't counted, when only its time is
+    '''
+    if _status_dir is None:
+        return
+    if error is not None:
+        outcome = 'failed'
+    elif not probe.counted:
+        outcome = None
+    elif probe.quarantined:
+        outcome = 'quarantined'
+    else:
+        outcome = 'done'
+
+    global _worker
+    with _lock:
+        if _worker is None or _worker.pid != os.getpid():
+            # first galaxy of this process (or of a fork of it). Pool
+            # workers leave through multiprocessing's exit function,
+            # which runs finalizers but not atexit
+            import multiprocessing.util
+            _worker = WorkerStatus()
+            multiprocessing.util.Finalize(_worker, _flush, exitpriority=10)
+        _worker.add(probe, outcome)
+        if time.time() - _worker.written >= STATUS_EVERY:
+            _worker.write(_status_dir)
+
+
+class _Merger(threading.Thread):
+    # the driver's thread keeping status.json up to date. The parallel
+    # drivers' pools fork while it runs, which is safe as long as it never
+    # holds a lock a child could need: a fork copies locks in whatever
+    # state they're in, and the thread that would release them doesn't
+    # come along. So it only reads and writes files with what's imported
+    # above (no logging -- its handler locks -- and no imports -- the
+    # import lock); the one lock it touches is its own Event's, which no
+    # child ever uses. Drivers that can still start their pools first do
+    # (measure_morph.py).
+
+    def __init__(self, directory, every):
+        threading.Thread.__init__(self, name='status')
+        self.daemon = True
+        self.directory, self.every = directory, every
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.every):
+            write_status(self.directory)
+
+def status_to(directory, fresh=True):
+    '''
+    Keep the status of this run in directory (None to stop): this process
+    and every process started from it from now on count into it. fresh
+    clears out an earlier run's files; nodes sharing the directory pass
+    fresh=False.
+    '''
+    global _status_dir, _merger
+    if _merger is not None:
+        _merger.stopped.set()
+        _merger = None
+    if not directory:
+        os.environ.pop(STATUS_ENV, None)
+        _status_dir = None
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if fresh:
+        for old in glob.glob(os.path.join(directory, 'run.*.json')) + \
+                   glob.glob(os.path.join(directory, 'worker.*.json')):
+            os.remove(old)
+    os.environ[STATUS_ENV] = directory
+    _status_dir = directory
+    _write_json(_run_file(), {'host':socket.gethostname(), 'pid':os.getpid(),
+                              'started':time.time(), 'total':None,
+                              'command':' '.join(sys.argv), 'finished':None})
+    write_status(directory)
+
+def status_started(total=None, every=STATUS_EVERY):
+    '''
+    The work is laid out: total galaxies to do (None if not known, and
+    there's no ETA). Starts the thread merging status.json every `every`
+    seconds.
+    '''
+    global _merger
+    if _status_dir is None:
+        return
+    run = _read_json(_run_file())
+    if run is not None:
+        run['total'] = total
+        _write_json(_run_file(), run)
+    write_status(_status_dir)
+    if _merger is None:
+        _merger = _Merger(_status_dir, every)
+        _merger.start()
+
+def status_finished():
+    ''' The driver is done: last counts in, status.json final '''
+    global _merger
+    if _status_dir is None:
+        return
+    if _merger is not None:
+        _merger.stopped.set()
+        _merger = None
+    _flush()
+    run = _read_json(_run_file())
+    if run is not None:
+        run['finished'] = time.time()
+        _write_json(_run_file(), run)
+    write_status(_status_dir)
+
+def _run_file():
+    return os.path.join(_status_dir, 'run.%s.%i.json'
+                        %(socket.gethostname(), os.getpid()))
+
+
+def _rate(bins, now, since):
+    # galaxies/sec over the last RATE_WINDOW seconds (or since started)
+    n = sum(count for start, count in bins if start >= now - RATE_WINDOW)
+    return n/max(min(RATE_WINDOW, now - since), 1.)
+
+def read_status(directory):
+    ''' Everything the run and its workers have written, merged '''
+    now = time.time()
+    runs = filter(None, map(_read_json, sorted(glob.glob(
+                  os.path.join(directory, 'run.*.json')))))
+    workers = filter(None, map(_read_json, sorted(glob.glob(
+                     os.path.join(directory, 'worker.*.json')))))
+
+    status = {'time':now, 'directory':directory, 'runs':runs,
+              'started':min([r['started'] for r in runs] or [None]),
+              'finished':None, 'total':None, 'remaining':None, 'eta':None}
+    if runs and all(r.get('finished') for r in runs):
+        status['finished'] = max(r['finished'] for r in runs)
+    if runs and all(r.get('total') is not None for r in runs):
+        status['total'] = sum(r['total'] for r in runs)
+    for outcome in OUTCOMES:
+        status[outcome] = sum(w.get(outcome, 0) for w in workers)
+
+    stages = {}
+    for w in workers:
+        w['rate'] = _rate(w.get('bins', []), now, w['started'])
+        w['stale'] = now - w['updated'] > STALE
+        for name, seconds in w.get('stages', {}).items():
+            stages[name] = stages.get(name, 0.) + seconds
+    measured = sum(w.get('seconds', 0.) for w in workers)
+    status['stages'] = dict((name, seconds/measured) for name, seconds
+                            in stages.items() if measured)
+    status['workers'] = workers
+
+    # every worker counts into the rate, the stale ones' recent bins too
+    status['rate'] = sum(w['rate'] for w in workers)
+    if status['total'] is not None:
+        status['remaining'] = max(status['total'] -
+                                  sum(status[o] for o in OUTCOMES), 0)
+        if status['finished'] is None and status['rate'] > 0:
+            status['eta'] = status['remaining']/status['rate']
+    return status
+
+def write_status(directory):
+    ''' Merge directory's run and worker files into its status.json '''
+    status = read_status(directory)
+    _write_json(os.path.join(directory, 'status.json'), status)
+    return status
+
+
+def _duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return '%id%02ih'%(seconds//86400, seconds%86400//3600)
+    return '%ih%02im%02is'%(seconds//3600, seconds%3600//60, seconds%60)
+
+def _when(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+def status_report(status):
+    ''' read_status()'s status as a few lines of text '''
+    if status['started'] is None:
+        return 'no run in %s'%status['directory']
+    now = status['time']
+    lines = ['run started %s (%s ago), %s'%(_when(status['started']),
+             _duration(now - status['started']),
+             'finished %s'%_when(status['finished']) if status['finished']
+             else 'running')]
+
+    finished = sum(status[o] for o in OUTCOMES)
+    line = 'galaxies  %i done, %i failed, %i quarantined'%(status['done'],
+           status['failed'], status['quarantined'])
+    if status['total']:
+        line += ' -- %i of %i (%.1f%%)'%(finished, status['total'],
+                                          100.*finished/status['total'])
+    lines.append(line)
+
+    line = 'rate      %.3g galaxies/s over the last %g min'%(status['rate'],
+           RATE_WINDOW/60.)
+    if status['eta'] is not None:
+        line += ', ETA %s (%s)'%(_duration(status['eta']),
+                                 _when(now + status['eta']))
+    elif status['finished'] is None:
+        line += ', ETA unknown'
+    lines.append(line)
+
+    if status['stages']:
+        lines.append('stages    '+'  '.join('%s %.0f%%'%(name, 100*share)
+                     for name, share in sorted(status['stages'].items(),
+                                               key=lambda s: -s[1])))
+
+    workers = status['workers']
+    if workers:
+        lines.append('%-20s %7s %7s %6s %5s %8s %8s %8s  %s'%('worker',
+                     'done', 'failed', 'quar', 'gal/s', 'rss MB', 'peak MB',
+                     'updated', 'last'))
+        for w in sorted(workers, key=lambda w: (w['host'], w['pid'])):
+            lines.append('%-20s %7i %7i %6i %5.2f %8s %8.0f %7s%s  %s'%(
+                '%s.%i'%(w['host'][:12], w['pid']), w.get('done', 0),
+                w.get('failed', 0), w.get('quarantined', 0), w['rate'],
+                '%.0f'%w['rss_mb'] if w.get('rss_mb') is not None else '?',
+                w.get('peak_mb', 0), '%is'%(now - w['updated']),
+                '!' if w['stale'] else ' ', w.get('last') or ''))
+    return '\n'.join(lines)
+
+def show_status(directory, as_json=False, clear=False, out=sys.stdout):
+    ''' Write the status of a run to out: the report, or the JSON '''
+    status = read_status(directory)
+    if clear:
+        # clear the terminal
+        out.write('\033[2J\033[H')
+    if as_json:
+        out.write(json.dumps(status, indent=1)+'\n')
+    else:
+        out.write(status_report(status)+'\n')
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the status of a run '
+                                     'started with --status DIR')
+    parser.add_argument('directory', type=str)
+    parser.add_argument('--watch', type=float, default=None,
+                        help='Redraw every this many seconds until ctrl-c')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the merged status as JSON')
+    args = parser.parse_args()
+
+    while True:
+        show_status(args.directory, args.json,
+                    clear=bool(args.watch) and not args.json)
+        if not args.watch:
+            break
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+'''
+Supervised measuring: one bad galaxy shouldn't be able to stop a run.
+
+supervised() runs the measurement of a single galaxy
+    - under a wall-clock limit (SIGALRM, so it only takes effect in a
+      process's main thread -- which is where pool/joblib workers run jobs)
+    - under a memory limit (RLIMIT_DATA: allocating past it raises
+      MemoryError instead of dragging the whole node into swap;
+      memory-mapped files like stamp stores don't count against it). It's
+      a limit on the whole worker process, held only while the galaxy is
+      measured
+and if anything goes wrong the input is moved into the quarantine
+directory together with a <name>.fail.json saying what happened, where
+(the deepest morph function on the traceback) and the traceback itself.
+The caller still gets a row back: NaN everywhere except the galaxy's
+identity and failcode/failstage, so the catalog accounts for every galaxy.
+
+failcode is 0 for a good measurement, otherwise one of FAIL_*.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import threading
+import traceback
+import numpy as np
+
+from logs import get_logger
+from instrument import current
+
+log = get_logger(__name__)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+FAIL_NONE = 0
+FAIL_ERROR = 1
+FAIL_TIMEOUT = 2
+FAIL_MEMORY = 3
+FAIL_INPUT = 4
+
+QUARANTINE = 'bad_cutouts/'
+
+
+class GalaxyTimeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise GalaxyTimeout()
+
+class time_limit(object):
+    ''' with time_limit(seconds): raises GalaxyTimeout when time runs out '''
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.active = bool(seconds) and \
+            isinstance(threading.current_thread(), threading._MainThread)
+
+    def __enter__(self):
+        if self.active:
+            self._old = signal.signal(signal.SIGALRM, _alarm)
+            signal.alarm(max(1, int(np.ceil(self.seconds))))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.active:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, self._old)
+
+class memory_limit(object):
+    '''
+    with memory_limit(nbytes): caps the heap at nbytes until the block is
+    left. RLIMIT_DATA belongs to the process, not the call -- any thread 
+    allocating meanwhile is held to it too -- so the old limit is put back
+    on the way out.
+    '''
+
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.active = bool(nbytes) and resource is not None
+
+    def __enter__(self):
+        if self.active:
+            self._old = resource.getrlimit(resource.RLIMIT_DATA)
+            soft, hard = self._old
+            soft = int(self.nbytes) if hard == resource.RLIM_INFINITY \
+                   else min(int(self.nbytes), hard)
+            resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.active:
+            resource.setrlimit(resource.RLIMIT_DATA, self._old)
+
+def failure_code(error):
+    if isinstance(error, GalaxyTimeout):
+        return FAIL_TIMEOUT
+    if isinstance(error, MemoryError):
+        return FAIL_MEMORY
+    if isinstance(error, (IOError, OSError)):
+        return FAIL_INPUT
+    return FAIL_ERROR
+
+def failure_stage(tb):
+    '''
+    Name of the innermost morph function in a traceback, or failing that
+    the function supervised() was asked to run
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    frames = [f for f in traceback.extract_tb(tb)
+              if os.path.splitext(os.path.basename(f[0]))[0]
+              not in ('supervise', 'instrument')]
+    if not frames:
+        return ''
+    stage = frames[0][2]
+    for filename, lineno, func, text in frames:
+        if os.path.dirname(os.path.abspath(filename)) == here:
+            stage = func
+            if func.startswith('__'):
+                # __init__ on its own doesn't say much
+                module = os.path.splitext(os.path.basename(filename))[0]
+                stage = module+'.'+func
+    return stage
+
+def item_name(item):
+    ''' A file name for a galaxy however it was given (file, cutout, objid) '''
+    if hasattr(item, 'name'):
+        return str(item.name)
+    if isinstance(item, basestring):
+        return os.path.basename(os.path.splitext(item)[0])
+    return str(item)
+
+def item_objid(item):
+    if hasattr(item, 'objid'):
+        return np.int64(item.objid)
+    if isinstance(item, basestring):
+        # datacubes are f_<objid>_<tag>, cutouts <objid>_<tag>
+        name = item_name(item)
+        if name.startswith('f_'):
+            name = name[2:]
+        try:
+            return np.int64(name.split('_')[0])
+        except ValueError:
+            return np.int64(-1)
+    return np.int64(item)
+
+def failed_row(item, failcode, stage=''):
+    ''' The catalog row of a galaxy that couldn't be measured '''
+    row = {'name':item_name(item), 'objid':item_objid(item),
+           'failcode':failcode, 'failstage':stage}
+    if isinstance(item, basestring):
+        row['filename'] = item
+    return row
+
+def quarantine(item, failcode, stage, error, tb, qdir=QUARANTINE):
+    '''
+    Get a failed input out of the way: files are moved into qdir, virtual
+    cutouts are written there (there's no file to move) and galaxies that
+    live in a stamp store just get their record. Either way qdir gets a
+    <name>.fail.json with the failure.
+    '''
+    if not os.path.isdir(qdir):
+        try:
+            os.makedirs(qdir)
+        except OSError:
+            pass
+    name = item_name(item)
+
+    try:
+        if hasattr(item, 'write'):
+            item.write(qdir)
+        elif isinstance(item, basestring) and os.path.isfile(item):
+            shutil.move(item, os.path.join(qdir, os.path.basename(item)))
+    except (IOError, OSError):
+        # quarantining must never be the thing that takes the worker down
+        pass
+
+    record = {'item':str(item), 'name':name, 'failcode':failcode,
+              'stage':stage, 'error':repr(error),
+              'traceback':''.join(traceback.format_tb(tb)),
+              'host':os.uname()[1], 'pid':os.getpid(), 'time':time.time()}
+    with open(os.path.join(qdir, name+'.fail.json'), 'w') as F:
+        json.dump(record, F, indent=1)
+
+def supervised(func, args, item, timeout=None, max_memory=None,
+               qdir=QUARANTINE):
+    '''
+    Row from func(*args, item) -- a dict of catalog values -- with
+    failcode/failstage added; if func fails, times out or runs out of
+    memory, the input is quarantined and a NaN row comes back instead
+    '''
+    try:
+        with memory_limit(max_memory), time_limit(timeout):
+            row = func(*(args+(item,)))
+        row['failcode'], row['failstage'] = FAIL_NONE, ''
+        return row
+    except Exception as error:
+        tb = sys.exc_info()[2]
+        failcode, stage = failure_code(error), failure_stage(tb)
+        log.warning("Quarantining %s -- %s %r", item_name(item), stage, error)
+        quarantine(item, failcode, stage, error, tb, qdir)
+        current().quarantined = True
+        return failed_row(item, failcode, stage)
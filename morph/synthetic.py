@@ -0,0 +1,270 @@
+'''
+Synthetic galaxy stamps with known properties, for benchmarking and
+checking the pipeline without the SDSS cutouts.
+
+make_stamp() draws a Sersic galaxy (index n, half-light semi-major axis
+re, axis ratio q, position angle theta) in the middle of a stamp that
+reaches `scale` Petrosian radii out on each side -- like the 3Rp and 4Rp
+cutouts -- plus any companions (Sersic) and stars (Moffat) at the given
+separations, and Gaussian sky noise:
+
+    stamp = make_stamp(n=4, re=6., scale=4, companions=[(5., 0.5)], seed=1)
+    filename = write_datacube(stamp, 'stamps/')
+    g = GalaxyMorphology(fits.open(filename), filename, flags, outdir)
+
+Everything comes out of a RandomState seeded with `seed`, so the same
+arguments give the same pixels. stamp.truth has the parameters and what
+the profile says the measurements should be: the Petrosian radius as
+get_petro_ell2 defines it (sb in 0.8-1.25a over <sb> inside a, = 0.2),
+r20/r50/r80 and C of the light inside 1.5 Rp as get_concentration_ell
+counts it, and A, G and M20 of the noiseless image inside 1 Rp. There is
+no PSF: only the stars are blurred.
+
+write_datacube() writes a stamp the way clean_frame would have (CLN, ORG,
+BSEG, FSEG and CAT, with SECATIDX pointing at the galaxy) as
+f_<objid>_<tag>.fits; write_cutout() writes the raw cutout clean_frame
+starts from.
+'''
+
+import os
+import math
+import numpy as np
+import astropy.io.fits as fits
+from scipy.special import gammainc
+from scipy.optimize import brentq
+
+import datacube
+
+
+OBJID0 = 900000000000000000
+OVERSAMPLE = 4
+CORE, CORE_OVERSAMPLE = 3, 40
+SKY_RMS = 1.
+MOFFAT_BETA = 3.
+
+
+def sersic_b(n):
+    ''' b_n such that re encloses half the light (Ciotti & Bertin 1999) '''
+    return 2*n - 1/3. + 4/(405.*n) + 46/(25515.*n**2)
+
+def sersic_total(n, re, q, Ie=1.):
+    ''' Total flux of a Sersic profile with surface brightness Ie at re '''
+    b = sersic_b(n)
+    return 2*np.pi*n*q*re**2*Ie*np.exp(b)*b**(-2*n)*math.gamma(2*n)
+
+def enclosed(m, n, re):
+    ''' Fraction of a Sersic profile's light inside semi-major axis m '''
+    return gammainc(2*n, sersic_b(n)*(np.asarray(m, float)/re)**(1./n))
+
+def petrosian_radius(n, re, eta=0.2):
+    '''
+    Where the surface brightness in 0.8-1.25 a over the mean inside a
+    drops to eta (the same for every axis ratio)
+    '''
+    def ratio(a):
+        annulus = enclosed(1.25*a, n, re) - enclosed(0.8*a, n, re)
+        return annulus/(1.25**2 - 0.8**2) / enclosed(a, n, re) - eta
+    return brentq(ratio, 0.01*re, 100*re)
+
+def concentration(n, re, rp):
+    ''' r20, r50, r80 and C with the total taken inside 1.5 Rp '''
+    total = enclosed(1.5*rp, n, re)
+    radii = [brentq(lambda m: enclosed(m, n, re) - f*total, 1e-4*re, 1.5*rp)
+             for f in (0.2, 0.5, 0.8)]
+    return radii + [5*np.log10(radii[2]/radii[0])]
+
+
+def _grid(shape, oversample):
+    # pixel-centre coordinates of every subpixel, (rows, cols)
+    ny, nx = shape
+    sub = (np.arange(oversample) + 0.5)/oversample - 0.5
+    y = (np.arange(ny)[:,None] + sub[None,:]).ravel()
+    x = (np.arange(nx)[:,None] + sub[None,:]).ravel()
+    return y[:,None], x[None,:]
+
+def _bin(image, oversample):
+    ny, nx = image.shape[0]//oversample, image.shape[1]//oversample
+    return image.reshape(ny, oversample, nx, oversample).mean(axis=(1, 3))
+
+def elliptical_radius(x, y, x0, y0, q, theta):
+    ''' Semi-major axis of the ellipse through (x, y) '''
+    dx, dy = x - x0, y - y0
+    u = dx*np.cos(theta) + dy*np.sin(theta)
+    v = -dx*np.sin(theta) + dy*np.cos(theta)
+    return np.sqrt(u**2 + (v/q)**2)
+
+def sersic_image(shape, x0, y0, flux, n, re, q=1., theta=0.,
+                 oversample=OVERSAMPLE):
+    ''' A Sersic galaxy of total flux `flux` centred on (x0, y0) '''
+    Ie = flux/sersic_total(n, re, q)
+    def draw(y, x):
+        m = elliptical_radius(x, y, x0, y0, q, theta)
+        return Ie*np.exp(-sersic_b(n)*((m/re)**(1./n) - 1))
+
+    y, x = _grid(shape, oversample)
+    image = _bin(draw(y, x), oversample)
+
+    # the cusp: the pixels around the centre much more finely
+    r0, c0 = int(round(y0)), int(round(x0))
+    rows = slice(max(r0-CORE, 0), min(r0+CORE+1, shape[0]))
+    cols = slice(max(c0-CORE, 0), min(c0+CORE+1, shape[1]))
+    core = (rows.stop-rows.start, cols.stop-cols.start)
+    if min(core) > 0:
+        y, x = _grid(core, CORE_OVERSAMPLE)
+        image[rows, cols] = _bin(draw(y+rows.start, x+cols.start),
+                                 CORE_OVERSAMPLE)
+    return image
+
+def moffat_image(shape, x0, y0, flux, fwhm=3., beta=MOFFAT_BETA):
+    ''' A star: Moffat profile of total flux `flux` '''
+    y, x = np.indices(shape)
+    alpha = fwhm/(2*np.sqrt(2**(1./beta) - 1))
+    r2 = (x - x0)**2 + (y - y0)**2
+    return flux*(beta - 1)/(np.pi*alpha**2)*(1 + r2/alpha**2)**(-beta)
+
+
+class Stamp(object):
+    '''
+    A synthetic cutout: image (with noise), model (without), segmap, the
+    SE-like catalog of everything in it (cat; the galaxy is row 0), name,
+    objid and truth
+    '''
+
+    def __init__(self, image, model, segmap, cat, name, objid, truth):
+        self.image, self.model, self.segmap = image, model, segmap
+        self.cat, self.name, self.objid = cat, name, objid
+        self.truth = truth
+
+
+def _catalog(models, segmap, centers):
+    # what SExtractor would have said about each object (1-based pixels
+    # like SE), from the moments of its noiseless light in its segment
+    names = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'A_IMAGE', 'B_IMAGE',
+             'THETA_IMAGE', 'ELONGATION', 'ELLIPTICITY', 'KRON_RADIUS',
+             'FLUX_AUTO', 'ISOAREA_IMAGE', 'ALPHA_J2000', 'DELTA_J2000']
+    rows = []
+    y, x = np.indices(segmap.shape)
+    for idx, (model, (x0, y0)) in enumerate(zip(models, centers)):
+        mine = segmap == idx+1
+        w = model[mine]
+        if not w.sum():
+            w, mine = model.ravel(), np.ones(segmap.shape, bool)
+        dx, dy = x[mine] - x0, y[mine] - y0
+        xx, yy, xy = [np.sum(w*d)/np.sum(w) for d in (dx*dx, dy*dy, dx*dy)]
+        root = np.sqrt(((xx - yy)/2.)**2 + xy**2)
+        a = np.sqrt(max((xx + yy)/2. + root, 1e-6))
+        b = np.sqrt(max((xx + yy)/2. - root, 1e-6))
+        theta = 0.5*np.arctan2(2*xy, xx - yy)
+        m = elliptical_radius(x[mine], y[mine], x0, y0, b/a, theta)
+        kron = np.sum(w*m)/np.sum(w)/a
+        rows.append((idx+1, x0+1, y0+1, a, b, np.degrees(theta), a/b, 1-b/a,
+                     kron, model.sum(), mine.sum(), 0., 0.))
+    return np.rec.fromrecords(rows, names=names)
+
+def _gini(values):
+    values = np.sort(np.abs(values))
+    n = len(values)
+    return np.sum((2*np.arange(1, n+1) - n - 1)*values)/(values.mean()*n*(n-1))
+
+def _m20(image, x0, y0):
+    # about the given centre (the galaxy's), brightest 20% of the light;
+    # NaN when one pixel has more than that, as get_m20 has it
+    y, x = np.indices(image.shape)
+    f = image.ravel()
+    m = (f*((x - x0)**2 + (y - y0)**2).ravel())
+    order = np.argsort(f)[::-1]
+    bright = np.cumsum(f[order]) < 0.2*f.sum()
+    if not bright.any():
+        return np.nan
+    return np.log10(m[order][bright].sum()/m.sum())
+
+def make_stamp(n=1., re=5., q=0.7, theta=0.5, flux=2e4, scale=4,
+               companions=(), stars=(), clump=0., sky_rms=SKY_RMS,
+               seed=0, index=0, tag=None):
+    '''
+    A Stamp of one galaxy reaching scale Rp out on each side.
+    companions: (separation in re, flux ratio) for each Sersic neighbour
+    (n=1, half the size); stars: (separation in re, flux ratio). Their
+    directions are random. clump puts that fraction of the galaxy's light
+    in a blob 0.5 re off centre (so A isn't 0). index makes the objid.
+    '''
+    rng = np.random.RandomState(seed)
+    rp = petrosian_radius(n, re)
+    half = int(np.ceil(scale*rp))
+    shape = (2*half+1, 2*half+1)
+    x0 = y0 = float(half)
+
+    models = [sersic_image(shape, x0, y0, flux*(1-clump), n, re, q, theta)]
+    centers = [(x0, y0)]
+    if clump:
+        angle = rng.uniform(0, 2*np.pi)
+        models[0] = models[0] + sersic_image(shape,
+            x0 + 0.5*re*np.cos(angle), y0 + 0.5*re*np.sin(angle),
+            flux*clump, 0.5, 0.2*re)
+    for separation, ratio in companions:
+        angle = rng.uniform(0, 2*np.pi)
+        cx, cy = x0 + separation*re*np.cos(angle), \
+                 y0 + separation*re*np.sin(angle)
+        models.append(sersic_image(shape, cx, cy, flux*ratio, 1., 0.5*re,
+                                   rng.uniform(0.4, 1.), rng.uniform(0, np.pi)))
+        centers.append((cx, cy))
+    for separation, ratio in stars:
+        angle = rng.uniform(0, 2*np.pi)
+        cx, cy = x0 + separation*re*np.cos(angle), \
+                 y0 + separation*re*np.sin(angle)
+        models.append(moffat_image(shape, cx, cy, flux*ratio))
+        centers.append((cx, cy))
+
+    model = np.sum(models, axis=0)
+    image = model + rng.normal(0., sky_rms, shape)
+
+    # SE-ish segmentation: above the noise, to whichever object is brightest
+    segmap = np.where(model > sky_rms, np.argmax(models, axis=0)+1, 0)
+    segmap = segmap.astype(np.int16)
+    cat = _catalog(models, segmap, centers)
+
+    r20, r50, r80, C = concentration(n, re, rp)
+    y, x = np.indices(shape)
+    aper = elliptical_radius(x, y, x0, y0, q, theta) <= rp
+    galaxy = models[0]
+    A = np.sum(np.abs(galaxy - galaxy[::-1,::-1])[aper])/np.sum(galaxy[aper])
+    truth = {'n':n, 're':re, 'q':q, 'theta':theta, 'flux':flux,
+             'scale':scale, 'clump':clump, 'sky_rms':sky_rms,
+             'companions':list(companions), 'stars':list(stars),
+             'seed':seed, 'x':x0, 'y':y0, 'Rp':rp, 'r20':r20, 'r50':r50,
+             'r80':r80, 'C':C, 'A':A, 'G':_gini(galaxy[aper]),
+             'M20':_m20(np.where(aper, galaxy, 0.), x0, y0)}
+
+    objid = OBJID0 + index
+    tag = tag or '%iRp'%scale
+    return Stamp(image, model, segmap, cat, '%i_%s'%(objid, tag), objid,
+                 truth)
+
+
+def write_datacube(stamp, outdir, version=datacube.DCVERS,
+                   quantize_level=datacube.QUANTIZE_LEVEL):
+    ''' The stamp as clean_frame's datacube f_<name>.fits; its file name '''
+    header = fits.Header()
+    header.set('SE_MODE', 'FAINT', 'Sextractor mode used to clean image')
+    header.set('SECATIDX', 0, 'Index in FAINT catalog denoting gal of '
+               'interest')
+    image = stamp.image.astype(np.float32)
+    hdus = [fits.ImageHDU(data=image, header=header, name='CLN'),
+            fits.ImageHDU(data=image, name='ORG'),
+            fits.ImageHDU(data=stamp.segmap, name='BSEG'),
+            fits.ImageHDU(data=stamp.segmap, name='FSEG'),
+            fits.BinTableHDU(data=stamp.cat, name='CAT')]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    filename = os.path.join(outdir, 'f_'+stamp.name+'.fits')
+    datacube.write_datacube(hdus, filename, version, quantize_level)
+    return filename
+
+def write_cutout(stamp, outdir):
+    ''' The raw cutout <name>.fits clean_frame takes; its file name '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    filename = os.path.join(outdir, stamp.name+'.fits')
+    fits.PrimaryHDU(data=stamp.image.astype(np.float32)).writeto(
+        filename, clobber=True)
+    return filename
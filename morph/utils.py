@@ -8,26 +8,32 @@ from scipy.interpolate import interp1d
 from collections import OrderedDict
 from random import gauss
 import pdb #"""for doing an IDL-like stop"""
-from scipy.spatial import cKDTree
 import scipy.ndimage as ndimage
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
+from logs import get_logger
 #import fast_ffts
-import run_sextractor
 
+log = get_logger(__name__)
 
-def resource_getrusage():
+
+RUSAGE_FIELDS = [
+    ('ru_utime', 'User time'),
+    ('ru_stime', 'System time'),
+    ('ru_maxrss', 'Max. Resident Set Size'),
+    ('ru_ixrss', 'Shared Memory Size'),
+    ('ru_idrss', 'Unshared Memory Size'),
+    ('ru_isrss', 'Stack Size'),
+    ('ru_inblock', 'Block inputs'),
+    ('ru_oublock', 'Block outputs')]
+
+def resource_usage():
+    ''' This process's getrusage() as {field: value} (ru_maxrss in KB) '''
     usage = resource.getrusage(resource.RUSAGE_SELF)
-    for name, desc in [
-            ('ru_utime', 'User time'),
-            ('ru_stime', 'System time'),
-            ('ru_maxrss', 'Max. Resident Set Size'),
-            ('ru_ixrss', 'Shared Memory Size'),
-            ('ru_idrss', 'Unshared Memory Size'),
-            ('ru_isrss', 'Stack Size'),
-            ('ru_inblock', 'Block inputs'),
-            ('ru_oublock', 'Block outputs')]:
-        print '%-25s (%-10s) = %s' %(desc, name, getattr(usage, name))
+    return dict((name, getattr(usage, name)) for name, desc in RUSAGE_FIELDS)
+
+def resource_getrusage():
+    usage = resource_usage()
+    for name, desc in RUSAGE_FIELDS:
+        print '%-25s (%-10s) = %s' %(desc, name, usage[name])
 
 def resource_getrlimits():
     
@@ -73,8 +79,8 @@ def get_intersect(ydata, point, xvals, mono='inc'):
                     return np.mean([xvals[idx-1], xvals[idx]])
                     break
         else:
-            print 'Data never cross the Horizontal Line.'
-            print 'Cannot calculate the intersection.'
+            log.warning('Data never cross the horizontal line at %g: cannot '
+                        'calculate the intersection', point)
             return np.nan
 
     if mono=='dec':
@@ -84,11 +90,12 @@ def get_intersect(ydata, point, xvals, mono='inc'):
                     return np.mean([xvals[idx-1], xvals[idx]])
                     break
         else:
-            print 'Data never cross the Horizontal Line.'
-            print 'Cannot calculate the intersection.'
+            log.warning('Data never cross the horizontal line at %g: cannot '
+                        'calculate the intersection', point)
             return np.nan
 
 def find_closest(point, listofpoints, k=1):
+    from scipy.spatial import cKDTree
     
     # create a KDTree
     tree = cKDTree(listofpoints)
@@ -164,8 +171,8 @@ def get_SB_Mask(Rp, Rp_SB, image, outname):
             mm.writeto(outname+'_mask.fits', clobber=True)
             return mask2
         except:
-            print "You're in that weird place in get_SB_Mask..."
-            pdb.set_trace()
+            log.error("You're in that weird place in get_SB_Mask...")
+            raise
     else: 
         mm = fits.ImageHDU(data=mask)
         mm.writeto(outname+'_mask.fits', clobber=True)
@@ -203,6 +210,10 @@ class MyEllipticalAperture(object):
 
     def plot(self, ax=None, fill=False,  **kwargs):
         
+        # matplotlib only gets imported by whoever actually plots
+        import matplotlib.pyplot as plt
+        from matplotlib.patches import Ellipse
+
         kwargs['fill'] = fill
 
         if ax is None:
@@ -226,20 +237,6 @@ class MyEllipticalAperture(object):
     def num_pix(weights):
         return np.sum(weights)    
 
-    def run(self,longTable=False):
-        '''Return:
-        (skysub_aper_counts, aper_area, total_aper_counts,
-         sky_area, total_sky_counts, med_sky_counts, std_sky_counts)
-        '''
-        aper = self.aper * self.data
-
-        pdb.set_trace()
-        #sky = self.skyaper * self.data
-        #aper_area = self.radius*self.radius*np.pi
-        #sky_area = self.skyradius**2*np.pi - aper_area
-
-        return 0
-
 class MyCircularAperture(object):
 
     def __init__(self, xycenter, r, data):
@@ -263,6 +260,8 @@ class MyCircularAperture(object):
 
     def plot(self, ax=None, fill=False,  **kwargs):
         
+        import matplotlib.pyplot as plt
+
         kwargs['fill'] = fill
 
         if ax is None:
@@ -338,6 +337,7 @@ def plot2d(data, cmap='gray_r', **kwargs):
     for name, value in kwargs.items(): 
         print "%s = %f" %(name, value)
     
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.imgshow(kwargs['img'], cmap=kwargs['cmap'] )
     
@@ -349,6 +349,7 @@ def hist2d(data, *args, **kwargs):
 
     num = np.arange(0, datax.ndim, 1)
 
+    import matplotlib.pyplot as plt
     f, axarr = plt.subplots(datax.ndim)
     for n in num: 
         axarr[n].plot(datax[n], datay[n])
@@ -0,0 +1,47 @@
+import glob, argparse, warnings
+
+import numpy as np
+
+import morph
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Pack datacubes into a '
+		'stamp store')
+	parser.add_argument('store', type=str,
+		help='Stamp store directory (created if needed, appended to if not)')
+	parser.add_argument('pattern', type=str, nargs='?',
+		default='output_4Rp/chunk*/datacube/f_*Rp.fits',
+		help='Glob of datacubes to pack')
+	parser.add_argument('--chunk-mb', dest='chunk_mb', type=int, default=1024,
+		help='Size of each data chunk in MB')
+	args = parser.parse_args()
+
+	warnings.filterwarnings('ignore', message='Overwriting existing file .*')
+
+	fitsfiles = sorted(glob.glob(args.pattern))
+
+	store = morph.StampStore(args.store, mode='a',
+							 chunk_bytes=args.chunk_mb*(1 << 20))
+	done = set(store.lookup())
+
+	packed = 0
+	for f in fitsfiles:
+		objid = np.int64(f.split('/')[-1].split('_')[1])
+		if objid in done:
+			continue
+		store.add_datacube(f)
+		# the same objid can turn up twice in one pattern
+		done.add(objid)
+		packed += 1
+		if packed % 1000 == 0:
+			# a packer killed after this only has to redo what follows
+			store.flush()
+			print packed, "stamps packed"
+
+	store.close()
+	print "Packed", packed, "new stamps;", len(store), "in", args.store
+
+
+if __name__ == "__main__":
+	main()